@@ -1,6 +1,8 @@
 from gnomad_hail.utils import *
 from gnomad_hail.resources import *
 from gnomad_hail.slack_utils import *
+from gnomad_hail.cache_utils import *
+from gnomad_hail.profile_utils import *
 
 try:
     from gnomad_hail.slack_creds import *
@@ -0,0 +1,555 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import time
+import uuid
+
+logger = logging.getLogger("cache_utils")
+logger.setLevel(logging.INFO)
+
+CACHE_DIR = os.environ.get('GNOMAD_HAIL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'gnomad_hail'))
+
+
+def get_dir(*path):
+    """
+    Returns (and creates if needed) a local directory.
+
+    :param str path: Path components
+    :return: Path to the directory
+    :rtype: str
+    """
+    path = os.path.join(*path)
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def get_cache_dir(*subdirs):
+    """
+    Returns (and creates if needed) a local cache directory.
+    The root of the cache is set by the `GNOMAD_HAIL_CACHE_DIR` environment variable (default: ~/.cache/gnomad_hail)
+
+    :param str subdirs: Sub-directories within the cache root
+    :return: Path to the cache directory
+    :rtype: str
+    """
+    return get_dir(CACHE_DIR, *subdirs)
+
+
+def hash_content(chunks):
+    """
+    Computes the SHA-1 digest of a sequence of strings (e.g. lines of a file)
+
+    :param iterable of str chunks: Content to hash
+    :return: Hex digest
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    for chunk in chunks:
+        h.update(chunk.encode('utf-8') if not isinstance(chunk, bytes) else chunk)
+    return h.hexdigest()
+
+
+def is_remote_path(path):
+    """
+    Returns whether a path is a remote URL (e.g. gs://, hdfs://) rather than a local path or `file://` URI
+
+    :param str path: Path
+    :return: Whether the path is remote
+    :rtype: bool
+    """
+    return re.match(r'^\w+://', path) is not None and not path.startswith('file://')
+
+
+def file_sha1(path, block_size=1 << 20):
+    """
+    Computes the SHA-1 digest of a local file
+
+    :param str path: Local path
+    :param int block_size: Read block size
+    :return: Hex digest
+    :rtype: str
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def gsutil_fetch(url, dest):
+    """
+    Copies a remote file to a local path using `gsutil`
+
+    :param str url: Remote URL
+    :param str dest: Local destination path
+    """
+    subprocess.check_call(['gsutil', '-q', 'cp', url, dest])
+
+
+class ResourceMirror(object):
+    """
+    Local mirror of remote resource files (e.g. the interval lists, fam files or metadata TSVs in resources.py).
+
+    Files are stored content-addressed (`objects/<sha1>/<basename>`, keeping the basename so that file formats can
+    still be inferred from the extension) and tracked in `manifest.json` with their SHA-1, size and last access time.
+    Mirrored files are verified against their checksum when resolved (and fetched again if corrupted), the least
+    recently used files are evicted when the mirror grows over `max_size`, and the original URL is returned whenever
+    a file cannot be mirrored.
+
+    Note that the mirror is only visible to the processes that can read `mirror_dir`: unless `shared` is set, it
+    should only be used for files read on the driver.
+    """
+
+    def __init__(self, mirror_dir, max_size=10 * 1024 ** 3, fetch=gsutil_fetch, verify=True, shared=False):
+        """
+        :param str mirror_dir: Local directory of the mirror
+        :param int max_size: Maximum total size of the mirrored files in bytes
+        :param function(str, str) fetch: Function copying a remote URL to a local path (default: `gsutil cp`)
+        :param bool verify: Whether to verify the checksum of mirrored files every time they are resolved
+        :param bool shared: Whether `mirror_dir` is visible from the Spark executors (e.g. in local mode or on a shared mount)
+        """
+        self.mirror_dir = mirror_dir
+        self.max_size = max_size
+        self.fetch = fetch
+        self.verify = verify
+        self.shared = shared
+        self.stats = {'hits': 0, 'fetches': 0, 'fallbacks': 0, 'evictions': 0}
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.mirror_dir, 'manifest.json')
+
+    def load_manifest(self):
+        """
+        :return: Dictionary of url -> {path, sha1, size, last_access}
+        :rtype: dict
+        """
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        tmp_path = '{}.{}.tmp'.format(self.manifest_path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.manifest_path)
+
+    def is_valid(self, entry):
+        path = os.path.join(self.mirror_dir, entry['path'])
+        return (os.path.isfile(path) and os.path.getsize(path) == entry['size'] and
+                (not self.verify or file_sha1(path) == entry['sha1']))
+
+    def resolve(self, url):
+        """
+        Returns the local path of the mirrored copy of `url`, fetching it if needed.
+        Local paths, and URLs that cannot be mirrored, are returned as is.
+
+        :param str url: Resource URL
+        :return: Local path of the mirrored file, or `url`
+        :rtype: str
+        """
+        if not is_remote_path(url):
+            return url
+
+        manifest = self.load_manifest()
+        entry = manifest.get(url)
+        if entry is not None:
+            if self.is_valid(entry):
+                self.stats['hits'] += 1
+                entry['last_access'] = time.time()
+                self.save_manifest(manifest)
+                return os.path.join(self.mirror_dir, entry['path'])
+            logger.warn("Mirrored copy of %s is corrupted or missing, fetching it again.", url)
+            self.remove(manifest, url)
+
+        try:
+            entry = self.add(manifest, url)
+        except Exception as e:
+            logger.warn("Could not mirror %s (%s), using original URL.", url, e)
+            entry = None
+
+        if entry is None:
+            self.stats['fallbacks'] += 1
+            return url
+
+        self.evict(manifest, keep=url)
+        self.save_manifest(manifest)
+        return os.path.join(self.mirror_dir, entry['path'])
+
+    def add(self, manifest, url):
+        """
+        Fetches `url` into the mirror and adds it to the manifest
+
+        :param dict manifest: Manifest
+        :param str url: Resource URL
+        :return: Manifest entry, or None if the file is larger than the mirror
+        :rtype: dict
+        """
+        tmp_path = os.path.join(get_dir(self.mirror_dir, 'tmp'), uuid.uuid4().hex)
+        try:
+            self.fetch(url, tmp_path)
+            self.stats['fetches'] += 1
+            size = os.path.getsize(tmp_path)
+            if size > self.max_size:
+                logger.warn("%s (%d bytes) is larger than the mirror size (%d bytes).", url, size, self.max_size)
+                return None
+            sha1 = file_sha1(tmp_path)
+            path = os.path.join('objects', sha1, url.rstrip('/').split('/')[-1])
+            if not os.path.exists(os.path.join(self.mirror_dir, path)):
+                os.rename(tmp_path, os.path.join(get_dir(self.mirror_dir, 'objects', sha1), os.path.basename(path)))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        manifest[url] = {'path': path, 'sha1': sha1, 'size': size, 'last_access': time.time()}
+        return manifest[url]
+
+    def remove(self, manifest, url):
+        """
+        Removes `url` from the manifest, and its file if no other URL shares the same content.
+
+        :param dict manifest: Manifest
+        :param str url: Resource URL
+        """
+        entry = manifest.pop(url)
+        if all(x['path'] != entry['path'] for x in manifest.values()):
+            path = os.path.join(self.mirror_dir, entry['path'])
+            for remove in [os.remove, lambda x: os.rmdir(os.path.dirname(x))]:
+                try:
+                    remove(path)
+                except OSError:
+                    pass
+
+    def evict(self, manifest, keep=None):
+        """
+        Removes the least recently used files until the mirror is under `max_size`.
+
+        :param dict manifest: Manifest
+        :param str keep: URL that should not be evicted
+        """
+        def total_size():
+            return sum(x['size'] for x in dict((x['path'], x) for x in manifest.values()).values())
+
+        for url in sorted(manifest, key=lambda x: manifest[x]['last_access']):
+            if total_size() <= self.max_size:
+                break
+            if url != keep:
+                logger.info("Evicting %s from resource mirror.", url)
+                self.stats['evictions'] += 1
+                self.remove(manifest, url)
+
+
+_resource_mirror = None
+
+
+def set_resource_mirror(mirror):
+    """
+    Sets the `ResourceMirror` used by `resolve_resource` (None to disable mirroring).
+    By default, a mirror is created if the `GNOMAD_HAIL_MIRROR_DIR` environment variable is set
+    (with its maximum size in bytes in `GNOMAD_HAIL_MIRROR_MAX_SIZE`).
+
+    :param ResourceMirror mirror: Resource mirror
+    """
+    global _resource_mirror
+    _resource_mirror = mirror
+
+
+def get_resource_mirror():
+    """
+    :return: The `ResourceMirror` used by `resolve_resource`, or None if mirroring is disabled
+    :rtype: ResourceMirror
+    """
+    global _resource_mirror
+    if _resource_mirror is None and 'GNOMAD_HAIL_MIRROR_DIR' in os.environ:
+        _resource_mirror = ResourceMirror(os.environ['GNOMAD_HAIL_MIRROR_DIR'])
+        if 'GNOMAD_HAIL_MIRROR_MAX_SIZE' in os.environ:
+            _resource_mirror.max_size = int(os.environ['GNOMAD_HAIL_MIRROR_MAX_SIZE'])
+    return _resource_mirror
+
+
+def resolve_resource(path, uri=False, executors=False):
+    """
+    Resolves a resource path to its mirrored copy if a resource mirror is set (see `set_resource_mirror`).
+
+    :param str path: Resource path (e.g. `lcr_intervals_path`)
+    :param bool uri: Whether to return mirrored files as `file://` URIs (e.g. to be read by Hail rather than Python)
+    :param bool executors: Whether the file is read by the Spark executors (only resolved if the mirror is shared)
+    :return: Path to use
+    :rtype: str
+    """
+    mirror = get_resource_mirror()
+    if mirror is None or (executors and not mirror.shared):
+        return path
+    resolved = mirror.resolve(path)
+    return 'file://' + os.path.abspath(resolved) if uri and resolved != path else resolved
+
+
+def fingerprint(obj):
+    """
+    Computes a stable SHA-1 digest of a JSON-serializable object (e.g. function arguments)
+
+    :param obj: Object to hash
+    :return: Hex digest
+    :rtype: str
+    """
+    return hash_content([json.dumps(obj, sort_keys=True, default=str)])
+
+
+def path_version(path):
+    """
+    Returns a digest of the files (names, sizes and modification times) under a path, so that fingerprints change
+    when inputs are rewritten in place.
+    Local paths are walked recursively. Google Storage paths are listed with `gsutil ls -l` (not recursively: for
+    datasets, the top-level metadata files are rewritten on each write). Other remote paths return None.
+
+    :param str path: Path to a file or directory (e.g. a VDS)
+    :return: Hex digest, or None for missing paths and remote paths other than gs://
+    :rtype: str
+    """
+    if path.startswith('gs://'):
+        try:
+            with open(os.devnull, 'w') as devnull:
+                return hash_content([subprocess.check_output(['gsutil', 'ls', '-l', path.rstrip('/')], stderr=devnull)])
+        except subprocess.CalledProcessError:
+            return None
+    if is_remote_path(path):
+        return None
+    path = path[len('file://'):] if path.startswith('file://') else path
+    if not os.path.exists(path):
+        return None
+    if os.path.isfile(path):
+        return hash_content([str((os.path.getsize(path), os.path.getmtime(path)))])
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            f = os.path.join(root, name)
+            entries.append(str((os.path.relpath(f, path), os.path.getsize(f), os.path.getmtime(f))))
+    return hash_content(entries)
+
+
+def path_size(path):
+    """
+    Returns the total size of a file or directory, local or remote (using `gsutil du`)
+
+    :param str path: Path
+    :return: Size in bytes
+    :rtype: int
+    """
+    if is_remote_path(path):
+        return int(subprocess.check_output(['gsutil', 'du', '-s', path]).split()[0])
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(path) for f in files)
+
+
+def remove_path(path):
+    """
+    Recursively removes a file or directory, local or remote (using `gsutil rm`)
+
+    :param str path: Path
+    """
+    if is_remote_path(path):
+        subprocess.call(['gsutil', '-m', '-q', 'rm', '-r', path])
+    elif os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def move_path(path, dest):
+    """
+    Moves a file or directory, local (with a rename) or remote (using `gsutil mv`). An existing `dest` is replaced.
+
+    :param str path: Source path
+    :param str dest: Destination path
+    """
+    remove_path(dest)
+    if is_remote_path(path):
+        subprocess.check_call(['gsutil', '-m', '-q', 'mv', path, dest])
+    else:
+        os.rename(path, dest)
+
+
+def read_json(path, default=None):
+    """
+    Reads a JSON file, local or remote (through Hadoop)
+
+    :param str path: Path
+    :param default: Value returned if the file is missing or cannot be parsed
+    :return: Parsed content
+    """
+    try:
+        if is_remote_path(path):
+            from hail import hadoop_read
+            with hadoop_read(path) as f:
+                return json.loads(f.read())
+        with open(path) as f:
+            return json.load(f)
+    except Exception:
+        return default
+
+
+def write_json(path, obj):
+    """
+    Writes a JSON file, local (atomically) or remote (through Hadoop)
+
+    :param str path: Path
+    :param obj: JSON-serializable content
+    """
+    content = json.dumps(obj, indent=1, sort_keys=True)
+    if is_remote_path(path):
+        from hail import hadoop_write
+        with hadoop_write(path) as f:
+            f.write(content)
+    else:
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, path)
+
+
+class CheckpointCache(object):
+    """
+    Cache of checkpointed datasets (e.g. the fully annotated VDS returned by `get_gnomad_data`), keyed by a fingerprint
+    of the arguments used to build them and of the versions of their inputs.
+
+    Checkpoints are written under `root` (local or remote) as `<fingerprint>.vds`, and tracked in `root/manifest.json`
+    with their description, size, creation and last access times. The least recently used checkpoints are evicted
+    when the cache grows over `max_size`.
+    """
+
+    def __init__(self, root, max_size=None):
+        """
+        :param str root: Directory of the cache (e.g. a local directory, or gs://bucket/tmp/checkpoints)
+        :param int max_size: Maximum total size of the checkpoints in bytes (None for no limit)
+        """
+        self.root = root.rstrip('/')
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @property
+    def manifest_path(self):
+        return self.root + '/manifest.json'
+
+    def load_manifest(self):
+        """
+        :return: Dictionary of key -> {path, description, size, created, last_access}
+        :rtype: dict
+        """
+        return read_json(self.manifest_path, {})
+
+    def save_manifest(self, manifest):
+        write_json(self.manifest_path, manifest)
+
+    def key(self, args, inputs=()):
+        """
+        Computes the key of a checkpoint
+
+        :param dict args: Arguments (and any other settings) used to build the dataset
+        :param list of str inputs: Paths of the inputs of the dataset (versioned by `path_version`)
+        :return: Checkpoint key
+        :rtype: str
+        """
+        return fingerprint({'args': args, 'inputs': [(path, path_version(path)) for path in inputs]})
+
+    def path(self, key):
+        return '{}/{}.vds'.format(self.root, key)
+
+    def get(self, key):
+        """
+        :param str key: Checkpoint key
+        :return: Path to the checkpoint, or None if it is not in the cache
+        :rtype: str
+        """
+        manifest = self.load_manifest()
+        if key not in manifest:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        manifest[key]['last_access'] = time.time()
+        self.save_manifest(manifest)
+        return manifest[key]['path']
+
+    def put(self, key, description=None):
+        """
+        Records a checkpoint written at `self.path(key)` and evicts older checkpoints if needed
+
+        :param str key: Checkpoint key
+        :param description: JSON-serializable description of the checkpoint (e.g. its arguments)
+        """
+        if not is_remote_path(self.root):
+            get_dir(self.root)
+        manifest = self.load_manifest()
+        path = self.path(key)
+        now = time.time()
+        manifest[key] = {'path': path, 'description': description, 'size': path_size(path), 'created': now, 'last_access': now}
+        self.evict(manifest, keep=key)
+        self.save_manifest(manifest)
+
+    def invalidate(self, key=None):
+        """
+        Removes a checkpoint from the cache, or all checkpoints if `key` is None
+
+        :param str key: Checkpoint key
+        """
+        manifest = self.load_manifest()
+        for k in [key] if key is not None else list(manifest):
+            entry = manifest.pop(k, None)
+            remove_path(entry['path'] if entry else self.path(k))
+        self.save_manifest(manifest)
+
+    def evict(self, manifest, keep=None):
+        """
+        Removes the least recently used checkpoints until the cache is under `max_size`.
+
+        :param dict manifest: Manifest
+        :param str keep: Key that should not be evicted
+        """
+        if self.max_size is None:
+            return
+        for key in sorted(manifest, key=lambda x: manifest[x]['last_access']):
+            if sum(x['size'] for x in manifest.values()) <= self.max_size:
+                break
+            if key != keep:
+                logger.info("Evicting checkpoint %s from %s.", key, self.root)
+                self.stats['evictions'] += 1
+                remove_path(manifest.pop(key)['path'])
+
+    def checkpoint_vds(self, hc, build, args, inputs=()):
+        """
+        Returns the checkpointed VDS for `args` and `inputs` if it is in the cache, or builds, writes and
+        returns it otherwise.
+
+        :param HailContext hc: HailContext
+        :param function build: Function returning the VDS to checkpoint
+        :param dict args: Arguments used to build the VDS
+        :param list of str inputs: Paths of the inputs of the VDS
+        :return: Checkpointed VDS
+        :rtype: VariantDataset
+        """
+        key = self.key(args, inputs)
+        path = self.get(key)
+        if path is not None:
+            try:
+                return hc.read(path)
+            except Exception as e:
+                logger.warn("Could not read checkpoint %s (%s), rebuilding it.", path, e)
+                self.invalidate(key)
+
+        path = self.path(key)
+        logger.info("Writing checkpoint %s", path)
+        build().write(path, overwrite=True)
+        self.put(key, args)
+        return hc.read(path)
@@ -1,6 +1,6 @@
 #!/usr/bin/env bash
 
-PACKAGES="slackclient sklearn tabulate pandas scipy statsmodels"
+PACKAGES="sklearn tabulate pandas scipy statsmodels"
 pip install --upgrade $PACKAGES
 
 export HAIL_VERSION=devel
@@ -0,0 +1,256 @@
+import functools
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+from cache_utils import write_json
+
+logger = logging.getLogger("profile_utils")
+logger.setLevel(logging.INFO)
+
+
+def get_spark_context():
+    """
+    :return: The active SparkContext, or None if there is none (or pyspark is not available)
+    :rtype: SparkContext
+    """
+    try:
+        from pyspark import SparkContext
+        return SparkContext._active_spark_context
+    except ImportError:
+        return None
+
+
+def get_jvm_heap_pools(sc):
+    """
+    :param SparkContext sc: SparkContext
+    :return: Heap memory pools of the driver JVM
+    :rtype: list of MemoryPoolMXBean
+    """
+    try:
+        return [pool for pool in sc._jvm.java.lang.management.ManagementFactory.getMemoryPoolMXBeans()
+                if str(pool.getType()) == 'HEAP']
+    except Exception:
+        return []
+
+
+class StepProfiler(object):
+    """
+    Records, for each named step of a job (see `step` and `profiled`):
+    - its wall time
+    - the number of Spark jobs and stages it ran (steps are tracked as Spark job groups, which are set per thread: jobs
+      started from other threads are only counted when the function they run is wrapped with `bind`)
+    - the peak heap usage of the driver JVM during the step
+    - the peak RSS of the python driver process at the end of the step (process-wide peak)
+
+    Steps can be nested: jobs and memory of inner steps are included in the outer steps.
+    The steps can be reported as a table (`summary`) or as JSON (`to_json`), and are written to `json_path` after
+    each step when set.
+    """
+
+    def __init__(self, sc=None, json_path=None):
+        """
+        :param SparkContext sc: SparkContext (default: the active SparkContext)
+        :param str json_path: Path (local or remote) where the steps are written as JSON after each step
+        """
+        self.sc = sc
+        self.json_path = json_path
+        self.steps = []
+        self.active = []
+
+    @contextmanager
+    def step(self, name):
+        """
+        Context manager profiling a step
+
+        :param str name: Name of the step
+        """
+        sc = self.sc or get_spark_context()
+        pools = get_jvm_heap_pools(sc) if sc is not None else []
+        if self.active:
+            self._update_heap_peak(self.active[-1], pools)
+        for pool in pools:
+            pool.resetPeakUsage()
+
+        record = {'name': name, 'depth': len(self.active), 'status': 'running', 'job_group': 'gnomad_step_%d' % len(self.steps),
+                  'n_jobs': None, 'n_stages': None, 'jvm_heap_peak_mb': None, 'driver_maxrss_mb': None,
+                  'job_ids': set(), 'start': time.time()}
+        self.steps.append(record)
+        self.active.append(record)
+        if sc is not None:
+            sc.setJobGroup(record['job_group'], name)
+        try:
+            yield record
+            record['status'] = 'success'
+        except BaseException:
+            record['status'] = 'failed'
+            raise
+        finally:
+            self.active.pop()
+            record['wall_time'] = time.time() - record.pop('start')
+            if sc is not None:
+                self._update_jobs(record, sc)
+                self._update_heap_peak(record, pools)
+                if self.active:
+                    parent = self.active[-1]
+                    parent['job_ids'].update(record['job_ids'])
+                    parent['jvm_heap_peak_mb'] = max(parent['jvm_heap_peak_mb'], record['jvm_heap_peak_mb'])
+                    sc.setJobGroup(parent['job_group'], parent['name'])
+                else:
+                    sc.setLocalProperty('spark.jobGroup.id', None)
+                    sc.setLocalProperty('spark.job.description', None)
+            record['driver_maxrss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+            logger.info("Step %s (%s) took %.1fs", name, record['status'], record['wall_time'])
+            if self.json_path:
+                try:
+                    write_json(self.json_path, self.to_json())
+                except Exception as e:
+                    logger.warn("Could not write profile to %s: %s", self.json_path, e)
+
+    def profiled(self, name=None):
+        """
+        Decorator profiling each call of a function as a step
+
+        :param str name: Name of the step (default: name of the function)
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.step(name or f.__name__):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def bind(self, f):
+        """
+        Wraps a function so that the Spark jobs it starts are counted in the step that is running when `bind` is called,
+        even when it runs in another thread (e.g. with `ThreadPool.map`)
+
+        :param function f: Function
+        :return: Wrapped function
+        :rtype: function
+        """
+        sc = self.sc or get_spark_context()
+        if sc is None or not self.active:
+            return f
+        record = self.active[-1]
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            sc.setJobGroup(record['job_group'], record['name'])
+            try:
+                return f(*args, **kwargs)
+            finally:
+                sc.setLocalProperty('spark.jobGroup.id', None)
+                sc.setLocalProperty('spark.job.description', None)
+        return wrapper
+
+    def _update_jobs(self, record, sc):
+        tracker = sc.statusTracker()
+        record['job_ids'].update(tracker.getJobIdsForGroup(record['job_group']))
+        record['n_jobs'] = len(record['job_ids'])
+        job_infos = [tracker.getJobInfo(job_id) for job_id in record['job_ids']]
+        record['n_stages'] = sum(len(info.stageIds) for info in job_infos if info is not None)
+
+    @staticmethod
+    def _update_heap_peak(record, pools):
+        if pools:
+            peak = sum(pool.getPeakUsage().getUsed() for pool in pools) / float(1 << 20)
+            record['jvm_heap_peak_mb'] = max(record['jvm_heap_peak_mb'], peak)
+
+    def reset(self):
+        """
+        Clears the recorded steps. Cannot be called while a step is running.
+        """
+        if self.active:
+            raise ValueError("Cannot reset the profiler while steps are running: %s" % ", ".join(step['name'] for step in self.active))
+        self.steps = []
+
+    def to_json(self):
+        """
+        :return: Steps as JSON-serializable dicts (name, depth, status, wall_time, n_jobs, n_stages, jvm_heap_peak_mb, driver_maxrss_mb)
+        :rtype: list of dict
+        """
+        return [{k: v for k, v in step.iteritems() if k not in ('job_ids', 'job_group', 'start')} for step in self.steps]
+
+    def summary(self):
+        """
+        :return: Table of the steps (nested steps are indented)
+        :rtype: str
+        """
+        def fmt(x, pattern):
+            return pattern % x if x is not None else '-'
+
+        lines = ['{:<40} {:>8} {:>10} {:>6} {:>7} {:>10} {:>10}'.format('step', 'status', 'time (s)', 'jobs', 'stages', 'heap (MB)', 'rss (MB)')]
+        for step in self.steps:
+            lines.append('{:<40} {:>8} {:>10} {:>6} {:>7} {:>10} {:>10}'.format(
+                ('  ' * step['depth'] + step['name'])[:40], step['status'], fmt(step.get('wall_time'), '%.1f'),
+                fmt(step['n_jobs'], '%d'), fmt(step['n_stages'], '%d'), fmt(step['jvm_heap_peak_mb'], '%.0f'),
+                fmt(step['driver_maxrss_mb'], '%.0f')))
+        return '\n'.join(lines)
+
+
+_profiler = None
+
+
+def get_profiler():
+    """
+    Returns the module-level StepProfiler (used by `profile_step`, `profiled`, `bind_to_step` and `try_slack`).
+    Its steps are written as JSON to $GNOMAD_PROFILE_JSON when set.
+
+    :return: Profiler
+    :rtype: StepProfiler
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = StepProfiler(json_path=os.environ.get('GNOMAD_PROFILE_JSON'))
+    return _profiler
+
+
+def set_profiler(profiler):
+    """
+    :param StepProfiler profiler: Module-level profiler, or None to reset it
+    """
+    global _profiler
+    _profiler = profiler
+
+
+def profile_step(name):
+    """
+    Context manager profiling a step with the module-level profiler, e.g.:
+
+    with profile_step('sample_qc'):
+        vds = vds.sample_qc()
+
+    :param str name: Name of the step
+    """
+    return get_profiler().step(name)
+
+
+def profiled(name=None):
+    """
+    Decorator profiling each call of a function as a step of the module-level profiler (see `StepProfiler.profiled`).
+    The profiler is looked up at call time, so that `set_profiler` also applies to functions decorated at import.
+
+    :param str name: Name of the step (default: name of the function)
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            return get_profiler().profiled(name or f.__name__)(f)(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind_to_step(f):
+    """
+    Wraps a function so that the Spark jobs it starts from other threads are counted in the current step of the
+    module-level profiler (see `StepProfiler.bind`)
+
+    :param function f: Function
+    :return: Wrapped function
+    :rtype: function
+    """
+    return get_profiler().bind(f)
@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 from __future__ import print_function
 import argparse
+import hashlib
 import sys
 import subprocess
 import os
+import shlex
+import time
 import zipfile
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 # Great hack for 2.X and 3.X to use input()
 try:
@@ -18,40 +22,138 @@ try:
 except Exception:
     standard_scripts = None
 
+# Local cache of the latest Hail build hashes and of the zipped script bundles
+CACHE_DIR = os.path.expanduser(os.environ.get('PYHAIL_CACHE_DIR', '~/.pyhail'))
+HASH_TTL = int(os.environ.get('PYHAIL_HASH_TTL', 3600))
+MAX_BUNDLES = 20
 
-def main(args, pass_through_args):
-    temp_py = None
-    if args.script is None:
-        if args.inline is None:
-            print('Either --script or --inline is required. Exiting.', file=sys.stderr)
-            sys.exit(1)
-        if 'print' not in args.inline:
-            continue_script = input('No print statement found. Continue? [no] ')
-            if not len(continue_script.strip()) or continue_script[0] != 'y':
-                sys.exit(1)
-        temp_py = tempfile.mkstemp(suffix='.py')
-        with open(temp_py[1], 'w') as temp_py_f:
-            script = "from hail import *\nfrom pprint import pprint\nhc = HailContext(log=\"/hail.log\")\n"
-            if standard_scripts is not None and any(['resources.py' in x for x in standard_scripts]):
-                script = "from resources import *\n" + script
-            temp_py_f.write(script)
-            temp_py_f.write(args.inline)
-        script = temp_py[1]
-    else:
-        script = args.script
 
-    print('Running {} on {}'.format(script, args.cluster))
+def get_cache_dir(name):
+    path = os.path.join(CACHE_DIR, name)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+    return path
 
-    hash_string = ''
+
+def write_atomic(path, content, mode='w'):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, mode) as f:
+        f.write(content)
+    os.rename(tmp_path, path)
+
+
+def get_hash_string(hail_version, spark_version, ttl=HASH_TTL):
+    """
+    Returns the hash of the latest Hail build, read from $HAIL_HASH_LOCATION if set, or fetched with `gsutil` and
+    cached locally for `ttl` seconds otherwise. A stale cached hash is used if `gsutil` fails.
+
+    :param str hail_version: Hail version (0.1 or devel)
+    :param str spark_version: Spark version
+    :param int ttl: Time to live of the cached hash in seconds
+    :return: Hash of the build
+    :rtype: str
+    """
     try:
         with open(os.path.expanduser(os.environ['HAIL_HASH_LOCATION'])) as f:
             hash_string = f.read().strip()
+        if hash_string:
+            return hash_string
     except Exception:
         pass
 
+    cache_path = os.path.join(get_cache_dir('hashes'), 'latest-hash-{}-spark-{}.txt'.format(hail_version, spark_version))
+    cached = None
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = f.read().strip()
+        if cached and time.time() - os.path.getmtime(cache_path) < ttl:
+            return cached
+
+    try:
+        hash_string = subprocess.check_output(['gsutil', 'cat', 'gs://hail-common/builds/{}/latest-hash-spark-{}.txt'.format(hail_version, spark_version)]).decode().strip()
+    except (OSError, subprocess.CalledProcessError) as e:
+        if cached:
+            print('Could not fetch latest hash ({}), using cached hash {}'.format(e, cached), file=sys.stderr)
+            return cached
+        raise
+    if hash_string:
+        write_atomic(cache_path, hash_string)
+    return hash_string
+
+
+def list_script_files(pyfiles):
+    """
+    Lists the python files to bundle: `.py` entries are added at the root of the bundle and directories are walked,
+    keeping their own name as top-level package.
+
+    :param list of str pyfiles: Python files and directories
+    :return: Sorted list of (path, name in bundle)
+    :rtype: list of (str, str)
+    """
+    files = []
+    for hail_script_entry in pyfiles:
+        if hail_script_entry.endswith('.py'):
+            files.append((hail_script_entry, os.path.basename(hail_script_entry)))
+        else:
+            for root, _, names in os.walk(hail_script_entry):
+                for pyfile in names:
+                    if pyfile.endswith('.py'):
+                        files.append((os.path.join(root, pyfile),
+                                      os.path.relpath(os.path.join(root, pyfile), os.path.join(hail_script_entry, '..'))))
+    return sorted(files, key=lambda x: x[1])
+
+
+def get_scripts_bundle(pyfiles):
+    """
+    Returns a zip of the python files in `pyfiles`, cached by content: the zip is only rebuilt when a file is added,
+    removed or modified. Only the `MAX_BUNDLES` most recently used bundles are kept.
+
+    :param list of str pyfiles: Python files and directories
+    :return: Path to the zip
+    :rtype: str
+    """
+    files = list_script_files(pyfiles)
+    h = hashlib.sha1()
+    for path, arcname in files:
+        with open(path, 'rb') as f:
+            content = f.read()
+        h.update('{}\0{}\0'.format(arcname, len(content)).encode())
+        h.update(content)
+
+    bundles_dir = get_cache_dir('bundles')
+    bundle = os.path.join(bundles_dir, 'pyscripts_{}.zip'.format(h.hexdigest()))
+    if os.path.exists(bundle):
+        os.utime(bundle, None)
+        return bundle
+
+    tmp_bundle = '{}.{}.tmp'.format(bundle, os.getpid())
+    zipf = zipfile.ZipFile(tmp_bundle, 'w', zipfile.ZIP_DEFLATED)
+    for path, arcname in files:
+        zipf.write(path, arcname=arcname)
+    zipf.close()
+    os.rename(tmp_bundle, bundle)
+
+    old_bundles = sorted([os.path.join(bundles_dir, x) for x in os.listdir(bundles_dir) if x.endswith('.zip')],
+                         key=os.path.getmtime, reverse=True)[MAX_BUNDLES:]
+    for old_bundle in old_bundles:
+        os.remove(old_bundle)
+    return bundle
+
+
+def get_job_files(args):
+    """
+    Returns the Hail JAR and python files to submit with the jobs (building or reusing the scripts bundle)
+
+    :param Namespace args: Command-line arguments
+    :return: JAR path, JAR file name and list of python files (Hail zip first)
+    :rtype: (str, str, list of str)
+    """
     spark_version = '2.1.0' if args.preview else '2.0.2'
-    if not hash_string:
-        hash_string = subprocess.check_output(['gsutil', 'cat', 'gs://hail-common/builds/{}/latest-hash-spark-{}.txt'.format(args.hail_version, spark_version)]).rstrip()
+    hash_string = get_hash_string(args.hail_version, spark_version)
 
     if not hash_string:
         print('Could not get hash string', file=sys.stderr)
@@ -72,43 +174,166 @@ def main(args, pass_through_args):
     if standard_scripts is not None:
         pyfiles.extend(standard_scripts)
     if pyfiles:
-        tfile = tempfile.mkstemp(suffix='.zip', prefix='pyscripts_')[1]
-        print(tfile)
-        zipf = zipfile.ZipFile(tfile, 'w', zipfile.ZIP_DEFLATED)
-        for hail_script_entry in pyfiles:
-            if hail_script_entry.endswith('.py'):
-                zipf.write(hail_script_entry, arcname=os.path.basename(hail_script_entry))
-            else:
-                for root, _, files in os.walk(hail_script_entry):
-                    for pyfile in files:
-                        if pyfile.endswith('.py'):
-                            zipf.write(os.path.join(root, pyfile),
-                                       os.path.relpath(os.path.join(root, pyfile),
-                                                       os.path.join(hail_script_entry, '..')))
-        zipf.close()
-        all_pyfiles.append(tfile)
+        bundle = get_scripts_bundle(pyfiles)
+        print(bundle)
+        all_pyfiles.append(bundle)
 
     print('Using JAR: {} and files:\n{}'.format(jar, '\n'.join(pyfiles)))
+    return jar, jar_file, all_pyfiles
 
+
+def get_job(args, script, cluster, jar, jar_file, all_pyfiles, pass_through_args):
+    """
+    :return: `gcloud` command submitting `script` to `cluster`
+    :rtype: list of str
+    """
     spark_properties = ['spark.{}=./{}'.format(x, jar_file) for x in ('executor.extraClassPath', 'driver.extraClassPath', 'files')]
     spark_properties.append('spark.submit.pyFiles=./{}'.format(all_pyfiles[0]))
     if args.spark_conf:
         spark_properties.extend(args.spark_conf.split(','))
 
     job = ['gcloud', 'dataproc', 'jobs', 'submit', 'pyspark', script,
-           '--cluster', args.cluster,
+           '--cluster', cluster,
            '--files={}'.format(jar),
            '--py-files={}'.format(','.join(all_pyfiles)),
            '--properties={}'.format(','.join(spark_properties)),
            '--driver-log-levels', 'root=FATAL,is.hail=INFO'
     ]
-    if pass_through_args is not None:
+    if pass_through_args:
         job.append('--')
         job.extend(pass_through_args)
+    return job
+
 
-    subprocess.check_output(job)
-    if temp_py is not None:
-        os.remove(temp_py[1])
+def main(args, pass_through_args):
+    if args.batch is not None:
+        sys.exit(1 if run_batch(args, pass_through_args) else 0)
+    if args.cluster is None:
+        print('--cluster is required. Exiting.', file=sys.stderr)
+        sys.exit(1)
+
+    temp_py = None
+    if args.script is None:
+        if args.inline is None:
+            print('Either --script or --inline is required. Exiting.', file=sys.stderr)
+            sys.exit(1)
+        if 'print' not in args.inline:
+            continue_script = input('No print statement found. Continue? [no] ')
+            if not len(continue_script.strip()) or continue_script[0] != 'y':
+                sys.exit(1)
+        temp_py = tempfile.mkstemp(suffix='.py')
+        with open(temp_py[1], 'w') as temp_py_f:
+            script = "from hail import *\nfrom pprint import pprint\nhc = HailContext(log=\"/hail.log\")\n"
+            if standard_scripts is not None and any(['resources.py' in x for x in standard_scripts]):
+                script = "from resources import *\n" + script
+            temp_py_f.write(script)
+            temp_py_f.write(args.inline)
+        script = temp_py[1]
+    else:
+        script = args.script
+
+    print('Running {} on {}'.format(script, args.cluster))
+
+    jar, jar_file, all_pyfiles = get_job_files(args)
+    job = get_job(args, script, args.cluster, jar, jar_file, all_pyfiles, pass_through_args)
+    try:
+        subprocess.check_output(job)
+    finally:
+        if temp_py is not None:
+            os.remove(temp_py[1])
+
+
+def read_batch_manifest(path, default_cluster=None):
+    """
+    Reads a batch manifest: one job per line, as tab-separated `script`, `cluster` (empty for --cluster) and
+    pass-through arguments (shell-quoted). Empty lines and lines starting with # are ignored.
+
+    :param str path: Path to the manifest
+    :param str default_cluster: Cluster used when not specified in the manifest
+    :return: List of (script, cluster, pass-through args)
+    :rtype: list of (str, str, list of str)
+    """
+    jobs = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            script = fields[0].strip()
+            cluster = fields[1].strip() if len(fields) > 1 and fields[1].strip() else default_cluster
+            if cluster is None:
+                raise ValueError('No cluster specified for {} (line {} of {})'.format(script, i + 1, path))
+            jobs.append((script, cluster, shlex.split(fields[2]) if len(fields) > 2 else []))
+    return jobs
+
+
+def stage_bundle(bundle, staging_dir):
+    """
+    Uploads a scripts bundle to `staging_dir` (once per content, as bundles are named by their hash)
+
+    :param str bundle: Local path of the bundle
+    :param str staging_dir: Remote directory (e.g. gs://my-bucket/pyhail)
+    :return: Remote path of the bundle
+    :rtype: str
+    """
+    remote_bundle = '{}/{}'.format(staging_dir.rstrip('/'), os.path.basename(bundle))
+    if subprocess.call(['gsutil', '-q', 'stat', remote_bundle]) != 0:
+        subprocess.check_call(['gsutil', '-q', 'cp', bundle, remote_bundle])
+    return remote_bundle
+
+
+def run_batch(args, pass_through_args):
+    """
+    Submits all the jobs of the `args.batch` manifest, `args.max_jobs` at a time. The output of each job goes to its
+    own log file in `args.log_dir` and a report of the wall time and exit status of each job is printed at the end.
+    Command-line pass-through arguments are appended to the arguments of every job.
+    The scripts bundle is uploaded once to `args.staging_dir`, which is required when there is a bundle.
+
+    :param Namespace args: Command-line arguments
+    :param list of str pass_through_args: Arguments passed to all jobs
+    :return: Number of failed jobs
+    :rtype: int
+    """
+    jobs = read_batch_manifest(args.batch, args.cluster)
+    jar, jar_file, all_pyfiles = get_job_files(args)
+    if len(all_pyfiles) > 1:
+        if not args.staging_dir:
+            print('--staging_dir (or $PYHAIL_STAGING_DIR) is required to share the scripts bundle between batch jobs. Exiting.', file=sys.stderr)
+            sys.exit(1)
+        all_pyfiles[1] = stage_bundle(all_pyfiles[1], args.staging_dir)
+
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='pyhail_batch_')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    def run_job(i):
+        script, cluster, job_args = jobs[i]
+        log_path = os.path.join(log_dir, '{:03d}_{}.log'.format(i, os.path.splitext(os.path.basename(script))[0]))
+        job = get_job(args, script, cluster, jar, jar_file, all_pyfiles, job_args + (pass_through_args or []))
+        print('Running {} on {} (log: {})'.format(script, cluster, log_path))
+        start = time.time()
+        with open(log_path, 'w') as log:
+            log.write(' '.join(job) + '\n')
+            log.flush()
+            try:
+                status = subprocess.call(job, stdout=log, stderr=subprocess.STDOUT)
+            except OSError as e:
+                log.write('{}\n'.format(e))
+                status = -1
+        return script, cluster, status, time.time() - start, log_path
+
+    pool = ThreadPool(max(1, min(args.max_jobs, len(jobs))))
+    try:
+        results = pool.map(run_job, range(len(jobs)))
+    finally:
+        pool.close()
+
+    print('\n{:<40} {:<20} {:>6} {:>10}  {}'.format('script', 'cluster', 'status', 'time (s)', 'log'))
+    for script, cluster, status, elapsed, log_path in results:
+        print('{:<40} {:<20} {:>6} {:>10.1f}  {}'.format(script, cluster, status, elapsed, log_path))
+    n_failed = sum(1 for r in results if r[2] != 0)
+    print('{} of {} jobs failed'.format(n_failed, len(results)))
+    return n_failed
 
 
 if __name__ == '__main__':
@@ -116,7 +341,7 @@ if __name__ == '__main__':
 
     parser.add_argument('--script', '--input', '-i', help='Script to run')
     parser.add_argument('--inline', help='Inline script to run')
-    parser.add_argument('--cluster', help='Which cluster to run on', required=True)
+    parser.add_argument('--cluster', help='Which cluster to run on (required unless specified for every job of --batch)')
     parser.add_argument('--preview', help='Use Spark2.1 hail JAR', action = 'store_true')
 
     hail_script_options = parser.add_argument_group('Additional hail script options')
@@ -125,5 +350,13 @@ if __name__ == '__main__':
     hail_script_options.add_argument('--zip', help='Hail zip file to use')
     hail_script_options.add_argument('--add_scripts', help='Comma-separated list of additional python scripts to add.')
     hail_script_options.add_argument('--spark_conf', help='Comma-separated list of additional spark configurations to pass.')
+
+    batch_options = parser.add_argument_group('Batch submission options')
+    batch_options.add_argument('--batch', help='Manifest of jobs to submit: one job per line as tab-separated script, cluster (optional) and pass-through arguments')
+    batch_options.add_argument('--max_jobs', help='Maximum number of jobs running concurrently', type=int, default=4)
+    batch_options.add_argument('--log_dir', help='Directory of the job logs (default: a new temporary directory)')
+    batch_options.add_argument('--staging_dir', help='Remote directory where the scripts bundle is uploaded once for all jobs (e.g. gs://my-bucket/pyhail), '
+                                                     'required with --batch when scripts are added',
+                               default=os.environ.get('PYHAIL_STAGING_DIR'))
     args, pass_through_args = parser.parse_known_args()
     main(args, pass_through_args)
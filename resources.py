@@ -1,4 +1,12 @@
+import logging
+import random
+import uuid
+
 from hail import *
+from cache_utils import *
+
+logger = logging.getLogger("resources")
+logger.setLevel(logging.INFO)
 
 CURRENT_HAIL_VERSION = "0.1"
 CURRENT_RELEASE = "2.0.2"
@@ -7,6 +15,9 @@ CURRENT_EXOME_META = "2017-06-02"
 
 RELEASES = ["2.0.1", "2.0.2"]
 
+GNOMAD_DATA_CHECKPOINT_VERSION = 1  # Increment when get_gnomad_data changes so that existing checkpoints are not reused
+GNOMAD_META_KT_VERSION = 1  # Increment when import_gnomad_meta changes so that existing metadata KeyTables are not reused
+
 GENOME_POPS = ['AFR', 'AMR', 'ASJ', 'EAS', 'FIN', 'NFE', 'OTH']
 EXOME_POPS = ['AFR', 'AMR', 'ASJ', 'EAS', 'FIN', 'NFE', 'OTH', 'SAS']
 EXAC_POPS = ["AFR", "AMR", "EAS", "FIN", "NFE", "OTH", "SAS"]
@@ -36,10 +47,15 @@ def get_gnomad_public_data(hc, data_type, split=False, version=CURRENT_RELEASE):
 
 def get_gnomad_data(hc, data_type, hardcalls=None, split=False, hail_version=CURRENT_HAIL_VERSION,
                     meta_version=None, meta_root='sa.meta', vqsr=True, fam_root='sa.fam', duplicate_mapping_root=None,
-                    release_samples=False, release_annotations=None):
+                    release_samples=False, release_annotations=None, intervals=None, contigs=None,
+                    sample_fraction=None, n_samples=None, seed=42, checkpoint_cache=None, packed_hardcalls=False):
     """
     Wrapper function to get gnomAD data as VDS.
 
+    For development, the data can be subset to some `intervals` / `contigs` and to a random subset of samples
+    (`sample_fraction` or `n_samples`, deterministic for a given `seed`): these filters are applied before
+    any annotation join, and interval filters only read the overlapping partitions.
+
     :param HailContext hc: HailContext
     :param str data_type: One of `exomes` or `genomes`
     :param str hardcalls: One of `adj` or `raw` if hardcalls are desired (leave as None for raw data)
@@ -52,24 +68,54 @@ def get_gnomad_data(hc, data_type, hardcalls=None, split=False, hail_version=CUR
     :param str duplicate_mapping_root: Where to put the duplicate genome/exome samples ID mapping (default is None -- do not annotate)
     :param bool release_samples: When set, filters the data to release samples only
     :param str release_annotations: One of the RELEASES to add variant annotations (into va), or None for no data
+    :param list of str intervals: Intervals (e.g. `1:1000000-2000000`) to subset the data to
+    :param list of str contigs: Contigs to subset the data to
+    :param float sample_fraction: Fraction of the samples to keep (randomly chosen)
+    :param int n_samples: Number of samples to keep (randomly chosen)
+    :param int seed: Random seed used to choose samples
+    :param CheckpointCache checkpoint_cache: When set (as a CheckpointCache or the path to its root), the annotated VDS is written to the cache the first time and read back from it on subsequent calls with the same arguments
+    :param bool packed_hardcalls: Whether to read the packed hardcalls (GT and adj bit, see `utils.pack_hardcalls`): adj hardcalls are then obtained by filtering on the adj bit
     :return: Chosen VDS
     :rtype: VariantDataset
     """
-    vds = hc.read(get_gnomad_data_path(data_type, hardcalls=hardcalls, split=split, hail_version=hail_version))
+    if checkpoint_cache is not None:
+        if not isinstance(checkpoint_cache, CheckpointCache):
+            checkpoint_cache = CheckpointCache(checkpoint_cache)
+        args = dict(data_type=data_type, hardcalls=hardcalls, split=split, hail_version=hail_version,
+                    meta_version=meta_version, meta_root=meta_root, vqsr=vqsr, fam_root=fam_root,
+                    duplicate_mapping_root=duplicate_mapping_root, release_samples=release_samples,
+                    release_annotations=release_annotations, intervals=intervals, contigs=contigs,
+                    sample_fraction=sample_fraction, n_samples=n_samples, seed=seed, packed_hardcalls=packed_hardcalls)
+        return checkpoint_cache.checkpoint_vds(hc,
+                                               lambda: get_gnomad_data(hc, **args),
+                                               dict(function='get_gnomad_data', version=GNOMAD_DATA_CHECKPOINT_VERSION, **args),
+                                               get_gnomad_data_inputs(**args))
+
+    vds = hc.read(get_gnomad_data_path(data_type, hardcalls=hardcalls, split=split, hail_version=hail_version,
+                                       packed_hardcalls=packed_hardcalls))
+    if packed_hardcalls and hardcalls == 'adj':
+        vds = vds.filter_genotypes('g.adj')
+
+    subset_intervals = get_subset_intervals(intervals, contigs)
+    if subset_intervals:
+        vds = vds.filter_intervals(subset_intervals)
+
+    if sample_fraction is not None or n_samples is not None:
+        vds = vds.filter_samples_list(sample_subset(vds.sample_ids, sample_fraction, n_samples, seed))
 
     if meta_root:
         vds = vds.annotate_samples_table(get_gnomad_meta(hc, data_type, meta_version), root=meta_root)
 
     if duplicate_mapping_root:
         vds = vds.annotate_samples_table(
-            hc.import_table(genomes_exomes_duplicate_ids_tsv_path,
+            hc.import_table(resolve_resource(genomes_exomes_duplicate_ids_tsv_path, uri=True, executors=True),
                             impute=True,
                             key='exome_id' if data_type == "exomes" else 'genome_id'),
             root=duplicate_mapping_root)
 
     if fam_root:
         vds = vds.annotate_samples_table(
-            KeyTable.import_fam(exomes_fam_path if data_type == "exomes" else genomes_fam_path),
+            KeyTable.import_fam(resolve_resource(exomes_fam_path if data_type == "exomes" else genomes_fam_path, uri=True)),
             root=fam_root
         )
 
@@ -77,7 +123,9 @@ def get_gnomad_data(hc, data_type, hardcalls=None, split=False, hail_version=CUR
     vds = vds.annotate_global('global.pops', map(lambda x: x.lower(), pops), TArray(TString()))
 
     if data_type == 'exomes' and vqsr:
-        vqsr_vds = hc.read(vqsr_exomes_sites_vds_path())
+        vqsr_vds = hc.read(vqsr_exomes_sites_vds_path(hail_version))
+        if subset_intervals:
+            vqsr_vds = vqsr_vds.filter_intervals(subset_intervals)
         annotations = ['culprit', 'POSITIVE_TRAIN_SITE', 'NEGATIVE_TRAIN_SITE', 'VQSLOD']
         vds = vds.annotate_variants_vds(vqsr_vds, expr=', '.join(['va.info.%s = vds.info.%s' % (a, a) for a in annotations]))
 
@@ -86,15 +134,125 @@ def get_gnomad_data(hc, data_type, hardcalls=None, split=False, hail_version=CUR
 
     if release_annotations:
         sites_vds = get_gnomad_public_data(hc, data_type, split, release_annotations)
+        if subset_intervals:
+            sites_vds = sites_vds.filter_intervals(subset_intervals)
         vds = vds.annotate_variants_vds(sites_vds, root='va')
 
     return vds
 
 
-def get_gnomad_meta(hc, data_type, version=None):
+def get_subset_intervals(intervals=None, contigs=None):
+    """
+    Returns the intervals to subset data to (see `get_gnomad_data`)
+
+    :param list of str intervals: Intervals (as strings or Interval)
+    :param list of str contigs: Contigs
+    :return: List of Intervals
+    :rtype: list of Interval
+    """
+    subset_intervals = [x if isinstance(x, Interval) else Interval.parse(x) for x in (intervals or [])]
+    subset_intervals.extend(Interval.parse(str(contig)) for contig in (contigs or []))
+    return subset_intervals
+
+
+def sample_subset(sample_ids, sample_fraction=None, n_samples=None, seed=42):
+    """
+    Deterministically chooses a random subset of samples (independently of the order of `sample_ids`)
+
+    :param list of str sample_ids: Sample IDs
+    :param float sample_fraction: Fraction of the samples to keep
+    :param int n_samples: Number of samples to keep
+    :param int seed: Random seed
+    :return: Chosen sample IDs
+    :rtype: list of str
+    """
+    if sample_fraction is not None and n_samples is not None:
+        raise DataException("Select only one of sample_fraction or n_samples")
+    sample_ids = sorted(sample_ids)
+    if n_samples is None:
+        n_samples = int(round(sample_fraction * len(sample_ids)))
+    return random.Random(seed).sample(sample_ids, min(n_samples, len(sample_ids)))
+
+
+def get_gnomad_data_inputs(data_type, hardcalls=None, split=False, hail_version=CURRENT_HAIL_VERSION,
+                           meta_version=None, meta_root='sa.meta', vqsr=True, fam_root='sa.fam', duplicate_mapping_root=None,
+                           release_samples=False, release_annotations=None, packed_hardcalls=False, **kwargs):
+    """
+    Returns the paths of all the inputs read by `get_gnomad_data` with the same arguments
+
+    :return: List of input paths
+    :rtype: list of str
+    """
+    inputs = [get_gnomad_data_path(data_type, hardcalls=hardcalls, split=split, hail_version=hail_version,
+                                   packed_hardcalls=packed_hardcalls)]
+    if meta_root:
+        inputs.append(get_gnomad_meta_path(data_type, meta_version))
+    if duplicate_mapping_root:
+        inputs.append(genomes_exomes_duplicate_ids_tsv_path)
+    if fam_root:
+        inputs.append(exomes_fam_path if data_type == "exomes" else genomes_fam_path)
+    if data_type == 'exomes' and vqsr:
+        inputs.append(vqsr_exomes_sites_vds_path(hail_version))
+    if release_annotations:
+        inputs.append(get_gnomad_public_data_path(data_type, split, release_annotations))
+    return inputs
+
+
+def get_gnomad_meta(hc, data_type, version=None, use_cache=True):
     """
     Wrapper function to get gnomAD metadata as keytable
 
+    When it has been materialized with `write_gnomad_meta_kt`, the keyed and annotated metadata is read from its native
+    KeyTable (see `get_gnomad_meta_kt_path`) instead of re-importing and imputing the TSV. This function never writes it.
+
+    :param HailContext hc: HailContext
+    :param str data_type: One of `exomes` or `genomes`
+    :param str version: Metadata version (None for current)
+    :param bool use_cache: Whether to read the materialized KeyTable when present
+    :return: Metadata KeyTable
+    :rtype: KeyTable
+    """
+    if use_cache:
+        kt_path = get_gnomad_meta_kt_path(data_type, version)
+        if read_json(kt_path + '.SUCCESS.json') is not None:
+            return hc.read_table(kt_path)
+        logger.info("No materialized metadata found at %s (see write_gnomad_meta_kt), importing %s", kt_path, get_gnomad_meta_path(data_type, version))
+
+    return import_gnomad_meta(hc, data_type, version)
+
+
+def write_gnomad_meta_kt(hc, data_type, version=None, overwrite=False):
+    """
+    Materializes the gnomAD metadata (see `import_gnomad_meta`) as a native KeyTable at `get_gnomad_meta_kt_path`,
+    for `get_gnomad_meta` to read.
+    The table is written to a temporary path and then moved in place. A `<kt_path>.SUCCESS.json` marker is written last,
+    and readers ignore the table until it is present.
+
+    :param HailContext hc: HailContext
+    :param str data_type: One of `exomes` or `genomes`
+    :param str version: Metadata version (None for current)
+    :param bool overwrite: Whether to rewrite an existing table
+    :return: Path of the KeyTable
+    :rtype: str
+    """
+    kt_path = get_gnomad_meta_kt_path(data_type, version)
+    success_path = kt_path + '.SUCCESS.json'
+    if read_json(success_path) is not None and not overwrite:
+        logger.info("Metadata KeyTable already present at %s", kt_path)
+        return kt_path
+
+    tmp_path = '{}.{}.tmp'.format(kt_path, uuid.uuid4().hex)
+    import_gnomad_meta(hc, data_type, version).write(tmp_path)
+    remove_path(success_path)
+    move_path(tmp_path, kt_path)
+    write_json(success_path, {'source': get_gnomad_meta_path(data_type, version), 'kt_version': GNOMAD_META_KT_VERSION})
+    return kt_path
+
+
+def import_gnomad_meta(hc, data_type, version=None):
+    """
+    Imports gnomAD metadata from its TSV (with type imputation) as keytable
+
     :param HailContext hc: HailContext
     :param str data_type: One of `exomes` or `genomes`
     :param str version: Metadata version (None for current)
@@ -103,7 +261,7 @@ def get_gnomad_meta(hc, data_type, version=None):
     """
     return (
         hc
-        .import_table(get_gnomad_meta_path(data_type, version), impute=True)
+        .import_table(resolve_resource(get_gnomad_meta_path(data_type, version), uri=True, executors=True), impute=True)
         .key_by("sample" if data_type == "exomes" else "Sample")
         .annotate(['release = {}'.format('drop_status == "keep"' if data_type == "exomes" else 'keep'), # unify_sample_qc: this is version dependent will need fixing when new metadata arrives
                    'population = {}'.format('population' if data_type == "exomes" else 'if(final_pop == "sas") "oth" else final_pop')])
@@ -130,7 +288,7 @@ def get_gnomad_public_data_path(data_type, split=False, version=CURRENT_RELEASE)
     return DataException("Select data_type as one of 'genomes' or 'exomes'")
 
 
-def get_gnomad_data_path(data_type, hardcalls=None, split=False, hail_version=CURRENT_HAIL_VERSION):
+def get_gnomad_data_path(data_type, hardcalls=None, split=False, hail_version=CURRENT_HAIL_VERSION, packed_hardcalls=False):
     """
     Wrapper function to get paths to gnomAD data
 
@@ -138,11 +296,14 @@ def get_gnomad_data_path(data_type, hardcalls=None, split=False, hail_version=CU
     :param str hardcalls: One of `adj` or `raw` if hardcalls are desired (leave as None for raw data)
     :param bool split: Whether the dataset should be split (only applies to hardcalls)
     :param str hail_version: One of the HAIL_VERSIONs
+    :param bool packed_hardcalls: Whether to use the packed hardcalls (the same dataset for `adj` and `raw`)
     :return: Path to chosen VDS
     :rtype: str
     """
     if hardcalls is not None and hardcalls not in ('adj', 'raw'):
         return DataException("Select hardcalls as one of 'adj', 'raw', or None")
+    if packed_hardcalls and hardcalls:
+        return packed_hardcalls_vds_path(data_type, split, hail_version)
     if data_type == 'exomes':
         if not hardcalls:
             return raw_exomes_vds_path(hail_version)
@@ -176,6 +337,23 @@ def get_gnomad_meta_path(data_type, version=None):
     return DataException("Select data_type as one of 'genomes' or 'exomes'")
 
 
+def get_gnomad_meta_kt_path(data_type, version=None):
+    """
+    Wrapper function to get paths to the materialized gnomAD metadata KeyTables (see `write_gnomad_meta_kt`).
+    Paths include `GNOMAD_META_KT_VERSION`, so tables written by an older `import_gnomad_meta` are not reused.
+
+    :param str data_type: One of `exomes` or `genomes`
+    :param str version: String with version (date) for metadata
+    :return: Path to chosen metadata KeyTable
+    :rtype: str
+    """
+    if data_type == 'exomes':
+        return metadata_exomes_kt_path(version if version else CURRENT_EXOME_META)
+    elif data_type == 'genomes':
+        return metadata_genomes_kt_path(version if version else CURRENT_GENOME_META)
+    raise DataException("Select data_type as one of 'genomes' or 'exomes'")
+
+
 def vqsr_exomes_sites_vds_path(hail_version=CURRENT_HAIL_VERSION):
     return 'gs://gnomad/raw/hail-{0}/vds/exomes/gnomad.exomes.vqsr.sites.vds'.format(hail_version)
 
@@ -203,6 +381,18 @@ def hardcalls_genomes_vds_path(split=False, adj=False, hail_version=CURRENT_HAIL
                                                                                          "adj" if adj else "raw",
                                                                                          ".split" if split else "")
 
+def packed_hardcalls_vds_path(data_type, split=False, hail_version=CURRENT_HAIL_VERSION):
+    """
+    Returns the path of the packed hardcalls (GT and adj bit, see `utils.pack_hardcalls`)
+
+    :param str data_type: One of `exomes` or `genomes`
+    :param bool split: Whether the dataset is split
+    :param str hail_version: One of the HAIL_VERSIONs
+    :return: Path to packed hardcalls VDS
+    :rtype: str
+    """
+    return 'gs://gnomad/hardcalls/hail-{0}/vds/{1}/gnomad.{1}.packed{2}.vds'.format(hail_version, data_type, ".split" if split else "")
+
 gnomad_pca_vds_path = "gs://gnomad-genomes/sampleqc/gnomad.pca.vds"
 
 
@@ -225,6 +415,14 @@ def metadata_exomes_tsv_path(version=CURRENT_EXOME_META):
     return 'gs://gnomad/metadata/exomes/gnomad.exomes.metadata.{0}.tsv.bgz'.format(version)
 
 
+def metadata_genomes_kt_path(version=CURRENT_GENOME_META, kt_version=GNOMAD_META_KT_VERSION):
+    return 'gs://gnomad/metadata/genomes/gnomad.genomes.metadata.{0}.v{1}.kt'.format(version, kt_version)
+
+
+def metadata_exomes_kt_path(version=CURRENT_EXOME_META, kt_version=GNOMAD_META_KT_VERSION):
+    return 'gs://gnomad/metadata/exomes/gnomad.exomes.metadata.{0}.v{1}.kt'.format(version, kt_version)
+
+
 genomes_fam_path = "gs://gnomad/metadata/genomes/gnomad.genomes.fam"
 exomes_fam_path = "gs://gnomad/metadata/exomes/gnomad.exomes.fam"
 genomes_exomes_duplicate_ids_tsv_path = "gs://gnomad/metadata/genomes_exomes_duplicate_ids.tsv"
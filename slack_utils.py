@@ -1,97 +1,473 @@
+import Queue
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+import urllib
+import urllib2
+
+SLACK_API_URL = os.environ.get('SLACK_API_URL', 'https://slack.com/api')
+DIRECTORY_TTL = 3600  # Seconds before the user and channel name -> ID maps are refreshed
+DIRECTORY_PAGE_SIZE = 1000
+
+
+class SlackClient(object):
+    """
+    Minimal Slack Web API client (standard library only), caching the user and channel name -> ID maps for `ttl`
+    seconds. A name missing from a cached map triggers a single refresh of that map, so new users and channels are
+    still found.
+    """
+
+    def __init__(self, token, base_url=SLACK_API_URL, ttl=DIRECTORY_TTL, timeout=30):
+        """
+        :param str token: Slack API token
+        :param str base_url: Slack Web API URL
+        :param int ttl: Time to live of the cached name -> ID maps in seconds
+        :param int timeout: HTTP timeout in seconds
+        """
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.ttl = ttl
+        self.timeout = timeout
+        self.directories = {}
+        self._default_channel = None
+
+    def api_call(self, method, **kwargs):
+        """
+        Calls a Slack Web API method
+
+        :param str method: API method (e.g. `chat.postMessage`)
+        :param kwargs: Arguments of the method
+        :return: Parsed JSON response
+        :rtype: dict
+        """
+        params = {k: v.encode('utf-8') if isinstance(v, unicode) else v for k, v in kwargs.iteritems() if v is not None}
+        params['token'] = self.token
+        response = urllib2.urlopen('{}/{}'.format(self.base_url, method), urllib.urlencode(params), self.timeout)
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+
+    def list_all(self, method, key):
+        """
+        Fetches all the pages of a Slack list method
+
+        :param str method: List method (e.g. `users.list`)
+        :param str key: Key of the items in the response (e.g. `members`)
+        :return: All items
+        :rtype: list of dict
+        """
+        items = []
+        cursor = None
+        while True:
+            response = self.api_call(method, limit=DIRECTORY_PAGE_SIZE, cursor=cursor)
+            items.extend(response.get(key, []))
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return items
+
+    def get_directory(self, kind, refresh=False):
+        """
+        :param str kind: One of `users` or `channels`
+        :param bool refresh: Whether to refresh the cached map
+        :return: Name -> ID map
+        :rtype: dict of str -> str
+        """
+        timestamp, directory = self.directories.get(kind, (None, None))
+        if refresh or directory is None or time.time() - timestamp > self.ttl:
+            method, key = ('users.list', 'members') if kind == 'users' else ('channels.list', 'channels')
+            directory = {x['name']: x['id'] for x in self.list_all(method, key) if 'id' in x}
+            self.directories[kind] = (time.time(), directory)
+        return directory
+
+    def get_id(self, kind, name):
+        """
+        :param str kind: One of `users` or `channels`
+        :param str name: User or channel name
+        :return: ID, or None if not found
+        :rtype: str
+        """
+        timestamp = self.directories.get(kind, (None, None))[0]
+        directory = self.get_directory(kind)
+        if name not in directory and self.directories[kind][0] == timestamp:
+            directory = self.get_directory(kind, refresh=True)
+        return directory.get(name)
+
+    def get_user_id(self, user):
+        return self.get_id('users', user)
+
+    def get_channel_id(self, channel):
+        return self.get_id('channels', channel)
+
+    def get_target_id(self, target):
+        """
+        :param str target: `@user` or `#channel`
+        :return: ID of the user or channel, or None if not found
+        :rtype: str
+        """
+        if target.startswith('@'):
+            return self.get_user_id(target.lstrip('@'))
+        return self.get_channel_id(target.lstrip('#'))
+
+    @property
+    def default_channel(self):
+        """
+        The current user (`@user`) if they are in the workspace, `#gnomad` otherwise
+        """
+        if self._default_channel is None:
+            import getpass
+            user = getpass.getuser()
+            if user.startswith('konrad'): user = 'konradjk'
+            self._default_channel = '#gnomad' if self.get_user_id(user) is None else '@' + user
+        return self._default_channel
+
+
+_slack_client = None
+
+
+def get_slack_client():
+    """
+    Returns the module-level SlackClient, created on first use from `slack_creds.slack_token`
+
+    :return: Slack client, or None if no token is available
+    :rtype: SlackClient
+    """
+    global _slack_client
+    if _slack_client is None:
+        try:
+            from slack_creds import slack_token
+        except Exception:
+            return None
+        _slack_client = SlackClient(slack_token)
+    return _slack_client
+
+
+def set_slack_client(client):
+    """
+    Sets the module-level SlackClient (e.g. with a different `base_url` or `ttl`)
+
+    :param SlackClient client: Slack client, or None to reset it
+    """
+    global _slack_client
+    _slack_client = client
+
+
+class SlackDispatcher(object):
+    """
+    Sends Slack API calls from a background thread, so that notifications never block (or delay the teardown of) the
+    calling job:
+    - calls are queued in a bounded queue: when it is full, new calls are dropped rather than blocking the caller
+    - consecutive messages to the same channel are batched into a single `chat.postMessage` call
+    - failed calls are retried with exponential backoff, and rate-limited calls (HTTP 429 or `ratelimited` errors)
+      after the `Retry-After` delay
+    - pending calls are flushed at interpreter exit, for at most `flush_timeout` seconds
+    """
+
+    def __init__(self, client=None, max_queue_size=100, batch_size=20, max_retries=5, backoff=1.0, max_backoff=60,
+                 flush_timeout=10):
+        """
+        :param SlackClient client: Slack client (default: the module-level client, see `get_slack_client`)
+        :param int max_queue_size: Maximum number of pending calls
+        :param int batch_size: Maximum number of queued messages merged into a single call
+        :param int max_retries: Maximum number of retries of a call
+        :param float backoff: Delay before the first retry in seconds (doubled after each retry)
+        :param float max_backoff: Maximum delay between retries in seconds
+        :param float flush_timeout: Maximum time spent sending pending calls at exit in seconds
+        """
+        self.client = client
+        self.queue = Queue.Queue(max_queue_size)
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.flush_timeout = flush_timeout
+        self.stats = {'sent': 0, 'batched': 0, 'dropped': 0, 'failed': 0, 'retries': 0, 'rate_limited': 0}
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='SlackDispatcher')
+                self.thread.daemon = True
+                self.thread.start()
+                atexit.register(self.flush)
+
+    def submit(self, method, **kwargs):
+        """
+        Queues a Slack API call. A `target` argument (`@user` or `#channel`) is resolved to the `channels` ID in the
+        background.
+
+        :param str method: API method (e.g. `chat.postMessage`)
+        :param kwargs: Arguments of the method
+        :return: Whether the call was queued (False if the queue is full)
+        :rtype: bool
+        """
+        self.start()
+        try:
+            self.queue.put_nowait((method, kwargs))
+            return True
+        except Queue.Full:
+            self.stats['dropped'] += 1
+            print >> sys.stderr, 'Slack notification queue full, dropping {}: {}'.format(method, kwargs.get('text', ''))
+            return False
+
+    def flush(self, timeout=None):
+        """
+        Waits for the pending calls to be sent
+
+        :param float timeout: Maximum wait in seconds (default: `flush_timeout`)
+        :return: Whether all calls were sent
+        :rtype: bool
+        """
+        deadline = time.time() + (self.flush_timeout if timeout is None else timeout)
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    print >> sys.stderr, 'Timed out sending {} Slack notifications'.format(self.queue.unfinished_tasks)
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def next_batch(self):
+        """
+        Waits for the next call and merges it with the queued messages to the same channel
+
+        :return: Calls to send, as (method, kwargs, number of queued calls)
+        :rtype: list of (str, dict, int)
+        """
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        calls = []
+        for method, kwargs in batch:
+            if calls and method == 'chat.postMessage' and calls[-1][0] == method:
+                last_kwargs = calls[-1][1]
+                if (all(kwargs.get(k) == last_kwargs.get(k) for k in ('channel', 'icon_emoji', 'parse')) and
+                        len(last_kwargs.get('text', '')) + len(kwargs.get('text', '')) < 4000):
+                    last_kwargs['text'] = '{}\n{}'.format(last_kwargs.get('text', ''), kwargs.get('text', ''))
+                    calls[-1] = (method, last_kwargs, calls[-1][2] + 1)
+                    self.stats['batched'] += 1
+                    continue
+            calls.append((method, dict(kwargs), 1))
+        return calls
+
+    def run(self):
+        while True:
+            for method, kwargs, n in self.next_batch():
+                try:
+                    self.send(method, kwargs)
+                except Exception as e:
+                    self.stats['failed'] += n
+                    print >> sys.stderr, 'Could not send Slack notification ({}): {}'.format(e, kwargs.get('text', kwargs.get('content', '')))
+                finally:
+                    for _ in range(n):
+                        self.queue.task_done()
+
+    def send(self, method, kwargs):
+        """
+        Sends a call, retrying with backoff on errors and after `Retry-After` when rate-limited
+
+        :param str method: API method
+        :param dict kwargs: Arguments of the method
+        :return: Parsed JSON response
+        :rtype: dict
+        """
+        client = self.client or get_slack_client()
+        if client is None:
+            raise ValueError('no Slack credentials')
+        if 'target' in kwargs:
+            kwargs['channels'] = client.get_target_id(kwargs.pop('target') or client.default_channel)
+        if 'channel' in kwargs and kwargs['channel'] is None:
+            kwargs['channel'] = client.default_channel
+
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = client.api_call(method, **kwargs)
+                if response.get('ok', True):
+                    self.stats['sent'] += 1
+                    return response
+                if response.get('error') != 'ratelimited':
+                    raise ValueError(response.get('error'))
+                retry_after = delay
+            except urllib2.HTTPError as e:
+                if e.code != 429:
+                    if attempt == self.max_retries or e.code < 500:
+                        raise
+                else:
+                    retry_after = float(e.headers.get('Retry-After', delay))
+            except (urllib2.URLError, IOError):
+                if attempt == self.max_retries:
+                    raise
+
+            if retry_after is not None:
+                self.stats['rate_limited'] += 1
+                if attempt == self.max_retries:
+                    raise ValueError('rate limited')
+            self.stats['retries'] += 1
+            time.sleep(min(retry_after if retry_after is not None else delay, self.max_backoff))
+            delay = min(delay * 2, self.max_backoff)
+
+
+_slack_dispatcher = None
+
+
+def get_slack_dispatcher():
+    """
+    :return: The module-level SlackDispatcher
+    :rtype: SlackDispatcher
+    """
+    global _slack_dispatcher
+    if _slack_dispatcher is None:
+        _slack_dispatcher = SlackDispatcher()
+    return _slack_dispatcher
+
+
+def set_slack_dispatcher(dispatcher):
+    """
+    Sets the module-level SlackDispatcher (e.g. with different queue size or retry settings)
+
+    :param SlackDispatcher dispatcher: Dispatcher, or None to reset it
+    """
+    global _slack_dispatcher
+    _slack_dispatcher = dispatcher
 
 
 def get_slack_info():
-    import getpass
-    from slackclient import SlackClient
-    # import os
-    try:
-        from slack_creds import slack_token
-    except Exception:
+    sc = get_slack_client()
+    if sc is None:
         return None
-
-    # slack_token = os.environ["SLACK_API_TOKEN"]
-    sc = SlackClient(slack_token)
-    user = getpass.getuser()
-    if user.startswith('konrad'): user = 'konradjk'
-    users = [x['name'] for x in sc.api_call("users.list")['members']]
-    default_channel = '#gnomad' if user not in users else '@' + user
-    return sc, default_channel
+    return sc, sc.default_channel
 
 
 def get_slack_channel_id(sc, channel):
-    channel_id = [x for x in sc.api_call('channels.list')['channels'] if x['name'] == channel]
-    return channel_id[0]['id'] if len(channel_id) and 'id' in channel_id[0] else None
+    return sc.get_channel_id(channel)
 
 
 def get_slack_user_id(sc, user):
-    channel_id = [x for x in sc.api_call('users.list')['members'] if x['name'] == user]
-    return channel_id[0]['id'] if len(channel_id) and 'id' in channel_id[0] else None
+    return sc.get_user_id(user)
 
 
-def send_message(channels=None, message="Your job is done!", icon_emoji=':woohoo:'):
-    sc, default_channel = get_slack_info()
+def send_message(channels=None, message="Your job is done!", icon_emoji=':woohoo:', background=False):
+    """
+    Posts a message to Slack
+
+    :param list of str channels: Channels (`#channel`) or users (`@user`) to post to (default: see `SlackClient.default_channel`)
+    :param str message: Message
+    :param str icon_emoji: Icon
+    :param bool background: Whether to send the message from the background dispatcher (see `SlackDispatcher`) without waiting
+    """
+    if not background and get_slack_client() is None:
+        print 'No Slack credentials. Was going to send:'
+        print message
+        return
 
     if not isinstance(channels, list):
-        channels = [channels]
+        channels = [channels if channels is not None else (None if background else get_slack_client().default_channel)]
     for channel in channels:
-        sc.api_call(
-            "chat.postMessage",
-            channel=channel,
-            text=message,
-            icon_emoji=icon_emoji,
-            parse='full'
-        )
-
-        
-def send_snippet(channels=None, content='', filename='data.txt'):
-    sc, default_channel = get_slack_info()
+        kwargs = dict(text=message, icon_emoji=icon_emoji, parse='full')
+        if background:
+            get_slack_dispatcher().submit("chat.postMessage", channel=channel, **kwargs)
+        else:
+            get_slack_client().api_call("chat.postMessage", channel=channel, **kwargs)
+
 
+def send_snippet(channels=None, content='', filename='data.txt', initial_comment=None, background=False):
+    """
+    Uploads a snippet to Slack
+
+    :param list of str channels: Channels (`#channel`) or users (`@user`) to upload to (default: see `SlackClient.default_channel`)
+    :param str content: Content of the snippet
+    :param str filename: File name of the snippet
+    :param str initial_comment: Message posted with the snippet
+    :param bool background: Whether to upload the snippet from the background dispatcher (see `SlackDispatcher`) without waiting
+    :return: Response of the (first) upload (empty when sent in the background)
+    :rtype: dict
+    """
     if isinstance(channels, str):
         channels = [channels]
     elif channels is None:
-        channels = [default_channel]
+        channels = [None]
 
-    for channel in channels:
-        if channel.startswith('@'):
-            channel_id = get_slack_user_id(sc, channel.lstrip('@'))
-        else:
-            channel_id = get_slack_channel_id(sc, channel.lstrip('#'))
+    if background:
+        for channel in channels:
+            get_slack_dispatcher().submit("files.upload", target=channel, content=content, filename=filename,
+                                          initial_comment=initial_comment)
+        return {}
+
+    sc = get_slack_client()
+    if sc is None:
+        print 'No Slack credentials. Was going to send:'
+        print content
+        return {}
 
+    for channel in channels:
         try:
             return sc.api_call("files.upload",
-                               channels=channel_id,
+                               channels=sc.get_target_id(channel or sc.default_channel),
                                content=content,
-                               filename=filename)
+                               filename=filename,
+                               initial_comment=initial_comment)
         except Exception:
             print 'Slack connection fail. Was going to send:'
             print content
+            return {}
 
 
 def try_slack(target, func, *args):
+    """
+    Runs `func(*args)` and notifies `target` on Slack of its success or failure (with the traceback), along with the
+    summary of the profiled steps (see `profile_utils.StepProfiler`): `func` itself is profiled as a step, and any
+    step profiled within it with `profile_step` or `profiled` is reported.
+    Notifications are sent in the background (see `SlackDispatcher`): they never delay the job, and the original
+    exception is re-raised with its traceback.
+
+    :param str target: Channel (`#channel`) or user (`@user`) to notify
+    :param function func: Function to run
+    :param args: Arguments of `func`
+    """
     import sys
     import os
     import traceback
     import time
+    from profile_utils import get_profiler
     process = os.path.basename(sys.argv[0])
+    profiler = get_profiler()
     try:
-        func(*args)
-        send_message(target, 'Success! {} finished!'.format(process))
+        with profiler.step(getattr(func, '__name__', process)):
+            func(*args)
+        summary = profiler.summary()
+        message = 'Success! {} finished!'.format(process)
+        if len(message) + len(summary) > 3900:  # Slack message length limit (from https://api.slack.com/methods/chat.postMessage)
+            filename = 'profile_{}_{}.txt'.format(process, time.strftime("%Y-%m-%d_%H:%M"))
+            send_snippet(target, summary, filename=filename, initial_comment=message, background=True)
+        else:
+            send_message(target, '{}\n```{}```'.format(message, summary), background=True)
     except Exception as e:
+        exc_info = sys.exc_info()
         try:
             emoji = ':white_frowning_face:'
-            if len(e.message) > 4000:  # Slack message length limit (from https://api.slack.com/methods/chat.postMessage)
+            error = '{}\n{}'.format(traceback.format_exc(), profiler.summary())
+            message = str(e)
+            if len(error) > 3900:  # Slack message length limit (from https://api.slack.com/methods/chat.postMessage)
                 filename = 'error_{}_{}.txt'.format(process, time.strftime("%Y-%m-%d_%H:%M"))
-                snippet = send_snippet(target, traceback.format_exc(), filename=filename)
-                if 'file' in snippet:
-                    if 'SparkContext was shut down' in e.message or 'connect to the Java server' in e.message:
-                        send_message(target, 'Job ({}) cancelled - see {} for error log'.format(process, snippet['file']['url_private']), ':beaker:')
-                    else:
-                        send_message(target, 'Job ({}) failed :white_frowning_face: - see {} for error log'.format(process, snippet['file']['url_private']), emoji)
+                if 'SparkContext was shut down' in message or 'connect to the Java server' in message:
+                    comment = ':beaker: Job ({}) cancelled - see attached error log'.format(process)
                 else:
-                    send_message(target, 'Snippet failed to upload: {}'.format(snippet), emoji)
+                    comment = '{} Job ({}) failed - see attached error log'.format(emoji, process)
+                send_snippet(target, error, filename=filename, initial_comment=comment, background=True)
             else:
-                send_message(target, 'Job ({}) failed :white_frowning_face:\n```{}```'.format(process, traceback.format_exc()), emoji)
-            raise e
-        except ImportError as f:
-            print "ERROR: missing slackclient. But here's the original error:"
-            raise e
\ No newline at end of file
+                send_message(target, 'Job ({}) failed :white_frowning_face:\n```{}```'.format(process, error), emoji, background=True)
+        except Exception as f:
+            print >> sys.stderr, 'Could not queue Slack notification ({})'.format(f)
+        raise exc_info[0], exc_info[1], exc_info[2]
@@ -0,0 +1,307 @@
+"""
+Benchmarks for the Hail helper functions, run on synthetic data using:
+
+PYTHONPATH=.:$PYTHONPATH python tests/benchmarks.py [benchmark ...]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from utils import *
+from tests.synthetic import *
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__.replace('benchmark_', '')] = f
+    return f
+
+
+def time_it(f, n_iter=3):
+    """
+    Runs `f` `n_iter` times and returns the best wall time
+
+    :param function f: Function to time
+    :param int n_iter: Number of runs
+    :return: Best wall time in seconds
+    :rtype: float
+    """
+    best = None
+    for _ in range(n_iter):
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, timings):
+    logger.info("%s:\n%s", name, "\n".join(["  %-30s %8.3fs" % (k, v) for k, v in timings.iteritems()]))
+
+
+@benchmark
+def benchmark_allele_stats(hc, args):
+    vds = create_synthetic_vds(hc, args.n_variants, args.n_samples).cache()
+    vds.count()
+
+    timings = OrderedDict()
+    for medians, approx_medians in [(False, False), (True, False), (True, True)]:
+        for fused in [False, True]:
+            expr = get_allele_stats_expr('va.stats', medians=medians, fused=fused, approx_medians=approx_medians)
+            timings['medians=%s, approx=%s, fused=%s' % (medians, approx_medians, fused)] = time_it(
+                lambda: vds.annotate_variants_expr(expr).variants_table().count(), args.n_iter)
+
+    report('get_allele_stats_expr', timings)
+
+
+def process_consequences_legacy(vds, vep_root='va.vep', genes_to_string=True):
+    """
+    Chained `process_consequences` implementation (three annotation passes), used as a baseline
+    """
+    if vep_root + '.worst_csq' in flatten_struct(vds.variant_schema, root='va'):
+        vds = (vds.annotate_variants_expr('%(vep)s.transcript_consequences = '
+                                          ' %(vep)s.transcript_consequences.map('
+                                          '     csq => drop(csq, most_severe_consequence)'
+                                          ')' % {'vep': vep_root}))
+    vds = (vds.annotate_global('global.csqs', CSQ_ORDER, TArray(TString()))
+           .annotate_variants_expr(
+        '%(vep)s.transcript_consequences = '
+        '   %(vep)s.transcript_consequences.map(csq => '
+        '   let worst_csq = global.csqs.find(c => csq.consequence_terms.toSet().contains(c)) in'
+        # '   let worst_csq_suffix = if (csq.filter(x => x.lof == "HC").length > 0)'
+        # '       worst_csq + "-HC" '
+        # '   else '
+        # '       if (csq.filter(x => x.lof == "LC").length > 0)'
+        # '           worst_csq + "-LC" '
+        # '       else '
+        # '           if (csq.filter(x => x.polyphen_prediction == "probably_damaging").length > 0)'
+        # '               worst_csq + "-probably_damaging"'
+        # '           else'
+        # '               if (csq.filter(x => x.polyphen_prediction == "possibly_damaging").length > 0)'
+        # '                   worst_csq + "-possibly_damaging"'
+        # '               else'
+        # '                   worst_csq in'
+        '   merge(csq, {most_severe_consequence: worst_csq'
+        # ', most_severe_consequence_suffix: worst_csq_suffix'
+        '})'
+        ')' % {'vep': vep_root}
+    ).annotate_variants_expr(
+        '%(vep)s.worst_csq = global.csqs.find(c => %(vep)s.transcript_consequences.map(x => x.most_severe_consequence).toSet().contains(c)),'
+        '%(vep)s.worst_csq_suffix = '
+        'let csq = global.csqs.find(c => %(vep)s.transcript_consequences.map(x => x.most_severe_consequence).toSet().contains(c)) in '
+        'if (%(vep)s.transcript_consequences.filter(x => x.lof == "HC" && x.lof_flags == "").length > 0)'
+        '   csq + "-HC" '
+        'else '
+        '   if (%(vep)s.transcript_consequences.filter(x => x.lof == "HC").length > 0)'
+        '       csq + "-HC-flag" '
+        '   else '
+        '       if (%(vep)s.transcript_consequences.filter(x => x.lof == "LC").length > 0)'
+        '           csq + "-LC" '
+        '       else '
+        '           if (%(vep)s.transcript_consequences.filter(x => x.polyphen_prediction == "probably_damaging").length > 0)'
+        '               csq + "-probably_damaging"'
+        '           else'
+        '               if (%(vep)s.transcript_consequences.filter(x => x.polyphen_prediction == "possibly_damaging").length > 0)'
+        '                   csq + "-possibly_damaging"'
+        '               else'
+        '                   if (%(vep)s.transcript_consequences.filter(x => x.polyphen_prediction == "benign").length > 0)'
+        '                       csq + "-benign"'
+        '                   else'
+        '                       csq' % {'vep': vep_root}
+    ).annotate_variants_expr(
+        '{vep}.lof = "-HC" ~ {vep}.worst_csq_suffix, '
+        '{vep}.worst_csq_genes = {vep}.transcript_consequences'
+        '.filter(x => x.most_severe_consequence == {vep}.worst_csq).map(x => x.gene_symbol).toSet(){genes_to_string}'.format(
+            vep=vep_root, genes_to_string='.mkString("|")' if genes_to_string else '')
+    ))
+    return vds
+
+
+@benchmark
+def benchmark_process_consequences(hc, args):
+    vds = create_synthetic_vep_vds(hc, CSQ_ORDER, args.n_variants * 10).cache()
+    vds.count()
+
+    expected = process_consequences_legacy(vds).query_variants('variants.map(v => {v: v, vep: va.vep}).collect()')
+    assert expected == process_consequences(vds).query_variants('variants.map(v => {v: v, vep: va.vep}).collect()')
+
+    timings = OrderedDict()
+    timings['legacy'] = time_it(lambda: process_consequences_legacy(vds).variants_table().count(), args.n_iter)
+    timings['single pass'] = time_it(lambda: process_consequences(vds).variants_table().count(), args.n_iter)
+    report('process_consequences', timings)
+
+
+def split_vds_and_annotations_legacy(vds, AS_filters=None):
+    """
+    Chained `split_vds_and_annotations` implementation (three annotation passes after the split), used as a baseline
+    """
+    numbered_annotations = get_numbered_annotations(vds.variant_schema, "va.info")
+    vds = vds.split_multi()
+    vds = vds.annotate_variants_expr(index_into_arrays(a_based_annotations=[a.path for a in numbered_annotations['A']]))
+    vds = recompute_filters_by_allele(vds, AS_filters, True)
+    return vds.annotate_variants_expr('va.info = drop(va.info, {0})'.format(",".join([a.field.name for a in numbered_annotations['G']])))
+
+
+@benchmark
+def benchmark_split_vds_and_annotations(hc, args):
+    vds = annotate_synthetic_info(create_synthetic_vds(hc, args.n_variants, args.n_samples, multi_allelic_fraction=0.5)).cache()
+    vds.count()
+
+    query = 'variants.map(v => {v: v, va: va}).collect()'
+    assert split_vds_and_annotations_legacy(vds).query_variants(query) == split_vds_and_annotations(vds).query_variants(query)
+
+    timings = OrderedDict()
+    timings['chained'] = time_it(lambda: split_vds_and_annotations_legacy(vds).variants_table().count(), args.n_iter)
+    timings['single pass'] = time_it(lambda: split_vds_and_annotations(vds).variants_table().count(), args.n_iter)
+    report('split_vds_and_annotations', timings)
+
+
+def annotation_pipeline(vds, plan):
+    """
+    Typical post-split annotation steps, applied through `plan` (a VariantAnnotationPlan or a VDS)
+    """
+    return (plan
+            .annotate('va.info.AC = va.info.AC[va.aIndex - 1]')
+            .annotate('va.info.AF = va.info.AC / va.info.AN')
+            .filter('va.info.AN > 0')
+            .annotate('va.info = drop(va.info, GC)')
+            .annotate('va.pass = va.filters.isEmpty')
+            .filter('va.info.AC > 0'))
+
+
+@benchmark
+def benchmark_annotation_plan(hc, args):
+    vds = annotate_synthetic_info(create_synthetic_vds(hc, args.n_variants, args.n_samples, multi_allelic_fraction=0.5)).split_multi().cache()
+    vds.count()
+
+    class ChainedCalls(object):
+        def __init__(self, vds):
+            self.vds = vds
+            self.n_stages = 0
+
+        def annotate(self, expr):
+            self.n_stages += 1
+            self.vds = self.vds.annotate_variants_expr(expr)
+            return self
+
+        def filter(self, expr):
+            self.n_stages += 1
+            self.vds = self.vds.filter_variants_expr(expr)
+            return self
+
+    chained = annotation_pipeline(vds, ChainedCalls(vds))
+    plan = annotation_pipeline(vds, VariantAnnotationPlan(vds))
+    logger.info("Hail calls: %d chained, %d with VariantAnnotationPlan", chained.n_stages, plan.n_stages)
+
+    timings = OrderedDict()
+    timings['chained (%d calls)' % chained.n_stages] = time_it(lambda: annotation_pipeline(vds, ChainedCalls(vds)).vds.variants_table().count(), args.n_iter)
+    timings['plan (%d calls)' % plan.n_stages] = time_it(lambda: annotation_pipeline(vds, VariantAnnotationPlan(vds)).execute().variants_table().count(), args.n_iter)
+    report('VariantAnnotationPlan', timings)
+
+
+def group_annotations_by_attribute_legacy(schema, grouping_key, root='va', recursive=False, default_func=None):
+    """
+    `group_annotations_by_attribute` re-flattening the schema for every struct, used as a baseline
+    """
+    annotations = defaultdict(list)
+    fields = flatten_struct(schema, 'va', leaf_only=False)[root].typ if '.' in root else schema
+    for field in fields.fields:
+        path = '{}.{}'.format(root, field.name)
+        if isinstance(field.typ, TArray):
+            if grouping_key in field.attributes:
+                annotations[field.attributes[grouping_key]].append(PathAndField(path, field))
+        elif recursive and isinstance(field.typ, TStruct):
+            for k, v in group_annotations_by_attribute_legacy(schema, grouping_key, path, recursive, default_func).iteritems():
+                annotations[k].extend(v)
+        elif default_func is not None:
+            annotations[default_func(field)].append(PathAndField(path, field))
+        else:
+            annotations[None].append(PathAndField(path, field))
+    return annotations
+
+
+@benchmark
+def benchmark_schema_index(hc, args):
+    schema = create_synthetic_schema()
+    paths = flatten_struct(schema, root='va', leaf_only=False).keys()
+    logger.info("Schema with %d fields", len(paths))
+
+    def lookups(get_type):
+        for path in paths:
+            get_type(path)
+
+    timings = OrderedDict()
+    timings['flatten_struct lookups'] = time_it(lambda: lookups(lambda x: flatten_struct(schema, 'va', leaf_only=False)[x].typ), args.n_iter)
+    timings['schema index lookups'] = time_it(lambda: lookups(lambda x: get_ann_type(x, schema)), args.n_iter)
+    timings['legacy grouping'] = time_it(lambda: group_annotations_by_attribute_legacy(schema, 'Number', recursive=True, default_func=default_number), args.n_iter)
+    timings['schema index grouping'] = time_it(lambda: get_numbered_annotations(schema, recursive=True), args.n_iter)
+    report('schema index', timings)
+
+
+def merge_schemas_legacy(vdses):
+    """
+    `merge_schemas` attribute loop setting every annotation's attributes one at a time, used as a baseline
+    """
+    anns = [flatten_struct(vds.variant_schema, root='va') for vds in vdses]
+    all_anns = {}
+    for i in reversed(range(len(vdses))):
+        all_anns.update(anns[i])
+    merged_vdses = []
+    for vds in vdses:
+        for ann, f in all_anns.iteritems():
+            vds = vds.set_va_attributes(ann, f.attributes)
+        merged_vdses.append(vds)
+    return merged_vdses
+
+
+@benchmark
+def benchmark_merge_schemas(hc, args):
+    vdses = [create_synthetic_wide_vds(hc, 500, attributes=True), create_synthetic_wide_vds(hc, 500, attributes=False)]
+
+    timings = OrderedDict()
+    timings['per-field set_va_attributes'] = time_it(lambda: [vds.variant_schema for vds in merge_schemas_legacy(vdses)], args.n_iter)
+    timings['update_va_attributes'] = time_it(lambda: [vds.variant_schema for vds in merge_schemas(vdses)], args.n_iter)
+    report('merge_schemas (500 fields)', timings)
+
+
+@benchmark
+def benchmark_packed_hardcalls(hc, args):
+    vds = create_synthetic_vds(hc, args.n_variants, args.n_samples, multi_allelic_fraction=0.1)
+    tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+    paths = OrderedDict([('full genotypes', os.path.join(tmp_dir, 'full.vds')),
+                         ('packed hardcalls', os.path.join(tmp_dir, 'packed.vds'))])
+    vds.write(paths['full genotypes'])
+    pack_hardcalls(vds).write(paths['packed hardcalls'])
+
+    timings = OrderedDict()
+    for name, path in paths.iteritems():
+        logger.info("%s: %.1f MB on disk", name, path_size(path) / 1e6)
+        timings['%s: adj frequencies' % name] = time_it(
+            lambda: annotate_frequencies(hc.read(path), ['all'], pop_expr='"all"',
+                                         sex_expr='if (s.length % 2 == 0) "male" else "female"').variants_table().count(), args.n_iter)
+        timings['%s: adj sample QC' % name] = time_it(
+            lambda: filter_to_adj(hc.read(path)).annotate_samples_expr(
+                get_sample_qc_metrics_expr(call_expr=get_call_expr(hc.read(path)))).samples_table().count(), args.n_iter)
+    report('packed hardcalls', timings)
+    shutil.rmtree(tmp_dir)
+
+
+def main(args):
+    hc = HailContext(log='/dev/null', master='local[%d]' % args.cores)
+    for name in args.benchmarks if args.benchmarks else BENCHMARKS.keys():
+        BENCHMARKS[name](hc, args)
+    hc.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run, among: {} (default: all)'.format(', '.join(BENCHMARKS.keys())))
+    parser.add_argument('--n_variants', help='Number of variants in synthetic data', type=int, default=2000)
+    parser.add_argument('--n_samples', help='Number of samples in synthetic data', type=int, default=1000)
+    parser.add_argument('--n_iter', help='Number of runs per benchmark (best time is reported)', type=int, default=3)
+    parser.add_argument('--cores', help='Number of local cores', type=int, default=4)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,276 @@
+import os
+import random
+import sys
+import tempfile
+
+from hail import *
+
+VCF_HEADER = '''##fileformat=VCFv4.2
+##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">
+##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Approximate read depth">
+##FORMAT=<ID=GQ,Number=1,Type=Integer,Description="Genotype Quality">
+##FORMAT=<ID=PL,Number=G,Type=Integer,Description="Normalized, Phred-scaled likelihoods for genotypes as defined in the VCF specification">
+##contig=<ID=1,length=249250621>
+##contig=<ID=2,length=243199373>
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{samples}
+'''
+
+BASES = ['A', 'C', 'G', 'T']
+
+
+def generate_genotype(rng, n_alleles, afs, missing_rate=0.02):
+    """
+    Generates a random VCF genotype entry (GT:AD:DP:GQ:PL) with PLs consistent with GT and GQ
+
+    :param Random rng: Random number generator
+    :param int n_alleles: Number of alleles (including reference)
+    :param list of float afs: Frequencies of the alternate alleles
+    :param float missing_rate: Probability that the genotype is missing
+    :return: VCF genotype entry
+    :rtype: str
+    """
+    if rng.random() < missing_rate:
+        return './.'
+
+    def draw_allele():
+        x = rng.random()
+        for i, af in enumerate(afs):
+            if x < af:
+                return i + 1
+            x -= af
+        return 0
+
+    j, k = sorted([draw_allele(), draw_allele()])
+    dp = rng.randint(5, 60)
+    ad = [0] * n_alleles
+    if j == k:
+        ad[j] = dp
+    else:
+        ad[j] = sum(1 for _ in range(dp) if rng.random() < 0.5)
+        ad[k] = dp - ad[j]
+
+    gq = rng.randint(0, 99)
+    n_genotypes = n_alleles * (n_alleles + 1) // 2
+    called_index = k * (k + 1) // 2 + j
+    pl = [gq + rng.randint(1, 200) for _ in range(n_genotypes)]
+    pl[called_index] = 0
+    pl[(called_index + 1) % n_genotypes] = gq
+
+    return '{0}/{1}:{2}:{3}:{4}:{5}'.format(j, k, ','.join(map(str, ad)), dp, gq, ','.join(map(str, pl)))
+
+
+def write_synthetic_vcf(path, n_variants=100, n_samples=50, multi_allelic_fraction=0.0, seed=42):
+    """
+    Writes a VCF with random genotypes (GT:AD:DP:GQ:PL) for `n_samples` samples at `n_variants` sites on chromosome 1.
+
+    :param str path: Output VCF path (local)
+    :param int n_variants: Number of variants
+    :param int n_samples: Number of samples
+    :param float multi_allelic_fraction: Fraction of the sites that are tri-allelic
+    :param int seed: Random seed
+    """
+    rng = random.Random(seed)
+    samples = ['sample_%d' % i for i in range(n_samples)]
+    with open(path, 'w') as f:
+        f.write(VCF_HEADER.format(samples='\t'.join(samples)))
+        for i in range(n_variants):
+            ref = rng.choice(BASES)
+            alts = [b for b in BASES if b != ref]
+            n_alts = 2 if rng.random() < multi_allelic_fraction else 1
+            alts = rng.sample(alts, n_alts)
+            afs = [rng.uniform(0.01, 0.4) for _ in alts]
+            genotypes = [generate_genotype(rng, n_alts + 1, afs) for _ in samples]
+            f.write('\t'.join(['1', str(10000 + 10 * i), '.', ref, ','.join(alts), '.', 'PASS', '.', 'GT:AD:DP:GQ:PL'] +
+                              genotypes) + '\n')
+
+
+def create_synthetic_vds(hc, n_variants=100, n_samples=50, multi_allelic_fraction=0.0, seed=42):
+    """
+    Imports a VCF written by `write_synthetic_vcf` in a temporary directory.
+
+    :param HailContext hc: HailContext
+    :param int n_variants: Number of variants
+    :param int n_samples: Number of samples
+    :param float multi_allelic_fraction: Fraction of the sites that are tri-allelic
+    :param int seed: Random seed
+    :return: VDS with random genotypes
+    :rtype: VariantDataset
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix='gnomad_hail_'), 'synthetic.vcf')
+    write_synthetic_vcf(path, n_variants, n_samples, multi_allelic_fraction, seed)
+    return hc.import_vcf(path)
+
+
+VEP_CSQ_FIELDS = ['allele_num', 'consequence_terms', 'gene_symbol', 'transcript_id', 'canonical', 'lof', 'lof_flags', 'polyphen_prediction']
+VEP_CSQ_TYPE = TStruct(VEP_CSQ_FIELDS, [TInt(), TArray(TString()), TString(), TString(), TInt(), TString(), TString(), TString()])
+VEP_OTHER_CSQ_TYPE = TStruct(['allele_num', 'consequence_terms'], [TInt(), TArray(TString())])
+VEP_TYPE = TStruct(['allele_string', 'transcript_consequences', 'intergenic_consequences', 'motif_feature_consequences', 'regulatory_feature_consequences'],
+                   [TString(), TArray(VEP_CSQ_TYPE), TArray(VEP_OTHER_CSQ_TYPE), TArray(VEP_OTHER_CSQ_TYPE), TArray(VEP_OTHER_CSQ_TYPE)])
+
+
+def generate_vep_annotation(rng, n_alt_alleles, csq_terms, max_transcripts=8):
+    """
+    Generates a random (simplified) VEP annotation for a variant
+
+    :param Random rng: Random number generator
+    :param int n_alt_alleles: Number of alternate alleles
+    :param list of str csq_terms: Consequence terms to sample from
+    :param int max_transcripts: Maximum number of transcripts per allele
+    :return: VEP annotation matching VEP_TYPE
+    :rtype: dict
+    """
+    transcripts = []
+    for allele_num in range(1, n_alt_alleles + 1):
+        for _ in range(rng.randint(0, max_transcripts)):
+            lof = rng.choice([None, None, 'HC', 'LC'])
+            transcripts.append({
+                'allele_num': allele_num,
+                'consequence_terms': rng.sample(csq_terms + ['unknown_variant'], rng.randint(1, 3)),
+                'gene_symbol': 'GENE%d' % rng.randint(1, 5),
+                'transcript_id': 'ENST%011d' % rng.randint(1, 10 ** 6),
+                'canonical': rng.choice([None, 1]),
+                'lof': lof,
+                'lof_flags': rng.choice([None, '', 'SINGLE_EXON']) if lof else None,
+                'polyphen_prediction': rng.choice([None, 'benign', 'possibly_damaging', 'probably_damaging'])
+            })
+    other = [{'allele_num': allele_num, 'consequence_terms': ['intergenic_variant']}
+             for allele_num in range(1, n_alt_alleles + 1) if rng.random() < 0.2]
+    return {'allele_string': None,
+            'transcript_consequences': transcripts,
+            'intergenic_consequences': other,
+            'motif_feature_consequences': [],
+            'regulatory_feature_consequences': []}
+
+
+def create_synthetic_vep_vds(hc, csq_terms, n_variants=100, multi_allelic_fraction=0.0, seed=42):
+    """
+    Creates a sites-only VDS with random (simplified) VEP annotations in `va.vep`.
+
+    :param HailContext hc: HailContext
+    :param list of str csq_terms: Consequence terms to sample from
+    :param int n_variants: Number of variants
+    :param float multi_allelic_fraction: Fraction of the sites that are tri-allelic
+    :param int seed: Random seed
+    :return: Sites-only VDS with `va.vep`
+    :rtype: VariantDataset
+    """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n_variants):
+        ref = rng.choice(BASES)
+        alts = rng.sample([b for b in BASES if b != ref], 2 if rng.random() < multi_allelic_fraction else 1)
+        rows.append({'v': Variant.parse('1:{}:{}:{}'.format(10000 + 10 * i, ref, ','.join(alts))),
+                     'vep': generate_vep_annotation(rng, len(alts), csq_terms)})
+    return VariantDataset.from_table(KeyTable.from_py(hc, rows, TStruct(['v', 'vep'], [TVariant(), VEP_TYPE]), key_names=['v']))
+
+
+def create_synthetic_wide_vds(hc, n_fields=500, n_variants=10, attributes=True):
+    """
+    Creates a sites-only VDS with `n_fields` Int annotations in `va.info` (`va.info.f0`, `va.info.f1`, ...).
+
+    :param HailContext hc: HailContext
+    :param int n_fields: Number of fields in `va.info`
+    :param int n_variants: Number of variants
+    :param bool attributes: Whether to set a `Description` attribute on each field
+    :return: Sites-only VDS with a wide `va.info`
+    :rtype: VariantDataset
+    """
+    names = ['f%d' % i for i in range(n_fields)]
+    info_type = TStruct(names, [TInt()] * n_fields)
+    rows = [{'v': Variant.parse('1:{}:A:T'.format(10000 + i)), 'info': {name: i for name in names}} for i in range(n_variants)]
+    vds = VariantDataset.from_table(KeyTable.from_py(hc, rows, TStruct(['v', 'info'], [TVariant(), info_type]), key_names=['v']))
+    if attributes:
+        for name in names:
+            vds = vds.set_va_attributes('va.info.' + name, {'Description': 'Field %s' % name})
+    return vds
+
+
+def create_synthetic_schema(n_fields=20, depth=3, n_structs=3):
+    """
+    Creates a nested schema (e.g. VEP-sized for the defaults: ~1,000 fields), where each struct has `n_fields` leaves
+    (Int and Array[Int] with a `Number` attribute) and `n_structs` sub-structs, down to `depth` levels.
+
+    :param int n_fields: Number of leaf fields per struct
+    :param int depth: Depth of the schema
+    :param int n_structs: Number of sub-structs per struct
+    :return: Schema
+    :rtype: TStruct
+    """
+    names = ['f%d' % i for i in range(n_fields)]
+    types = [TInt() if i % 2 else TArray(TInt()) for i in range(n_fields)]
+    if depth > 0:
+        names.extend('s%d' % i for i in range(n_structs))
+        types.extend(create_synthetic_schema(n_fields, depth - 1, n_structs) for _ in range(n_structs))
+    return TStruct(names, types)
+
+
+def annotate_synthetic_info(vds):
+    """
+    Adds `va.info` annotations with `Number` attributes to a VDS from `create_synthetic_vds`:
+    A-based `AC` and `AS_FilterStatus` (RF for T alleles), G-based `GC`, `AN` and an un-numbered `AS_RF` array,
+    as well as `va.filters` (RF if any allele is filtered)
+
+    :param VariantDataset vds: Input VDS
+    :return: VDS with `va.info` and `va.filters`
+    :rtype: VariantDataset
+    """
+    vds = vds.annotate_variants_expr([
+        'va.info = {AC: gs.callStats(g => v).AC[1:], '
+        'AN: gs.callStats(g => v).AN, '
+        'GC: gs.map(g => range(v.nGenotypes).map(i => if (g.gt == i) 1 else 0)).sum(), '
+        'AS_FilterStatus: v.altAlleles.map(a => if (a.alt == "T") ["RF"].toSet else ["RF"].toSet.filter(x => false)), '
+        'AS_RF: v.altAlleles.map(a => a.alt.length.toDouble)}',
+        'va.filters = if (v.altAlleles.exists(a => a.alt == "T")) ["RF"].toSet else va.filters'
+    ])
+    for ann, number in [('AC', 'A'), ('AS_FilterStatus', 'A'), ('GC', 'G')]:
+        vds = vds.set_va_attributes('va.info.' + ann, {'Number': number})
+    return vds
+
+
+VEP_STUB_SCRIPT = '''import json
+import sys
+
+for line in sys.stdin:
+    if line.startswith('#'):
+        continue
+    fields = line.rstrip('\\n').split('\\t')
+    alts = fields[4].split(',')
+    print(json.dumps({
+        'input': line.rstrip('\\n'),
+        'allele_string': '/'.join([fields[3]] + alts),
+        'most_severe_consequence': 'missense_variant',
+        'transcript_consequences': [{'allele_num': i + 1,
+                                     'consequence_terms': ['missense_variant'],
+                                     'gene_symbol': 'GENE%d' % (int(fields[1]) % 5),
+                                     'transcript_id': 'ENST%011d' % int(fields[1]),
+                                     'canonical': 1} for i in range(len(alts))]
+    }))
+    sys.stdout.flush()
+'''
+
+
+def write_vep_stub_config(directory=None):
+    """
+    Writes a stub VEP script (annotating every alternate allele as a canonical missense variant) and a VEP config
+    running it in place of VEP/LOFTEE, for use with `vds.vep`.
+
+    :param str directory: Output directory (default: a new temporary directory)
+    :return: Path to the VEP config
+    :rtype: str
+    """
+    directory = directory or tempfile.mkdtemp(prefix='gnomad_hail_')
+    script_path = os.path.join(directory, 'vep_stub.py')
+    with open(script_path, 'w') as f:
+        f.write(VEP_STUB_SCRIPT)
+    config_path = os.path.join(directory, 'vep_stub.properties')
+    with open(config_path, 'w') as f:
+        f.write('\n'.join(['hail.vep.perl = %s' % sys.executable,
+                           'hail.vep.perl5lib = %s' % directory,
+                           'hail.vep.path = %s' % os.environ.get('PATH', '/usr/bin:/bin'),
+                           'hail.vep.location = %s' % script_path,
+                           'hail.vep.cache_dir = %s' % directory,
+                           'hail.vep.fasta = %s' % os.path.join(directory, 'stub.fa'),
+                           'hail.vep.lof.human_ancestor = %s' % directory,
+                           'hail.vep.lof.conservation_file = %s' % directory]) + '\n')
+    return config_path
@@ -0,0 +1,237 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import cache_utils
+from cache_utils import *
+from tests.test_pyhail import write_fake_executable
+
+
+class CacheDirTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        self.default_cache_dir = cache_utils.CACHE_DIR
+        cache_utils.CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        cache_utils.CACHE_DIR = self.default_cache_dir
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_cache_dir(self):
+        path = get_cache_dir('intervals')
+        self.assertEqual(path, os.path.join(self.cache_dir, 'intervals'))
+        self.assertTrue(os.path.isdir(path))
+        self.assertEqual(get_cache_dir('intervals'), path)
+
+    def test_move_path(self):
+        src, dest = os.path.join(self.cache_dir, 'src.kt'), os.path.join(self.cache_dir, 'dest.kt')
+        for content in ['a', 'b']:
+            FakeDataset(content).write(src)
+            move_path(src, dest)
+            self.assertFalse(os.path.exists(src))
+            self.assertEqual(FakeHailContext().read(dest).content, content)
+
+    def test_hash_content(self):
+        self.assertEqual(hash_content(['a\n', 'b\n']), hash_content(['a\nb\n']))
+        self.assertNotEqual(hash_content(['a\n', 'b\n']), hash_content(['b\n', 'a\n']))
+        self.assertEqual(hash_content([u'a\n']), hash_content(['a\n']))
+
+
+class ResourceMirrorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        self.bucket_dir = os.path.join(self.tmp_dir, 'bucket')
+        os.makedirs(os.path.join(self.bucket_dir, 'intervals'))
+        for name, size in [('intervals/LCR.interval_list', 100), ('gnomad.genomes.fam', 200), ('meta.tsv.bgz', 300)]:
+            self.write_bucket_file(name, 'x' * size)
+        self.fetched = []
+        self.mirror = ResourceMirror(os.path.join(self.tmp_dir, 'mirror'), max_size=1000, fetch=self.fetch)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        set_resource_mirror(None)
+
+    def write_bucket_file(self, name, content):
+        with open(os.path.join(self.bucket_dir, name), 'w') as f:
+            f.write(content)
+
+    def fetch(self, url, dest):
+        self.fetched.append(url)
+        shutil.copy(os.path.join(self.bucket_dir, url[len('gs://bucket/'):]), dest)
+
+    def test_resolve(self):
+        url = 'gs://bucket/intervals/LCR.interval_list'
+        path = self.mirror.resolve(url)
+        self.assertTrue(path.startswith(self.mirror.mirror_dir))
+        self.assertEqual(os.path.basename(path), 'LCR.interval_list')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'x' * 100)
+
+        for _ in range(10):
+            self.assertEqual(self.mirror.resolve(url), path)
+        self.assertEqual(self.fetched, [url])
+
+        # A new mirror object reuses the files on disk
+        mirror = ResourceMirror(self.mirror.mirror_dir, fetch=self.fetch)
+        self.assertEqual(mirror.resolve(url), path)
+        self.assertEqual(self.fetched, [url])
+
+    def test_local_paths(self):
+        for path in ['/local/file.tsv', 'file:///local/file.tsv', 'relative/file.tsv']:
+            self.assertEqual(self.mirror.resolve(path), path)
+        self.assertEqual(self.fetched, [])
+
+    def test_corrupted_file(self):
+        url = 'gs://bucket/gnomad.genomes.fam'
+        path = self.mirror.resolve(url)
+        with open(path, 'w') as f:
+            f.write('y' * 200)
+        self.assertEqual(self.mirror.resolve(url), path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'x' * 200)
+        self.assertEqual(self.fetched, [url, url])
+
+    def test_lru_eviction(self):
+        self.write_bucket_file('big1', 'a' * 400)
+        self.write_bucket_file('big2', 'b' * 400)
+        big1_path = self.mirror.resolve('gs://bucket/big1')
+        lcr_path = self.mirror.resolve('gs://bucket/intervals/LCR.interval_list')
+        self.mirror.resolve('gs://bucket/big1')  # big1 is now more recently used than LCR
+        self.mirror.resolve('gs://bucket/big2')
+        self.mirror.resolve('gs://bucket/meta.tsv.bgz')  # 1200 bytes: LCR is evicted first, then big1
+
+        manifest = self.mirror.load_manifest()
+        self.assertEqual(sorted(manifest.keys()), ['gs://bucket/big2', 'gs://bucket/meta.tsv.bgz'])
+        self.assertFalse(os.path.exists(lcr_path))
+        self.assertFalse(os.path.exists(big1_path))
+        self.assertEqual(self.mirror.stats['evictions'], 2)
+
+    def test_fallback(self):
+        self.assertEqual(self.mirror.resolve('gs://bucket/missing.tsv'), 'gs://bucket/missing.tsv')
+        self.write_bucket_file('huge', 'h' * 2000)
+        self.assertEqual(self.mirror.resolve('gs://bucket/huge'), 'gs://bucket/huge')
+        self.assertEqual(self.mirror.stats['fallbacks'], 2)
+        self.assertEqual(self.mirror.load_manifest(), {})
+
+    def test_resolve_resource(self):
+        url = 'gs://bucket/gnomad.genomes.fam'
+        self.assertEqual(resolve_resource(url), url)
+
+        set_resource_mirror(self.mirror)
+        path = resolve_resource(url)
+        self.assertTrue(path.startswith(self.mirror.mirror_dir))
+        self.assertEqual(resolve_resource(url, uri=True), 'file://' + os.path.abspath(path))
+        self.assertEqual(resolve_resource(url, executors=True), url)
+        self.mirror.shared = True
+        self.assertEqual(resolve_resource(url, executors=True), path)
+        self.assertEqual(self.fetched, [url])
+
+
+class FakeDataset(object):
+
+    def __init__(self, content):
+        self.content = content
+
+    def write(self, path, overwrite=False):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        with open(os.path.join(path, 'data'), 'w') as f:
+            f.write(self.content)
+
+
+class FakeHailContext(object):
+
+    def read(self, path):
+        with open(os.path.join(path, 'data')) as f:
+            return FakeDataset(f.read())
+
+
+class CheckpointCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        self.input_path = os.path.join(self.tmp_dir, 'input.vds')
+        FakeDataset('input').write(self.input_path)
+        self.cache = CheckpointCache(os.path.join(self.tmp_dir, 'checkpoints'), max_size=250)
+        self.hc = FakeHailContext()
+        self.builds = []
+
+        # Fake `gsutil ls -l`, listing the content of $FAKE_GSUTIL_LS (and failing when it is missing)
+        bin_dir = os.path.join(self.tmp_dir, 'bin')
+        os.makedirs(bin_dir)
+        write_fake_executable(bin_dir, 'gsutil', commands='cat "$FAKE_GSUTIL_LS" || exit 1')
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_CALLS_LOG'] = os.path.join(self.tmp_dir, 'calls.log')
+        os.environ['FAKE_GSUTIL_LS'] = os.path.join(self.tmp_dir, 'ls.txt')
+        self.set_remote_listing('     1200  2017-06-02T10:00:00Z  gs://bucket/x.vds/metadata.json.gz\n')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmp_dir)
+
+    def set_remote_listing(self, listing):
+        with open(os.environ['FAKE_GSUTIL_LS'], 'w') as f:
+            f.write(listing)
+
+    def build(self, content):
+        def f():
+            self.builds.append(content)
+            return FakeDataset(content)
+        return f
+
+    def test_checkpoint_vds(self):
+        args = {'data_type': 'exomes', 'split': True}
+        vds = self.cache.checkpoint_vds(self.hc, self.build('a' * 100), args, [self.input_path, 'gs://bucket/x.vds'])
+        self.assertEqual(vds.content, 'a' * 100)
+        vds = self.cache.checkpoint_vds(self.hc, self.build('a' * 100), dict(args), [self.input_path, 'gs://bucket/x.vds'])
+        self.assertEqual(vds.content, 'a' * 100)
+        self.assertEqual(self.builds, ['a' * 100])
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+        # Different arguments or rewritten inputs produce new checkpoints
+        self.cache.checkpoint_vds(self.hc, self.build('b'), dict(args, split=False), [self.input_path])
+        os.utime(os.path.join(self.input_path, 'data'), (0, 0))
+        self.cache.checkpoint_vds(self.hc, self.build('c'), args, [self.input_path, 'gs://bucket/x.vds'])
+        self.assertEqual(self.builds, ['a' * 100, 'b', 'c'])
+
+    def test_remote_inputs(self):
+        key = self.cache.key({}, ['gs://bucket/x.vds'])
+        self.assertEqual(self.cache.key({}, ['gs://bucket/x.vds']), key)
+        self.set_remote_listing('     1300  2017-07-01T10:00:00Z  gs://bucket/x.vds/metadata.json.gz\n')
+        self.assertNotEqual(self.cache.key({}, ['gs://bucket/x.vds']), key)
+        os.remove(os.environ['FAKE_GSUTIL_LS'])
+        self.assertIsNone(path_version('gs://bucket/x.vds'))
+        self.assertIsNone(path_version('hdfs://x.vds'))
+
+    def test_unreadable_checkpoint(self):
+        self.cache.checkpoint_vds(self.hc, self.build('a'), {}, [])
+        shutil.rmtree(self.cache.path(self.cache.key({})))
+        self.assertEqual(self.cache.checkpoint_vds(self.hc, self.build('a'), {}, []).content, 'a')
+        self.assertEqual(self.builds, ['a', 'a'])
+
+    def test_invalidate(self):
+        self.cache.checkpoint_vds(self.hc, self.build('a'), {'x': 1})
+        self.cache.checkpoint_vds(self.hc, self.build('b'), {'x': 2})
+        self.cache.invalidate(self.cache.key({'x': 1}))
+        self.assertFalse(os.path.exists(self.cache.path(self.cache.key({'x': 1}))))
+        self.assertEqual(list(self.cache.load_manifest()), [self.cache.key({'x': 2})])
+        self.cache.invalidate()
+        self.assertEqual(self.cache.load_manifest(), {})
+        self.assertFalse(os.path.exists(self.cache.path(self.cache.key({'x': 2}))))
+
+    def test_eviction(self):
+        for i in [0, 1, 0, 2]:
+            self.cache.checkpoint_vds(self.hc, self.build(str(i) * 100), {'x': i})
+            time.sleep(0.01)
+
+        self.assertEqual(self.builds, ['0' * 100, '1' * 100, '2' * 100])
+        self.assertEqual(sorted(self.cache.load_manifest()), sorted(self.cache.key({'x': i}) for i in [0, 2]))
+        self.assertEqual(self.cache.stats['evictions'], 1)
+        self.assertFalse(os.path.exists(self.cache.path(self.cache.key({'x': 1}))))
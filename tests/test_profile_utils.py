@@ -0,0 +1,210 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from collections import namedtuple
+
+from profile_utils import *
+
+FakeJobInfo = namedtuple('FakeJobInfo', ['jobId', 'stageIds'])
+
+
+class FakeStatusTracker(object):
+
+    def __init__(self, sc):
+        self.sc = sc
+
+    def getJobIdsForGroup(self, group):
+        return [job_id for job_id, (job_group, _) in enumerate(self.sc.jobs) if job_group == group]
+
+    def getJobInfo(self, job_id):
+        return FakeJobInfo(job_id, range(self.sc.jobs[job_id][1]))
+
+
+class FakeMemoryUsage(object):
+
+    def __init__(self, used):
+        self.used = used
+
+    def getUsed(self):
+        return self.used
+
+
+class FakeMemoryPool(object):
+
+    def __init__(self):
+        self.used = self.peak = 0
+
+    def getType(self):
+        return 'HEAP'
+
+    def getPeakUsage(self):
+        return FakeMemoryUsage(self.peak)
+
+    def resetPeakUsage(self):
+        self.peak = self.used
+
+    def allocate(self, mb):
+        self.used += mb << 20
+        self.peak = max(self.peak, self.used)
+
+
+class FakeJVM(object):
+    """
+    Py4J JVM view exposing only `java.lang.management.ManagementFactory.getMemoryPoolMXBeans()`
+    """
+
+    def __init__(self, pools):
+        self.java = self.lang = self.management = self.ManagementFactory = self
+        self.pools = pools
+
+    def getMemoryPoolMXBeans(self):
+        return self.pools
+
+
+class FakeSparkContext(object):
+    """
+    SparkContext recording the job group of the jobs run with `run_job`, with a single driver heap memory pool.
+    As in Spark, job groups are set per thread.
+    """
+
+    def __init__(self):
+        self.jobs = []
+        self.local = threading.local()
+        self.pool = FakeMemoryPool()
+
+    @property
+    def properties(self):
+        if not hasattr(self.local, 'properties'):
+            self.local.properties = {}
+        return self.local.properties
+
+    def setJobGroup(self, group, description):
+        self.properties['spark.jobGroup.id'] = group
+        self.properties['spark.job.description'] = description
+
+    def setLocalProperty(self, key, value):
+        self.properties[key] = value
+
+    def statusTracker(self):
+        return FakeStatusTracker(self)
+
+    @property
+    def _jvm(self):
+        return FakeJVM([self.pool])
+
+    def run_job(self, n_stages=1, memory_mb=0):
+        self.jobs.append((self.properties.get('spark.jobGroup.id'), n_stages))
+        self.pool.allocate(memory_mb)
+        self.pool.allocate(-memory_mb)
+
+
+class StepProfilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.sc = FakeSparkContext()
+        self.profiler = StepProfiler(self.sc)
+
+    def test_step(self):
+        with self.profiler.step('annotate'):
+            self.sc.run_job(3, memory_mb=100)
+            self.sc.run_job(2)
+        self.sc.run_job(1)
+        step = self.profiler.to_json()[0]
+        self.assertEqual((step['name'], step['status'], step['n_jobs'], step['n_stages']), ('annotate', 'success', 2, 5))
+        self.assertEqual(step['jvm_heap_peak_mb'], 100)
+        self.assertGreater(step['driver_maxrss_mb'], 0)
+        self.assertGreaterEqual(step['wall_time'], 0)
+        self.assertIsNone(self.sc.properties['spark.jobGroup.id'])
+
+    def test_nested_steps(self):
+        with self.profiler.step('outer'):
+            self.sc.run_job(1, memory_mb=50)
+            with self.profiler.step('inner'):
+                self.sc.run_job(2, memory_mb=200)
+            self.sc.run_job(1, memory_mb=10)
+        outer, inner = self.profiler.to_json()
+        self.assertEqual((outer['depth'], outer['n_jobs'], outer['n_stages'], outer['jvm_heap_peak_mb']), (0, 3, 4, 200))
+        self.assertEqual((inner['depth'], inner['n_jobs'], inner['n_stages'], inner['jvm_heap_peak_mb']), (1, 1, 2, 200))
+
+    def test_failed_step(self):
+        @self.profiler.profiled()
+        def fail():
+            self.sc.run_job(1)
+            raise ValueError('error')
+
+        with self.assertRaises(ValueError):
+            fail()
+        self.assertEqual(fail.__name__, 'fail')
+        step = self.profiler.to_json()[0]
+        self.assertEqual((step['name'], step['status'], step['n_jobs']), ('fail', 'failed', 1))
+
+    def test_summary(self):
+        with self.profiler.step('outer'):
+            with self.profiler.step('inner'):
+                self.sc.run_job()
+        lines = self.profiler.summary().split('\n')
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[0].startswith('step'))
+        self.assertTrue(lines[1].startswith('outer '))
+        self.assertTrue(lines[2].startswith('  inner '))
+
+    def test_threads(self):
+        def run_in_thread(f):
+            thread = threading.Thread(target=f)
+            thread.start()
+            thread.join()
+
+        with self.profiler.step('threads'):
+            run_in_thread(self.sc.run_job)
+            run_in_thread(self.profiler.bind(lambda: self.sc.run_job(2)))
+        step = self.profiler.to_json()[0]
+        self.assertEqual((step['n_jobs'], step['n_stages']), (1, 2))
+
+    def test_reset(self):
+        with self.profiler.step('outer'):
+            with self.assertRaises(ValueError):
+                self.profiler.reset()
+        self.profiler.reset()
+        self.assertEqual(self.profiler.to_json(), [])
+        with self.profiler.step('after_reset'):
+            pass
+        self.assertEqual([(x['name'], x['depth']) for x in self.profiler.to_json()], [('after_reset', 0)])
+
+    def test_no_spark(self):
+        profiler = StepProfiler()
+        with profiler.step('local'):
+            pass
+        step = profiler.to_json()[0]
+        self.assertEqual((step['n_jobs'], step['n_stages'], step['jvm_heap_peak_mb']), (None, None, None))
+        self.assertIn('local', profiler.summary())
+
+    def test_json_path(self):
+        tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        try:
+            self.profiler.json_path = os.path.join(tmp_dir, 'profile.json')
+            with self.profiler.step('first'):
+                self.sc.run_job()
+            with open(self.profiler.json_path) as f:
+                self.assertEqual([x['name'] for x in json.load(f)], ['first'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_module_profiler(self):
+        @profiled('decorated')
+        def f():
+            self.sc.run_job()
+
+        set_profiler(self.profiler)
+        try:
+            with profile_step('step'):
+                f()
+            self.assertEqual([(x['name'], x['n_jobs']) for x in self.profiler.to_json()], [('step', 1), ('decorated', 1)])
+        finally:
+            set_profiler(None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+import argparse
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import zipfile
+
+import pyhail
+
+
+def write_fake_executable(bin_dir, name, output='', commands=''):
+    """
+    Writes a fake executable that appends its arguments to `$FAKE_CALLS_LOG`, prints `output` and runs `commands`
+
+    :param str bin_dir: Directory of the executable
+    :param str name: Name of the executable (e.g. gsutil)
+    :param str output: Output of the executable
+    :param str commands: Additional shell commands
+    """
+    path = os.path.join(bin_dir, name)
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\necho "{} $@" >> "$FAKE_CALLS_LOG"\nprintf "{}"\n{}\n'.format(name, output, commands))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+
+def make_args(**kwargs):
+    args = dict(script=None, inline=None, cluster='test-cluster', preview=False, hail_version='0.1', jar=None, zip=None,
+                add_scripts=None, spark_conf=None, batch=None, max_jobs=4, log_dir=None, staging_dir=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+class PyhailTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        bin_dir = os.path.join(self.tmp_dir, 'bin')
+        os.makedirs(bin_dir)
+        write_fake_executable(bin_dir, 'gsutil', 'abcdef123456\\n', 'case "$1 $2" in "-q stat") exit 1;; esac')
+        write_fake_executable(bin_dir, 'gcloud', 'Job output\\n', 'case "$5" in *fail*) exit 2;; esac')
+        self.calls_log = os.path.join(self.tmp_dir, 'calls.log')
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+        os.environ['FAKE_CALLS_LOG'] = self.calls_log
+        os.environ.pop('HAIL_HASH_LOCATION', None)
+        self.default_cache_dir = pyhail.CACHE_DIR
+        pyhail.CACHE_DIR = os.path.join(self.tmp_dir, 'cache')
+
+        self.scripts_dir = os.path.join(self.tmp_dir, 'gnomad_hail')
+        os.makedirs(os.path.join(self.scripts_dir, 'tests'))
+        for name in ['utils.py', 'resources.py', os.path.join('tests', 'test_utils.py'), 'README.md']:
+            with open(os.path.join(self.scripts_dir, name), 'w') as f:
+                f.write('# %s\n' % name)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        pyhail.CACHE_DIR = self.default_cache_dir
+        shutil.rmtree(self.tmp_dir)
+
+    def calls(self, name=None):
+        if not os.path.exists(self.calls_log):
+            return []
+        with open(self.calls_log) as f:
+            return [line.split() for line in f if name is None or line.startswith(name + ' ')]
+
+
+class HashTests(PyhailTestCase):
+
+    def test_hash_cached(self):
+        for _ in range(5):
+            self.assertEqual(pyhail.get_hash_string('0.1', '2.0.2'), 'abcdef123456')
+        self.assertEqual(len(self.calls('gsutil')), 1)
+        pyhail.get_hash_string('0.1', '2.1.0')
+        self.assertEqual(len(self.calls('gsutil')), 2)
+
+    def test_hash_expired(self):
+        pyhail.get_hash_string('0.1', '2.0.2', ttl=0)
+        pyhail.get_hash_string('0.1', '2.0.2', ttl=0)
+        self.assertEqual(len(self.calls('gsutil')), 2)
+
+    def test_hash_location(self):
+        hash_path = os.path.join(self.tmp_dir, 'hash.txt')
+        with open(hash_path, 'w') as f:
+            f.write('fedcba\n')
+        os.environ['HAIL_HASH_LOCATION'] = hash_path
+        self.assertEqual(pyhail.get_hash_string('0.1', '2.0.2'), 'fedcba')
+        self.assertEqual(self.calls('gsutil'), [])
+
+
+class BundleTests(PyhailTestCase):
+
+    def test_bundle_content(self):
+        bundle = pyhail.get_scripts_bundle([self.scripts_dir])
+        self.assertEqual(sorted(zipfile.ZipFile(bundle).namelist()),
+                         ['gnomad_hail/resources.py', 'gnomad_hail/tests/test_utils.py', 'gnomad_hail/utils.py'])
+
+    def test_bundle_reused(self):
+        bundle = pyhail.get_scripts_bundle([self.scripts_dir])
+        self.assertEqual(pyhail.get_scripts_bundle([self.scripts_dir]), bundle)
+        self.assertEqual(len(os.listdir(os.path.dirname(bundle))), 1)
+
+        with open(os.path.join(self.scripts_dir, 'utils.py'), 'a') as f:
+            f.write('# changed\n')
+        new_bundle = pyhail.get_scripts_bundle([self.scripts_dir])
+        self.assertNotEqual(new_bundle, bundle)
+        self.assertNotEqual(pyhail.get_scripts_bundle([self.scripts_dir, os.path.join(self.scripts_dir, 'utils.py')]), new_bundle)
+
+    def test_old_bundles_removed(self):
+        default_max_bundles = pyhail.MAX_BUNDLES
+        pyhail.MAX_BUNDLES = 2
+        try:
+            for i in range(4):
+                with open(os.path.join(self.scripts_dir, 'utils.py'), 'a') as f:
+                    f.write('# %d\n' % i)
+                bundle = pyhail.get_scripts_bundle([self.scripts_dir])
+            self.assertEqual(len(os.listdir(os.path.dirname(bundle))), 2)
+            self.assertTrue(os.path.exists(bundle))
+        finally:
+            pyhail.MAX_BUNDLES = default_max_bundles
+
+
+class SubmitTests(PyhailTestCase):
+
+    def test_repeated_submissions(self):
+        args = make_args(script='script.py', add_scripts=self.scripts_dir)
+        for _ in range(10):
+            pyhail.main(args, ['--chrom', '22'])
+        self.assertEqual(len(self.calls('gsutil')), 1)
+        self.assertEqual(len(os.listdir(os.path.join(pyhail.CACHE_DIR, 'bundles'))), 1)
+        jobs = self.calls('gcloud')
+        self.assertEqual(len(jobs), 10)
+        self.assertIn('test-cluster', jobs[0])
+        self.assertEqual(jobs[0][-3:], ['--', '--chrom', '22'])
+        self.assertIn('--files=gs://hail-common/builds/0.1/jars/hail-0.1-abcdef123456-Spark-2.0.2.jar', jobs[0])
+
+
+class BatchTests(PyhailTestCase):
+
+    def write_manifest(self, lines):
+        path = os.path.join(self.tmp_dir, 'manifest.tsv')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_read_manifest(self):
+        manifest = self.write_manifest(['# script\tcluster\targs', 'a.py', 'b.py\tother-cluster\t--pop nfe --name "x y"', ''])
+        self.assertEqual(pyhail.read_batch_manifest(manifest, 'test-cluster'),
+                         [('a.py', 'test-cluster', []), ('b.py', 'other-cluster', ['--pop', 'nfe', '--name', 'x y'])])
+        with self.assertRaises(ValueError):
+            pyhail.read_batch_manifest(manifest)
+
+    def test_batch(self):
+        log_dir = os.path.join(self.tmp_dir, 'logs')
+        manifest = self.write_manifest(['chrom.py\t\t--chrom %d' % i for i in range(1, 6)] + ['fail.py\tother-cluster'])
+        args = make_args(batch=manifest, add_scripts=self.scripts_dir, log_dir=log_dir, max_jobs=2,
+                         staging_dir='gs://bucket/pyhail')
+        n_failed = pyhail.run_batch(args, ['--overwrite'])
+
+        self.assertEqual(n_failed, 1)
+        self.assertEqual(len(self.calls('gsutil')), 3)  # hash, stat and a single bundle upload
+        jobs = self.calls('gcloud')
+        self.assertEqual(len(jobs), 6)
+        self.assertTrue(all(any(x.startswith('--py-files=') and ',gs://bucket/pyhail/pyscripts_' in x for x in job) for job in jobs))
+        self.assertEqual(sorted(job[-3:] for job in jobs if 'chrom.py' in job),
+                         [['--chrom', str(i), '--overwrite'] for i in range(1, 6)])
+        self.assertIn('other-cluster', [job for job in jobs if 'fail.py' in job][0])
+
+        logs = sorted(os.listdir(log_dir))
+        self.assertEqual(logs, ['000_chrom.log', '001_chrom.log', '002_chrom.log', '003_chrom.log', '004_chrom.log', '005_fail.log'])
+        with open(os.path.join(log_dir, '000_chrom.log')) as f:
+            self.assertEqual(f.read().splitlines()[-1], 'Job output')
+
+    def test_batch_exit_status(self):
+        manifest = self.write_manifest(['fail.py'] * 256)
+        with self.assertRaises(SystemExit) as e:
+            pyhail.main(make_args(batch=manifest, log_dir=os.path.join(self.tmp_dir, 'logs'), add_scripts=self.scripts_dir,
+                                  staging_dir='gs://bucket/pyhail', max_jobs=16), [])
+        self.assertEqual(e.exception.code, 1)
+
+        manifest = self.write_manifest(['success.py'])
+        with self.assertRaises(SystemExit) as e:
+            pyhail.main(make_args(batch=manifest, log_dir=os.path.join(self.tmp_dir, 'logs'), add_scripts=self.scripts_dir,
+                                  staging_dir='gs://bucket/pyhail'), [])
+        self.assertEqual(e.exception.code, 0)
+
+    def test_batch_requires_staging_dir(self):
+        manifest = self.write_manifest(['a.py'])
+        with self.assertRaises(SystemExit) as e:
+            pyhail.run_batch(make_args(batch=manifest, add_scripts=self.scripts_dir), [])
+        self.assertEqual(e.exception.code, 1)
+        self.assertEqual(self.calls('gcloud'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+import BaseHTTPServer
+import json
+import threading
+import time
+import unittest
+import urlparse
+from collections import defaultdict
+
+import slack_utils
+from profile_utils import StepProfiler, profile_step, set_profiler
+from slack_utils import *
+
+
+class FakeSlackHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Fake Slack Web API: serves `users.list` and `channels.list` (paginated) from `server.users` / `server.channels`,
+    records every call in `server.calls` and returns `{"ok": true}` for any other method.
+    Each call takes `server.delay` seconds, and the HTTP status codes in `server.errors` are returned first.
+    """
+
+    def do_POST(self):
+        method = self.path.lstrip('/').split('/')[-1]
+        params = dict(urlparse.parse_qsl(self.rfile.read(int(self.headers.getheader('content-length', 0)))))
+        self.server.calls[method].append(params)
+
+        time.sleep(self.server.delay)
+        if self.server.errors:
+            code = self.server.errors.pop(0)
+            self.send_response(code)
+            if code == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            return
+
+        response = {'ok': True}
+        if method in ('users.list', 'channels.list'):
+            key, items = ('members', self.server.users) if method == 'users.list' else ('channels', self.server.channels)
+            start = int(params.get('cursor', 0))
+            end = start + self.server.page_size
+            response[key] = [{'name': name, 'id': 'ID_' + name} for name in items[start:end]]
+            response['response_metadata'] = {'next_cursor': str(end) if end < len(items) else ''}
+        elif method == 'files.upload':
+            response['file'] = {'url_private': 'https://files/%s' % params['filename']}
+
+        content = json.dumps(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_fake_slack_server(handler=FakeSlackHandler):
+    """
+    Starts a fake Slack server on a random local port, in a daemon thread
+
+    :param class handler: Request handler
+    :return: Server
+    :rtype: HTTPServer
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), handler)
+    server.calls = defaultdict(list)
+    server.users = ['user%d' % i for i in range(25)]
+    server.channels = ['gnomad', 'random']
+    server.page_size = 10
+    server.delay = 0
+    server.errors = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class SlackClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = start_fake_slack_server()
+        self.client = SlackClient('token', base_url='http://127.0.0.1:%d/api' % self.server.server_port)
+        set_slack_client(self.client)
+
+    def tearDown(self):
+        set_slack_client(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def n_calls(self, method):
+        return len(self.server.calls[method])
+
+    def test_directory_cached(self):
+        for _ in range(10):
+            self.assertEqual(send_snippet('@user24', 'content'), {'ok': True, 'file': {'url_private': 'https://files/data.txt'}})
+            send_snippet('#gnomad', 'content')
+        self.assertEqual(self.n_calls('users.list'), 3)  # 3 pages, fetched once
+        self.assertEqual(self.n_calls('channels.list'), 1)
+        self.assertEqual(self.n_calls('files.upload'), 20)
+        self.assertEqual(self.server.calls['files.upload'][0]['channels'], 'ID_user24')
+        self.assertEqual(self.server.calls['files.upload'][1]['channels'], 'ID_gnomad')
+        self.assertEqual(self.server.calls['files.upload'][0]['token'], 'token')
+
+    def test_refresh_on_miss(self):
+        self.assertEqual(self.client.get_channel_id('gnomad'), 'ID_gnomad')
+        self.server.channels.append('new_channel')
+        self.assertEqual(self.client.get_channel_id('new_channel'), 'ID_new_channel')
+        self.assertEqual(self.n_calls('channels.list'), 2)
+        self.assertIsNone(self.client.get_channel_id('missing'))
+        self.assertEqual(self.n_calls('channels.list'), 3)
+
+    def test_ttl(self):
+        self.client.ttl = 0
+        self.client.get_channel_id('gnomad')
+        self.client.get_channel_id('gnomad')
+        self.assertEqual(self.n_calls('channels.list'), 2)
+
+    def test_send_message(self):
+        send_message(['#gnomad', '@user1'], 'Done', ':tada:')
+        self.assertEqual([(x['channel'], x['text'], x['icon_emoji']) for x in self.server.calls['chat.postMessage']],
+                         [('#gnomad', 'Done', ':tada:'), ('@user1', 'Done', ':tada:')])
+        self.assertEqual(self.n_calls('users.list'), 0)
+
+    def test_module_client(self):
+        set_slack_client(None)
+        self.assertIsNone(get_slack_client())  # No slack_creds
+        set_slack_client(self.client)
+        self.assertIs(get_slack_info()[0], self.client)
+        self.assertIn(get_slack_info()[1], ['#gnomad'] + ['@user%d' % i for i in range(25)])
+        self.assertEqual(self.n_calls('users.list'), 3)
+
+
+class SlackDispatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = start_fake_slack_server()
+        self.client = SlackClient('token', base_url='http://127.0.0.1:%d/api' % self.server.server_port)
+        self.dispatcher = SlackDispatcher(self.client, max_queue_size=10, backoff=0.01, flush_timeout=5)
+        set_slack_client(self.client)
+        set_slack_dispatcher(self.dispatcher)
+
+    def tearDown(self):
+        self.dispatcher.flush(1)
+        set_slack_client(None)
+        set_slack_dispatcher(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def messages(self):
+        return [x['text'] for x in self.server.calls['chat.postMessage']]
+
+    def test_non_blocking(self):
+        self.server.delay = 0.5
+        start = time.time()
+        try_slack('#gnomad', lambda: None)
+        self.assertLess(time.time() - start, 0.2)
+        self.assertTrue(self.dispatcher.flush())
+        self.assertEqual(len(self.messages()), 1)
+        self.assertIn('finished', self.messages()[0])
+
+    def test_profile_summary(self):
+        set_profiler(StepProfiler())
+        try:
+            def job():
+                with profile_step('load_data'):
+                    pass
+                with profile_step('annotate'):
+                    pass
+
+            try_slack('#gnomad', job)
+            self.dispatcher.flush()
+            lines = self.messages()[0].split('\n')
+            self.assertIn('finished', lines[0])
+            self.assertTrue(lines[1].startswith('```step '))
+            self.assertTrue(lines[2].startswith('job '))
+            self.assertTrue(lines[3].startswith('  load_data '))
+            self.assertTrue(lines[4].startswith('  annotate '))
+        finally:
+            set_profiler(None)
+
+    def test_original_exception(self):
+        self.server.delay = 0.5
+
+        def fail():
+            raise ValueError('original error')
+
+        start = time.time()
+        with self.assertRaises(ValueError) as e:
+            try_slack('#gnomad', fail)
+        self.assertLess(time.time() - start, 0.2)
+        self.assertEqual(str(e.exception), 'original error')
+        self.dispatcher.flush()
+        self.assertIn('original error', self.messages()[0])
+        self.assertIn('in fail', self.messages()[0])
+
+    def test_long_error_snippet(self):
+        def fail():
+            raise ValueError('x' * 5000)
+
+        with self.assertRaises(ValueError):
+            try_slack('@user3', fail)
+        self.dispatcher.flush()
+        self.assertEqual(self.messages(), [])
+        upload = self.server.calls['files.upload'][0]
+        self.assertEqual(upload['channels'], 'ID_user3')
+        self.assertIn('failed', upload['initial_comment'])
+        self.assertIn('x' * 5000, upload['content'])
+
+    def test_batching(self):
+        self.server.delay = 0.2
+        for i in range(5):
+            send_message('#gnomad', 'message %d' % i, background=True)
+        send_message('#other', 'other message', background=True)
+        self.dispatcher.flush()
+        self.assertEqual('\n'.join(self.messages()), '\n'.join(['message %d' % i for i in range(5)] + ['other message']))
+        self.assertLess(len(self.messages()), 6)
+        self.assertEqual(self.dispatcher.stats['sent'], len(self.messages()))
+
+    def test_rate_limit(self):
+        self.server.errors = [429, 429, 503]
+        send_message('#gnomad', 'message', background=True)
+        self.dispatcher.flush()
+        self.assertEqual(self.messages(), ['message'] * 4)
+        self.assertEqual(self.dispatcher.stats['rate_limited'], 2)
+        self.assertEqual(self.dispatcher.stats['retries'], 3)
+        self.assertEqual(self.dispatcher.stats['sent'], 1)
+
+    def test_give_up(self):
+        self.dispatcher.max_retries = 2
+        self.server.errors = [500] * 3 + [400]
+        send_message('#gnomad', 'message', background=True)
+        send_message('@user1', 'other message', background=True)
+        self.assertTrue(self.dispatcher.flush())
+        self.assertEqual(self.dispatcher.stats['failed'], 2)
+        self.assertEqual(self.dispatcher.stats['sent'], 0)
+
+    def test_bounded_queue(self):
+        self.server.delay = 0.2
+        start = time.time()
+        for i in range(50):
+            send_message('#gnomad', 'message %d' % i, background=True)
+        self.assertLess(time.time() - start, 0.2)
+        self.assertGreater(self.dispatcher.stats['dropped'], 0)
+        self.dispatcher.flush()
+        self.assertEqual(len('\n'.join(self.messages()).split('\n')), 50 - self.dispatcher.stats['dropped'])
+
+    def test_flush_timeout(self):
+        self.server.delay = 2
+        send_message('#gnomad', 'message', background=True)
+        start = time.time()
+        self.assertFalse(self.dispatcher.flush(0.2))
+        self.assertLess(time.time() - start, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,13 @@
+import gzip
+import io
+import math
+import tempfile
 import unittest
+import zlib
 
 from utils import *
+from tests.synthetic import *
+from tests.test_pyhail import write_fake_executable
 
 hc = None
 verbose = False
@@ -126,6 +133,675 @@ class KeyTableTests(unittest.TestCase):
         if verbose: grouped_melted_kt.show(50)
 
 
+class SchemaTests(unittest.TestCase):
+
+    def test_schema_index(self):
+        schema = create_synthetic_schema(n_fields=4, depth=2, n_structs=2)
+        index = get_schema_index(schema)
+        self.assertIs(index, get_schema_index(schema))
+        self.assertEqual(index.fields, flatten_struct(schema, root='va', leaf_only=False))
+        self.assertEqual(index.leaves, flatten_struct(schema, root='va'))
+        self.assertTrue(ann_exists('va.s1.s0.f3', schema))
+        self.assertFalse(ann_exists('va.s1.s0.s0', schema))
+        self.assertEqual(get_ann_type('va.s0.f1', schema), TInt())
+
+        grouped = group_annotations_by_attribute(schema, 'Number', 'va.s1', recursive=True, default_func=default_number)
+        self.assertEqual(grouped.keys(), ['1'])  # Arrays are only grouped when they have a Number attribute
+        self.assertEqual(sorted(x.path for x in grouped['1']), sorted(p for p, f in index.leaves.iteritems() if p.startswith('va.s1.') and isinstance(f.typ, TInt)))
+        grouped['1'].pop()
+        self.assertEqual(len(group_annotations_by_attribute(schema, 'Number', 'va.s1', recursive=True, default_func=default_number)['1']), 2 * 3)
+
+    def test_merge_schemas(self):
+        vds_with_attributes = create_synthetic_wide_vds(hc, n_fields=20, attributes=True)
+        vds = create_synthetic_wide_vds(hc, n_fields=10, attributes=False).annotate_variants_expr('va.other = 1')
+        merged_vdses = merge_schemas([vds_with_attributes, vds])
+        self.assertEqual(len(merged_vdses), 2)
+        schemas = [flatten_struct(x.variant_schema, root='va') for x in merged_vdses]
+        self.assertEqual(set(schemas[0].keys()), set(schemas[1].keys()))
+        self.assertIn('va.other', schemas[0])
+        for schema in schemas:
+            self.assertEqual(schema['va.info.f15'].attributes, {'Description': 'Field f15'})
+
+    def test_update_va_attributes(self):
+        vds = create_synthetic_wide_vds(hc, n_fields=5, attributes=True)
+        self.assertIs(update_va_attributes(vds, {'va.info.f0': {'Description': 'Field f0'}}), vds)
+        vds = update_va_attributes(vds, {'va.info.f0': {'Description': 'New'}, 'va.info.f1': {'Description': 'Field f1'}})
+        schema = flatten_struct(vds.variant_schema, root='va')
+        self.assertEqual(schema['va.info.f0'].attributes, {'Description': 'New'})
+        self.assertEqual(schema['va.info.f1'].attributes, {'Description': 'Field f1'})
+
+
+class ListDataTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        self.path = os.path.join(self.tmp_dir, 'samples.tsv.gz')
+        with gzip.open(self.path, 'w') as f:
+            f.write(''.join('sample_%d\trenamed_%d\n' % (i, i) for i in range(0, 10, 2)))
+            f.write('other_sample\trenamed_other\n')
+
+    def test_iter_list_data(self):
+        lines = ['sample_%d\trenamed_%d' % (i, i) for i in range(0, 10, 2)] + ['other_sample\trenamed_other']
+        self.assertEqual(list(iter_list_data(self.path)), lines)
+        self.assertEqual(read_list_data('file://' + self.path), lines)
+        self.assertEqual(list(iter_list_data_chunks(self.path, chunk_size=4)), [lines[:4], lines[4:]])
+
+    def test_rename_samples(self):
+        vds = create_synthetic_vds(hc, n_variants=5, n_samples=8)
+        self.assertEqual(rename_samples(vds, self.path).sample_ids,
+                         ['renamed_%d' % i if i % 2 == 0 else 'sample_%d' % i for i in range(8)])
+        self.assertEqual(rename_samples(vds, self.path, filter_to_samples_in_file=True).sample_ids,
+                         ['renamed_%d' % i for i in range(0, 8, 2)])
+
+
+class IntervalTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        cls.interval_files = {}
+        for name, lines in [('lcr', ['@HD\tVN:1.0', '1\t100\t200\t+\tlcr1', '1\t150\t300\t+\tlcr2', '2\t50\t60\t+\tlcr3']),
+                            ('decoy', ['1:1000-1100', '2\t10\t20']),
+                            ('high_conf1', ['1\t1\t1050', '2\t1\t100']),
+                            ('high_conf2', ['1\t250\t5000', '2\t15\t55'])]:
+            cls.interval_files[name] = os.path.join(cls.tmp_dir, name + '.interval_list')
+            with open(cls.interval_files[name], 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+        positions = [('1', p) for p in [1, 99, 100, 200, 250, 300, 301, 999, 1000, 1050, 1100, 1101, 6000]] + \
+                    [('2', p) for p in [9, 10, 20, 21, 49, 55, 56, 60, 61, 101]]
+        rows = [{'v': Variant.parse('{}:{}:A:T'.format(c, p))} for c, p in positions]
+        cls.vds = VariantDataset.from_table(KeyTable.from_py(hc, rows, TStruct(['v'], [TVariant()]), key_names=['v']))
+
+    def test_merge_intervals(self):
+        merged = merge_intervals([('1', 1, 10), ('1', 5, 20), ('1', 22, 30), ('2', 1, 5), ('1', 21, 21)])
+        self.assertEqual(merged, [('1', 1, 30), ('2', 1, 5)])
+        other = merge_intervals([('1', 3, 4), ('1', 8, 25), ('2', 2, 2)])
+        self.assertEqual(intersect_intervals(merged, other), [('1', 3, 4), ('1', 8, 25), ('2', 2, 2)])
+        self.assertEqual(subtract_intervals(merged, other), [('1', 1, 2), ('1', 5, 7), ('1', 26, 30), ('2', 1, 1), ('2', 3, 5)])
+
+    def test_interval_index(self):
+        self.assertEqual(get_interval_index(self.interval_files['lcr']), [('1', 100, 300), ('2', 50, 60)])
+        self.assertEqual(get_interval_index(self.interval_files['decoy']), [('1', 1000, 1100), ('2', 10, 20)])
+
+    def test_filter_low_conf_regions(self):
+        for filter_lcr, filter_decoy, high_conf_regions in [(True, True, None), (True, False, None), (False, False, ['high_conf1']),
+                                                            (True, True, ['high_conf1']), (True, True, ['high_conf1', 'high_conf2'])]:
+            expected_vds = self.vds
+            if filter_lcr:
+                expected_vds = expected_vds.filter_variants_table(KeyTable.import_interval_list(self.interval_files['lcr']), keep=False)
+            if filter_decoy:
+                expected_vds = expected_vds.filter_variants_table(KeyTable.import_interval_list(self.interval_files['decoy']), keep=False)
+            if high_conf_regions:
+                for region in high_conf_regions:
+                    expected_vds = expected_vds.filter_variants_table(KeyTable.import_interval_list(self.interval_files[region]), keep=True)
+
+            result_vds = filter_low_conf_regions(self.vds, filter_lcr, filter_decoy,
+                                                 [self.interval_files[x] for x in high_conf_regions] if high_conf_regions else None,
+                                                 lcr_intervals=self.interval_files['lcr'], decoy_intervals=self.interval_files['decoy'])
+            self.assertEqual(sorted(map(str, result_vds.query_variants('variants.collect()'))),
+                             sorted(map(str, expected_vds.query_variants('variants.collect()'))),
+                             (filter_lcr, filter_decoy, high_conf_regions))
+
+
+class AlleleStatsTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vds = create_synthetic_vds(hc, n_variants=50, n_samples=100, multi_allelic_fraction=0.2).split_multi()
+
+    def assertValuesAlmostEqual(self, x, y, path=''):
+        if isinstance(x, Struct):
+            self.assertIsInstance(y, Struct, path)
+            self.assertEqual(sorted(x._attrs.keys()), sorted(y._attrs.keys()), path)
+            for k in x._attrs.keys():
+                self.assertValuesAlmostEqual(x._attrs[k], y._attrs[k], '{}.{}'.format(path, k))
+        elif isinstance(x, float) and isinstance(y, float):
+            self.assertAlmostEqual(x, y, places=6, msg=path)
+        else:
+            self.assertEqual(x, y, path)
+
+    def test_fused_allele_stats(self):
+        result_vds = (self.vds
+                      .annotate_variants_expr(get_allele_stats_expr('va.stats', medians=True))
+                      .annotate_variants_expr(get_allele_stats_expr('va.fused_stats', medians=True, fused=True)))
+        self.assertEqual(get_ann_type('va.stats', result_vds.variant_schema), get_ann_type('va.fused_stats', result_vds.variant_schema))
+
+        results = result_vds.query_variants('variants.map(v => {v: v, stats: va.stats, fused_stats: va.fused_stats}).collect()')
+        for r in results:
+            self.assertValuesAlmostEqual(r.stats, r.fused_stats, str(r.v))
+
+    def test_fused_allele_stats_no_carriers(self):
+        for vds, samples_filter_expr in [(self.vds.annotate_samples_expr('sa.keep = false'), 'sa.keep'),
+                                         (self.vds.filter_genotypes('!g.isCalledNonRef'), '')]:
+            result_vds = (vds
+                          .annotate_variants_expr(get_allele_stats_expr('va.stats', samples_filter_expr=samples_filter_expr))
+                          .annotate_variants_expr(get_allele_stats_expr('va.fused_stats', samples_filter_expr=samples_filter_expr, fused=True)))
+            for r in result_vds.query_variants('variants.map(v => {v: v, stats: va.stats, fused_stats: va.fused_stats}).collect()'):
+                self.assertEqual((r.fused_stats.nrdp, r.fused_stats.qual), (0, 0.0), str(r.v))
+                self.assertValuesAlmostEqual(r.stats, r.fused_stats, str(r.v))
+
+    def test_approx_medians(self):
+        def exact_median(values):
+            values = sorted(x for x in values if x is not None)
+            if not values:
+                return None
+            mid = len(values) // 2
+            return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+        values_expr = ['va.values.{0} = gs.filter(g => {1}).map(g => {2}).collect()'.format(metric, metric_filter, value)
+                       for metric, (metric_filter, value) in ALLELE_STATS_METRICS.iteritems()]
+        result_vds = (self.vds
+                      .annotate_variants_expr(get_allele_stats_expr('va.stats', medians=True, approx_medians=True))
+                      .annotate_variants_expr(values_expr))
+
+        results = result_vds.query_variants('variants.map(v => {v: v, stats: va.stats, values: va.values}).collect()')
+        for r in results:
+            for metric in ALLELE_STATS_METRICS:
+                start, end, bins = ALLELE_STATS_MEDIAN_HISTS[metric]
+                exact = exact_median(getattr(r.values, metric))
+                approx = getattr(r.stats, metric + '_median')
+                if exact is None or not start <= exact <= end:
+                    continue
+                self.assertIsNotNone(approx, '{} {}'.format(r.v, metric))
+                self.assertLessEqual(abs(approx - exact), (end - start) / (2.0 * bins) + 1e-9, '{} {}'.format(r.v, metric))
+
+    def test_approx_medians_requires_medians(self):
+        for fused in [False, True]:
+            with self.assertRaises(ValueError):
+                get_allele_stats_expr(approx_medians=True, fused=fused)
+
+
+class AnnotationPlanTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vds = annotate_synthetic_info(create_synthetic_vds(hc, n_variants=50, n_samples=10, multi_allelic_fraction=0.5))
+
+    def check_plan(self, steps, n_stages):
+        plan = VariantAnnotationPlan(self.vds)
+        vds = self.vds
+        for step, expr in steps:
+            getattr(plan, step)(expr)
+            vds = vds.annotate_variants_expr(expr) if step == 'annotate' else vds.filter_variants_expr(expr)
+        self.assertEqual(plan.n_stages, n_stages)
+        query = 'variants.map(v => {v: v, va: va}).collect()'
+        self.assertEqual(plan.execute().query_variants(query), vds.query_variants(query))
+
+    def test_independent_annotations(self):
+        self.check_plan([('annotate', 'va.a = va.info.AN * 2'),
+                         ('annotate', ['va.b = va.info.AC[0]', 'va.info.AN = va.info.AN + 1']),
+                         ('annotate', 'va.c = v.start')], 1)
+
+    def test_dependent_annotations(self):
+        self.check_plan([('annotate', 'va.a = va.info.AN * 2'),
+                         ('annotate', 'va.b = va.a + 1, va.c = va.info.AC'),
+                         ('annotate', 'va.info = drop(va.info, GC)'),
+                         ('annotate', 'va.d = va.info')], 3)
+
+    def test_filters(self):
+        self.check_plan([('annotate', 'va.a = va.info.AN * 2'),
+                         ('filter', 'va.info.AC[0] > 1'),
+                         ('annotate', 'va.b = va.info.AS_RF'),
+                         ('filter', 'v.nAltAlleles == 1'),
+                         ('filter', 'va.a > 10')], 3)
+
+
+class FrequencyTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        vds = create_synthetic_vds(hc, n_variants=30, n_samples=30)
+        meta = [{'s': s, 'population': ['afr', 'nfe', None][i % 3], 'sex': ['male', 'female'][i % 2]} for i, s in enumerate(vds.sample_ids)]
+        meta_kt = KeyTable.from_py(hc, meta, TStruct(['s', 'population', 'sex'], [TString(), TString(), TString()]), key_names=['s'])
+        cls.vds = vds.annotate_samples_table(meta_kt, root='sa.meta')
+        cls.freq_vds = annotate_frequencies(cls.vds, ['AFR', 'NFE'])
+
+    def test_freq_meta(self):
+        freq_meta = self.freq_vds.globals.freq_meta
+        self.assertEqual(freq_meta, get_freq_meta(['afr', 'nfe'], ['female', 'male']))
+        self.assertEqual(len(freq_meta), 2 * (1 + 2 + 2 + 4))
+        self.assertEqual(get_freq_labels(freq_meta)[:6], ['adj', 'adj_afr', 'adj_nfe', 'adj_female', 'adj_male', 'adj_afr_female'])
+
+    def test_frequencies(self):
+        freq_meta = self.freq_vds.globals.freq_meta
+        frequencies = {r.v: r.freq for r in self.freq_vds.query_variants('variants.map(v => {v: v, freq: va.freq}).collect()')}
+        for i, stratum in enumerate(freq_meta):
+            criteria = ['g.isCalled'] + (['(%s)' % ADJ_CRITERIA] if stratum['group'] == 'adj' else [])
+            if 'pop' in stratum:
+                criteria.append('sa.meta.population == "%s"' % stratum['pop'])
+            if 'sex' in stratum:
+                criteria.append('sa.meta.sex == "%s"' % stratum['sex'])
+            expected = self.vds.query_variants('variants.map(v => {v: v, cs: gs.filter(g => %s).callStats(g => v)}).collect()' % ' && '.join(criteria))
+            for r in expected:
+                freq = frequencies[r.v][i]
+                self.assertEqual(freq.AC, r.cs.AC[1])
+                self.assertEqual(freq.AN, r.cs.AN)
+                self.assertEqual(freq.Hom, r.cs.GC[2])
+
+    def test_melt_frequencies(self):
+        freq_meta = self.freq_vds.globals.freq_meta
+        kt = self.freq_vds.variants_table().annotate('freq = va.freq').select(['v', 'freq'])
+        melted_kt = melt_kt_grouped(kt, 'freq', ['AC', 'AN', 'Hom'], 'stratum', keys=get_freq_labels(freq_meta))
+        self.assertEqual(sorted(melted_kt.columns), sorted(['v', 'stratum', 'AC', 'AN', 'Hom']))
+        self.assertEqual(melted_kt.count(), 30 * len(freq_meta))
+        self.assertEqual(melted_kt.query('stratum.counter()'), {label: 30 for label in get_freq_labels(freq_meta)})
+
+    def test_mixed_case_meta(self):
+        vds = self.vds.annotate_samples_expr('sa.meta = {population: if (sa.meta.population == "afr") "AFR" else if (sa.meta.population == "nfe") "Nfe" else sa.meta.population, '
+                                             'sex: if (sa.meta.sex == "male") "Male" else "FEMALE"}')
+        freq_vds = annotate_frequencies(vds, ['afr', 'NFE'])
+        self.assertEqual(freq_vds.globals.freq_meta, self.freq_vds.globals.freq_meta)
+        self.assertEqual(freq_vds.query_variants('variants.map(v => {v: v, freq: va.freq}).collect()'),
+                         self.freq_vds.query_variants('variants.map(v => {v: v, freq: va.freq}).collect()'))
+
+    def test_special_characters_meta(self):
+        vds = self.vds.annotate_samples_expr('sa.meta.population = if (sa.meta.population == "nfe") "n\\"f\\\\e" else sa.meta.population')
+        freq_vds = annotate_frequencies(vds, ['afr', 'n"f\\e'])
+        self.assertEqual([x.AC for x in freq_vds.query_variants('variants.map(v => va.freq).collect()')[0]],
+                         [x.AC for x in self.freq_vds.query_variants('variants.map(v => va.freq).collect()')[0]])
+
+
+class PackedHardcallsTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        vds = create_synthetic_vds(hc, n_variants=30, n_samples=30, multi_allelic_fraction=0.2)
+        meta = [{'s': s, 'population': ['afr', 'nfe'][i % 2], 'sex': ['male', 'female'][i % 3 % 2]} for i, s in enumerate(vds.sample_ids)]
+        meta_kt = KeyTable.from_py(hc, meta, TStruct(['s', 'population', 'sex'], [TString(), TString(), TString()]), key_names=['s'])
+        cls.vds = vds.annotate_samples_table(meta_kt, root='sa.meta')
+        cls.packed_vds = pack_hardcalls(cls.vds)
+
+    def test_schema(self):
+        self.assertFalse(is_packed_hardcalls(self.vds))
+        self.assertTrue(is_packed_hardcalls(self.packed_vds))
+        self.assertEqual(get_call_expr(self.packed_vds), 'g.GT')
+        self.assertEqual(get_adj_expr(self.packed_vds), 'g.adj')
+
+    def test_adj(self):
+        expected = self.vds.query_genotypes('gs.filter(g => %s).count()' % ADJ_CRITERIA)
+        self.assertEqual(self.packed_vds.query_genotypes('gs.filter(g => g.adj).count()'), expected)
+        self.assertEqual(filter_to_adj(self.packed_vds).query_genotypes('gs.filter(g => g.GT.isCalled).count()'),
+                         filter_to_adj(self.vds).query_genotypes('gs.filter(g => g.isCalled).count()'))
+
+    def test_frequencies(self):
+        query = 'variants.map(v => {v: v, freq: va.freq}).collect()'
+        expected = {r.v: r.freq for r in annotate_frequencies(self.vds, ['AFR', 'NFE']).query_variants(query)}
+        packed = {r.v: r.freq for r in annotate_frequencies(self.packed_vds, ['AFR', 'NFE']).query_variants(query)}
+        self.assertEqual(packed, expected)
+
+    def test_sample_qc(self):
+        expected = self.vds.annotate_samples_expr(get_sample_qc_metrics_expr()).query_samples('samples.map(s => sa.qc).collect()')
+        packed = self.packed_vds.annotate_samples_expr(get_sample_qc_metrics_expr(call_expr='g.GT')).query_samples('samples.map(s => sa.qc).collect()')
+        self.assertEqual(packed, expected)
+
+
+class FilterSamplesThenVariantsTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vds = create_synthetic_vds(hc, n_variants=100, n_samples=10, multi_allelic_fraction=0.5)
+
+    def check_filter(self, vds, min_allele_count, split):
+        samples = '["sample_0", "sample_1"].toSet.contains(s)'
+        expected = (vds.filter_samples_expr(samples)
+                    .annotate_variants_expr('va.cs = gs.callStats(g => v)')
+                    .filter_variants_expr('va.cs.AC[1:].exists(ac => ac > %d)' % min_allele_count)
+                    .variants_table().query('v.collect()'))
+        result = filter_samples_then_variants(vds, samples, min_allele_count=min_allele_count, split=split)
+        self.assertEqual(result.sample_ids, ['sample_0', 'sample_1'])
+        self.assertEqual(sorted(map(str, result.variants_table().query('v.collect()'))), sorted(map(str, expected)))
+        self.assertEqual(result.variant_schema, vds.variant_schema)
+
+    def test_split(self):
+        for min_allele_count in [0, 1]:
+            self.check_filter(self.vds.split_multi(), min_allele_count, True)
+
+    def test_unsplit(self):
+        for min_allele_count in [0, 1]:
+            self.check_filter(self.vds, min_allele_count, False)
+
+
+class VCFExportTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vds = annotate_synthetic_info(create_synthetic_vds(hc, n_variants=40, n_samples=10, multi_allelic_fraction=0.2))
+
+    def test_contig_sort_key(self):
+        self.assertEqual(sorted(['X', '10', 'MT', '2', 'Y', '1'], key=contig_sort_key), ['1', '2', '10', 'X', 'Y', 'MT'])
+        self.assertEqual(sorted(['chrX', 'chr10', 'chr2'], key=contig_sort_key), ['chr2', 'chr10', 'chrX'])
+
+    def test_prepare_vcf_info(self):
+        vds = prepare_vcf_info(self.vds, ignore=['GC'])
+        anns = get_schema_index(vds.variant_schema).fields
+        self.assertNotIn('va.info.GC', anns)
+        self.assertEqual(anns['va.info.AC'].attributes['Number'], 'A')
+        self.assertEqual(anns['va.info.AN'].attributes['Number'], '1')
+        self.assertEqual(anns['va.info.AS_RF'].attributes['Number'], '.')
+
+    def test_prepare_vcf_info_arrays(self):
+        vds = prepare_vcf_info(self.vds.annotate_variants_expr('va.info.new_array = [1, 2], va.info.new_set = ["a"].toSet'))
+        anns = get_schema_index(vds.variant_schema).fields
+        self.assertEqual(anns['va.info.new_array'].attributes['Number'], '.')
+        self.assertEqual(anns['va.info.new_set'].attributes['Number'], '.')
+
+    def test_export_and_concatenate(self):
+        tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        shards = export_sites_vcf_shards(self.vds, tmp_dir, tabix=False)
+        self.assertEqual(shards, [os.path.join(tmp_dir, '1.vcf.bgz')])
+        output = os.path.join(tmp_dir, 'all.vcf.bgz')
+        concatenate_vcf_shards(shards + shards, output, tabix=False)
+        with hadoop_read(output) as f:
+            lines = f.readlines()
+        self.assertIn('##INFO=<ID=AC,Number=A', ''.join(lines))
+        self.assertEqual(len([l for l in lines if l.startswith('#CHROM')]), 1)
+        self.assertEqual(len([l for l in lines if not l.startswith('#')]), 2 * 40)
+        with open(output, 'rb') as f:
+            blocks = list(iter(lambda: read_bgzf_block(f), None))
+        self.assertEqual(blocks[-1][0], BGZF_EOF)
+
+    def test_concatenate_remote_shards(self):
+        tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        environ = dict(os.environ)
+        try:
+            bin_dir, bucket_dir = os.path.join(tmp_dir, 'bin'), os.path.join(tmp_dir, 'bucket')
+            os.makedirs(bin_dir)
+            export_sites_vcf_shards(self.vds, bucket_dir, tabix=False)
+            # Fake `gsutil cat [-r <start>-] gs://bucket/<path>`, reading from bucket_dir
+            write_fake_executable(bin_dir, 'gsutil', commands='case "$1 $2" in '
+                                  '"cat -r") tail -c +$((${3%-} + 1)) "$FAKE_BUCKET_DIR/${4#gs://bucket/}";; '
+                                  'cat*) cat "$FAKE_BUCKET_DIR/${2#gs://bucket/}";; esac')
+            os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+            os.environ['FAKE_CALLS_LOG'] = os.path.join(tmp_dir, 'calls.log')
+            os.environ['FAKE_BUCKET_DIR'] = bucket_dir
+
+            output = os.path.join(tmp_dir, 'all.vcf.bgz')
+            concatenate_vcf_shards(['gs://bucket/1.vcf.bgz', os.path.join(bucket_dir, '1.vcf.bgz'), 'gs://bucket/1.vcf.bgz'], output, tabix=False)
+            with gzip.open(output) as f:
+                lines = f.readlines()
+            self.assertTrue(lines[0].startswith('##fileformat'))
+            self.assertEqual(len([l for l in lines if l.startswith('#CHROM')]), 1)
+            self.assertEqual(len([l for l in lines if not l.startswith('#')]), 3 * 40)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(tmp_dir)
+
+    def test_split_bgzf_vcf_header(self):
+        header = '##fileformat=VCFv4.2\n' + '##INFO=<ID=X>\n' * 5000 + '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n'
+        records = ''.join('1\t%d\t.\tA\tT\t.\tPASS\t.\n' % i for i in range(1, 1001))
+        for split in [len(header), len(header) + 10]:
+            shard = bgzf_compress((header + records)[:split]) + bgzf_compress((header + records)[split:]) + BGZF_EOF
+            parsed_header, first_records, offset = split_bgzf_vcf_header(io.BytesIO(shard))
+            self.assertEqual(parsed_header, header)
+            self.assertEqual(zlib.decompress(first_records[18:-8], -15) if first_records else '', records[:split - len(header)])
+            self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(first_records + shard[offset:])).read(), records)
+
+
+class SplitTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vds = annotate_synthetic_info(create_synthetic_vds(hc, n_variants=50, n_samples=10, multi_allelic_fraction=0.5))
+        cls.original = {r.v.start: r for r in cls.vds.query_variants('variants.map(v => {v: v, va: va}).collect()')}
+
+    def get_split_rows(self, **kwargs):
+        split_vds = split_vds_and_annotations(self.vds, **kwargs)
+        self.assertEqual([f.name for f in get_ann_type('va.info', split_vds.variant_schema).fields], ['AC', 'AN', 'AS_FilterStatus', 'AS_RF'])
+        rows = split_vds.query_variants('variants.map(v => {v: v, va: va}).collect()')
+        self.assertEqual(len(rows), sum(r.v.num_alt_alleles() for r in self.original.values()))
+        return rows
+
+    def test_split_vds_and_annotations(self):
+        for r in self.get_split_rows():
+            original = self.original[r.v.start]
+            i = r.va.aIndex - 1
+            self.assertEqual(r.va.info.AC, original.va.info.AC[i])
+            self.assertEqual(r.va.info.AS_FilterStatus, original.va.info.AS_FilterStatus[i])
+            self.assertEqual(r.va.info.AS_RF, original.va.info.AS_RF)
+            self.assertEqual(r.va.filters, {'RF'} if r.v.alt() == 'T' else set())
+
+    def test_AS_filters(self):
+        for r in self.get_split_rows(AS_filters=['AC0']):
+            self.assertEqual(r.va.filters, self.original[r.v.start].va.filters)
+
+
+class SampleQCTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vds = create_synthetic_vds(hc, n_variants=100, n_samples=20, multi_allelic_fraction=0.3)
+
+    def test_sample_qc_metrics(self):
+        expected = {x.s: x.qc for x in self.vds.sample_qc().query_samples('samples.map(s => {s: s, qc: sa.qc}).collect()')}
+        for x in self.vds.annotate_samples_expr(get_sample_qc_metrics_expr()).query_samples('samples.map(s => {s: s, qc: sa.qc}).collect()'):
+            for metric in SAMPLE_QC_METRICS:
+                self.assertEqual(x.qc[metric], expected[x.s][metric])
+
+    def test_samples_sanity_checks(self):
+        result = run_samples_sanity_checks(self.vds, self.vds, n_samples=5)
+        self.assertTrue(result.passed)
+        self.assertEqual(len(result.matches), 5 * len(SAMPLE_QC_METRICS))
+
+        reference_vds = create_synthetic_vds(hc, n_variants=100, n_samples=20, seed=1).filter_samples_list(['sample_1'], keep=False)
+        result = run_samples_sanity_checks(self.vds, reference_vds, n_samples=5, verbose=False)
+        self.assertFalse(result.passed)
+        self.assertEqual(result.missing_samples, ['sample_1'])
+        self.assertTrue(all(x.data != x.reference for x in result.failures))
+        self.assertIn('FAILURE: Sample sample_0', str(result))
+        self.assertNotIn('SUCCESS', str(result))
+
+
+class PCProjectTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pc_vds = (create_synthetic_vds(hc, n_variants=50, n_samples=20, seed=1)
+                      .annotate_variants_expr('va.pca_loadings = {PC1: (v.start % 7) / 7.0, PC2: (v.start % 3) / 3.0 - 0.5, PC3: 1.0}'))
+        cls.vds = create_synthetic_vds(hc, n_variants=50, n_samples=10, seed=2)
+
+    def expected_scores(self, loadings_kt):
+        loadings = {r.v: r for r in loadings_kt.collect()}
+        variants = set(self.vds.query_variants('variants.collect()')).intersection(loadings)
+        scores = defaultdict(lambda: [0.0] * 3)
+        for g in self.vds.query_genotypes('gs.map(g => {v: v, s: s, gt: g.gt}).collect()'):
+            if g.v in variants and g.gt is not None:
+                r = loadings[g.v]
+                scores[g.s] = [x + (g.gt - 2 * r.af) * r.norm * getattr(r.loadings, pc) for x, pc in zip(scores[g.s], ['PC1', 'PC2', 'PC3'])]
+        return {s: [x / math.sqrt(len(variants)) for x in v] for s, v in scores.iteritems()}
+
+    def assert_scores(self, projected_vds, expected):
+        self.assertEqual([f.name for f in projected_vds.sample_schema.fields[0].typ.fields], ['PC1', 'PC2', 'PC3'])
+        for r in projected_vds.query_samples('samples.map(s => {s: s, pca: sa.pca}).collect()'):
+            for i, pc in enumerate(['PC1', 'PC2', 'PC3']):
+                self.assertAlmostEqual(r.pca[pc], expected[r.s][i])
+
+    def test_pc_project(self):
+        loadings_kt = get_pc_loadings_kt(self.pc_vds)
+        expected = self.expected_scores(loadings_kt)
+        for projected_vds in [pc_project(self.vds, self.pc_vds), pc_project(self.vds, loadings_kt=loadings_kt, n_pcs=3)]:
+            self.assert_scores(projected_vds, expected)
+
+    def test_array_loadings(self):
+        pc_vds = self.pc_vds.annotate_variants_expr('va.pca_loadings = [va.pca_loadings.PC1, va.pca_loadings.PC2, va.pca_loadings.PC3]')
+        loadings_kt = get_pc_loadings_kt(pc_vds)
+        expected = self.expected_scores(get_pc_loadings_kt(self.pc_vds))
+        self.assertEqual(self.expected_scores(loadings_kt), expected)
+        for projected_vds in [pc_project(self.vds, pc_vds), pc_project(self.vds, loadings_kt=loadings_kt)]:
+            self.assert_scores(projected_vds, expected)
+
+    def test_no_loadings(self):
+        pc_vds = self.pc_vds.annotate_variants_expr('va.pca_loadings = NA: Array[Double]')
+        with self.assertRaises(ValueError):
+            get_pc_loadings_kt(pc_vds)
+
+    def test_monomorphic_variants(self):
+        pc_vds = self.pc_vds.annotate_variants_expr('va.af = if (v.start % 5 == 0) 0.0 else 0.25')
+        loadings_kt = get_pc_loadings_kt(pc_vds, pca_af_root='va.af')
+        self.assertEqual(loadings_kt.count(), pc_vds.count_variants())
+        self.assertEqual(loadings_kt.query('norm.filter(x => x == 0.0).count()'), pc_vds.query_variants('variants.filter(v => va.af == 0.0).count()'))
+        self.assert_scores(pc_project(self.vds, loadings_kt=loadings_kt), self.expected_scores(loadings_kt))
+
+    def test_cached_loadings(self):
+        path = os.path.join(tempfile.mkdtemp(prefix='gnomad_hail_'), 'loadings.kt')
+        loadings_kt = get_pc_loadings_kt(self.pc_vds, output_path=path)
+        self.assertTrue(os.path.exists(path + '.fingerprint.json'))
+        self.assertEqual(get_pc_loadings_kt(self.pc_vds, output_path=path).collect(), loadings_kt.collect())
+        self.assertEqual(get_pc_loadings_kt(self.pc_vds.filter_variants_expr('v.start % 2 == 0'), output_path=path).count(),
+                         self.pc_vds.query_variants('variants.filter(v => v.start % 2 == 0).count()'))
+        rescaled_vds = self.pc_vds.annotate_variants_expr('va.pca_loadings.PC3 = 2.0')
+        self.assertEqual(set(get_pc_loadings_kt(rescaled_vds, output_path=path).query('loadings.map(x => x.PC3).collect()')), {2.0})
+
+
+class ConsequenceTests(unittest.TestCase):
+
+    @staticmethod
+    def create_consequence_test_vds():
+        """
+        Generate VDS with VEP transcript consequences and the expected processed consequences
+
+        :return: VDS with VEP annotations and expected values
+        :rtype: VariantDataset
+        """
+        def csq(terms, gene='A', lof=None, lof_flags=None, polyphen=None):
+            return {'allele_num': 1, 'consequence_terms': terms, 'gene_symbol': gene, 'transcript_id': None, 'canonical': 1,
+                    'lof': lof, 'lof_flags': lof_flags, 'polyphen_prediction': polyphen}
+
+        def vep(transcripts):
+            return {'allele_string': None, 'transcript_consequences': transcripts, 'intergenic_consequences': [],
+                    'motif_feature_consequences': [], 'regulatory_feature_consequences': []}
+
+        rows = [
+            {'v': Variant.parse('1:10000:A:T'), 'vep': vep([csq(['missense_variant', 'splice_region_variant'], 'A', polyphen='benign'), csq(['stop_gained'], 'B', 'HC', '')]),
+             'exp_msc': ['missense_variant', 'stop_gained'], 'exp_worst_csq': 'stop_gained', 'exp_suffix': 'stop_gained-HC', 'exp_lof': True, 'exp_genes': {'B'}},
+            {'v': Variant.parse('1:10001:A:T'), 'vep': vep([csq(['synonymous_variant'], 'A'), csq(['synonymous_variant'], 'C', polyphen='possibly_damaging')]),
+             'exp_msc': ['synonymous_variant', 'synonymous_variant'], 'exp_worst_csq': 'synonymous_variant', 'exp_suffix': 'synonymous_variant-possibly_damaging', 'exp_lof': False, 'exp_genes': {'A', 'C'}},
+            {'v': Variant.parse('1:10002:A:T'), 'vep': vep([csq(['intron_variant'], 'A', 'HC', 'SINGLE_EXON')]),
+             'exp_msc': ['intron_variant'], 'exp_worst_csq': 'intron_variant', 'exp_suffix': 'intron_variant-HC-flag', 'exp_lof': True, 'exp_genes': {'A'}},
+            {'v': Variant.parse('1:10003:A:T'), 'vep': vep([csq(['missense_variant'], 'A', 'LC'), csq(['frameshift_variant'], 'B', polyphen='probably_damaging')]),
+             'exp_msc': ['missense_variant', 'frameshift_variant'], 'exp_worst_csq': 'frameshift_variant', 'exp_suffix': 'frameshift_variant-LC', 'exp_lof': False, 'exp_genes': {'B'}},
+            {'v': Variant.parse('1:10004:A:T'), 'vep': vep([csq(['intergenic_variant'], 'A', lof='HC')]),
+             'exp_msc': ['intergenic_variant'], 'exp_worst_csq': 'intergenic_variant', 'exp_suffix': 'intergenic_variant-HC-flag', 'exp_lof': True, 'exp_genes': {'A'}},
+            {'v': Variant.parse('1:10005:A:T'), 'vep': vep([csq(['not_a_consequence'], 'A')]),
+             'exp_msc': [None], 'exp_worst_csq': None, 'exp_suffix': None, 'exp_lof': None, 'exp_genes': set()},
+            {'v': Variant.parse('1:10006:A:T'), 'vep': vep([]),
+             'exp_msc': [], 'exp_worst_csq': None, 'exp_suffix': None, 'exp_lof': None, 'exp_genes': set()},
+        ]
+        schema = ['v', 'vep', 'exp_msc', 'exp_worst_csq', 'exp_suffix', 'exp_lof', 'exp_genes']
+        types = [TVariant(), VEP_TYPE, TArray(TString()), TString(), TString(), TBoolean(), TSet(TString())]
+        return VariantDataset.from_table(KeyTable.from_py(hc, rows, TStruct(schema, types), key_names=['v']))
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vds = cls.create_consequence_test_vds()
+
+    def check_processed_consequences(self, vds):
+        results = vds.query_variants('variants.map(v => {v: v, vep: va.vep, exp_msc: va.exp_msc, exp_worst_csq: va.exp_worst_csq, '
+                                     'exp_suffix: va.exp_suffix, exp_lof: va.exp_lof, exp_genes: va.exp_genes}).collect()')
+        for r in results:
+            self.assertEqual([x.most_severe_consequence for x in r.vep.transcript_consequences], r.exp_msc, str(r.v))
+            self.assertEqual(r.vep.worst_csq, r.exp_worst_csq, str(r.v))
+            self.assertEqual(r.vep.worst_csq_suffix, r.exp_suffix, str(r.v))
+            self.assertEqual(r.vep.lof, r.exp_lof, str(r.v))
+            self.assertEqual(r.vep.worst_csq_genes, r.exp_genes, str(r.v))
+
+    def test_process_consequences(self):
+        proc_vds = process_consequences(self.vds, genes_to_string=False)
+        vep_fields = [f.name for f in get_ann_type('va.vep', proc_vds.variant_schema).fields]
+        self.assertEqual(vep_fields, [f.name for f in VEP_TYPE.fields] + ['worst_csq', 'worst_csq_suffix', 'lof', 'worst_csq_genes'])
+        self.check_processed_consequences(proc_vds)
+
+    def test_reprocess_consequences(self):
+        proc_vds = process_consequences(self.vds, genes_to_string=False)
+        reproc_vds = process_consequences(proc_vds, genes_to_string=False)
+        self.assertEqual(proc_vds.variant_schema, reproc_vds.variant_schema)
+        self.check_processed_consequences(reproc_vds)
+
+
+class SubsetTests(unittest.TestCase):
+
+    def test_sample_subset(self):
+        sample_ids = ['sample_%d' % i for i in range(100)]
+        subset = sample_subset(sample_ids, sample_fraction=0.1, seed=1)
+        self.assertEqual(len(subset), 10)
+        self.assertTrue(set(subset) <= set(sample_ids))
+        self.assertEqual(subset, sample_subset(list(reversed(sample_ids)), n_samples=10, seed=1))
+        self.assertNotEqual(subset, sample_subset(sample_ids, n_samples=10, seed=2))
+        self.assertEqual(len(sample_subset(sample_ids, n_samples=1000)), 100)
+        self.assertRaises(DataException, sample_subset, sample_ids, 0.1, 10)
+
+    def test_subset_intervals(self):
+        vds = create_synthetic_vds(hc, n_variants=100, n_samples=5)
+        self.assertEqual(vds.filter_intervals(get_subset_intervals(contigs=['1'])).count_variants(), 100)
+        self.assertEqual(vds.filter_intervals(get_subset_intervals(contigs=[2])).count_variants(), 0)
+        intervals = get_subset_intervals(intervals=['1:10000-10099', Interval.parse('1:10500-10509')])
+        self.assertEqual(vds.filter_intervals(intervals).count_variants(), 11)
+
+
+class CheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='gnomad_hail_')
+        self.input_path = os.path.join(self.tmp_dir, 'input.vds')
+        create_synthetic_vds(hc, n_variants=20, n_samples=5).write(self.input_path)
+        self.cache = CheckpointCache(os.path.join(self.tmp_dir, 'checkpoints'))
+
+    def build(self):
+        return hc.read(self.input_path).annotate_variants_expr('va.n_called = gs.filter(g => g.isCalled).count()')
+
+    def test_checkpoint_vds(self):
+        vds = self.cache.checkpoint_vds(hc, self.build, {'step': 'n_called'}, [self.input_path])
+        self.assertEqual(self.cache.stats['misses'], 1)
+        reread_vds = self.cache.checkpoint_vds(hc, self.build, {'step': 'n_called'}, [self.input_path])
+        self.assertEqual(self.cache.stats['hits'], 1)
+        self.assertEqual(vds.variant_schema, reread_vds.variant_schema)
+        self.assertEqual(self.build().query_variants('variants.map(v => {v: v, n: va.n_called}).collect()'),
+                         reread_vds.query_variants('variants.map(v => {v: v, n: va.n_called}).collect()'))
+
+
+class VEPCacheTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.vep_config = write_vep_stub_config()
+        cls.vds = create_synthetic_vds(hc, n_variants=40, n_samples=5, multi_allelic_fraction=0.2)
+
+    def setUp(self):
+        self.cache = VEPCache(tempfile.mkdtemp(prefix='gnomad_hail_'), self.vep_config)
+        self.vep_calls = []
+
+    def vep_func(self, vds):
+        self.vep_calls.append(vds.count_variants())
+        return vds.vep(self.vep_config)
+
+    def test_anti_join(self):
+        first_vds = self.vds.filter_variants_expr('v.start < 10200')
+        self.cache.annotate(first_vds, vep_func=self.vep_func)
+        vep_vds = self.cache.annotate(self.vds, vep_func=self.vep_func)
+        self.assertEqual(self.vep_calls, [20, 20])
+        self.assertEqual(len(self.cache.load_manifest()['shards']), 2)
+
+        self.cache.annotate(self.vds, vep_func=self.vep_func)
+        self.assertEqual(self.vep_calls, [20, 20])
+
+        expected = self.vds.vep(self.vep_config).query_variants('variants.map(v => {v: v, vep: va.vep}).collect()')
+        result = vep_vds.query_variants('variants.map(v => {v: v, vep: va.vep}).collect()')
+        self.assertEqual({r.v: r.vep for r in result}, {r.v: r.vep for r in expected})
+
+    def test_compact(self):
+        self.cache.annotate(self.vds.filter_variants_expr('v.start < 10200'), vep_func=self.vep_func)
+        self.cache.annotate(self.vds, vep_func=self.vep_func)
+        self.cache.compact(hc)
+        self.assertEqual(len(self.cache.load_manifest()['shards']), 1)
+        self.assertEqual(self.cache.read(hc).count_variants(), 40)
+
+    def test_config_mismatch(self):
+        self.cache.annotate(self.vds, vep_func=self.vep_func)
+        with self.assertRaises(ValueError):
+            VEPCache(self.cache.root, 'other.properties').read(hc)
+
+
 class VEPTests(unittest.TestCase):
 
     @staticmethod
@@ -3,13 +3,23 @@ import re
 import sys
 import logging
 import gzip
+import json
 import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import uuid
+import zlib
 
 from resources import *
+from cache_utils import *
 from hail import *
 from hail.expr import Field
 from slack_utils import *
+from profile_utils import *
 from collections import defaultdict, namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 from pprint import pprint, pformat
 
 logging.basicConfig(format="%(levelname)s (%(name)s %(lineno)s): %(message)s")
@@ -92,6 +102,16 @@ CSQ_NON_CODING = [
 
 CSQ_ORDER = CSQ_CODING_HIGH_IMPACT + CSQ_CODING_MEDIUM_IMPACT + CSQ_CODING_LOW_IMPACT + CSQ_NON_CODING
 
+# Suffixes added to the worst consequence (most severe first) when any transcript matches the criteria
+CSQ_SUFFIXES = [
+    ('-HC', 'x.lof == "HC" && x.lof_flags == ""'),
+    ('-HC-flag', 'x.lof == "HC"'),
+    ('-LC', 'x.lof == "LC"'),
+    ('-probably_damaging', 'x.polyphen_prediction == "probably_damaging"'),
+    ('-possibly_damaging', 'x.polyphen_prediction == "possibly_damaging"'),
+    ('-benign', 'x.polyphen_prediction == "benign"')
+]
+
 
 def cut_allele_from_g_array(target, destination=None):
     if destination is None: destination = target
@@ -152,7 +172,72 @@ def unfurl_filter_alleles_annotation(a_based=None, r_based=None, g_based=None, a
 
 
 def filter_to_adj(vds):
-    return vds.filter_genotypes(ADJ_CRITERIA)
+    """
+    Filters genotypes to adj (see ADJ_CRITERIA), using the precomputed adj bit for packed hardcalls (see `pack_hardcalls`)
+
+    :param VariantDataset vds: Input VDS
+    :return: VDS with non-adj genotypes set to missing
+    :rtype: VariantDataset
+    """
+    return vds.filter_genotypes(get_adj_expr(vds))
+
+
+def pack_hardcalls(vds, adj_expr=ADJ_CRITERIA):
+    """
+    Converts genotypes to a packed hardcalls representation: `g = {GT: Call, adj: Boolean}`, where `adj` is
+    precomputed from `adj_expr` so that adj genotypes can be selected without re-evaluating the criteria.
+
+    :param VariantDataset vds: Input VDS
+    :param str adj_expr: Expression for adj genotypes
+    :return: VDS with packed hardcalls
+    :rtype: VariantDataset
+    """
+    return vds.annotate_genotypes_expr('g = {GT: g.call(), adj: orElse(%s, false)}' % adj_expr)
+
+
+def is_packed_hardcalls(vds):
+    """
+    :param VariantDataset vds: Input VDS
+    :return: Whether the VDS genotypes are packed hardcalls (see `pack_hardcalls`)
+    :rtype: bool
+    """
+    schema = vds.genotype_schema
+    return isinstance(schema, TStruct) and [f.name for f in schema.fields] == ['GT', 'adj']
+
+
+def get_call_expr(vds):
+    """
+    :param VariantDataset vds: Input VDS
+    :return: Expression for the genotype call, for either full genotypes or packed hardcalls
+    :rtype: str
+    """
+    return 'g.GT' if is_packed_hardcalls(vds) else 'g'
+
+
+def get_adj_expr(vds):
+    """
+    :param VariantDataset vds: Input VDS
+    :return: Expression for adj genotypes, for either full genotypes or packed hardcalls
+    :rtype: str
+    """
+    return 'g.adj' if is_packed_hardcalls(vds) else ADJ_CRITERIA
+
+
+@profiled()
+def write_hardcalls(vds, data_type, hail_version=CURRENT_HAIL_VERSION, overwrite=False):
+    """
+    Writes the unsplit and split packed hardcalls datasets (see `pack_hardcalls` and `packed_hardcalls_vds_path`).
+    These contain both raw and adj data: adj data is read with `get_gnomad_data(hardcalls='adj', packed_hardcalls=True)`.
+
+    :param VariantDataset vds: Full (raw) VDS
+    :param str data_type: One of `exomes` or `genomes`
+    :param str hail_version: One of the HAIL_VERSIONs
+    :param bool overwrite: Whether to overwrite existing datasets
+    """
+    for split in [False, True]:
+        path = packed_hardcalls_vds_path(data_type, split, hail_version)
+        logger.info("Writing packed hardcalls to %s", path)
+        pack_hardcalls(vds.split_multi() if split else vds).write(path, overwrite=overwrite)
 
 
 def filter_star(vds, a_based=None, r_based=None, g_based=None, additional_annotations=None):
@@ -207,6 +292,83 @@ def flatten_struct(struct, root='va', leaf_only=True, recursive=True):
     return result
 
 
+class SchemaIndex(object):
+    """
+    Index of the annotations of a schema (see `get_schema_index`), built once per schema.
+
+    `fields` maps each path to its Field (structs before their leaves, as in `flatten_struct(leaf_only=False)`),
+    `leaves` only contains the leaf paths (as in `flatten_struct`), and groupings by attribute
+    (see `group_annotations_by_attribute`) are memoized.
+    """
+
+    def __init__(self, schema, root='va'):
+        """
+        :param TStruct schema: Schema to index
+        :param str root: Root of the schema
+        """
+        self.schema = schema
+        self.root = root
+        self.fields = flatten_struct(schema, root, leaf_only=False)
+        self.leaves = OrderedDict((path, f) for path, f in self.fields.iteritems() if not isinstance(f.typ, TStruct))
+        self._groupings = {}
+
+    def __contains__(self, path):
+        return path in self.fields
+
+    def get_struct(self, path):
+        """
+        :param str path: Path of a struct annotation, or the root of the schema
+        :return: The struct at `path`
+        :rtype: TStruct
+        """
+        return self.schema if path == self.root else self.fields[path].typ
+
+    def group_by_attribute(self, grouping_key, root, recursive=False, default_func=None):
+        key = (grouping_key, root, recursive, default_func)
+        if key not in self._groupings:
+            annotations = defaultdict(list)
+            for field in self.get_struct(root).fields:
+                path = '{}.{}'.format(root, field.name)
+                if isinstance(field.typ, TArray):
+                    if grouping_key in field.attributes:
+                        annotations[field.attributes[grouping_key]].append(PathAndField(path, field))
+                elif recursive and isinstance(field.typ, TStruct):
+                    for k, v in self.group_by_attribute(grouping_key, path, recursive, default_func).iteritems():
+                        annotations[k].extend(v)
+                elif default_func is not None:
+                    annotations[default_func(field)].append(PathAndField(path, field))
+                else:
+                    annotations[None].append(PathAndField(path, field))
+            self._groupings[key] = annotations
+        return defaultdict(list, ((k, list(v)) for k, v in self._groupings[key].iteritems()))
+
+
+PathAndField = namedtuple('PathAndField', ['path', 'field'])
+
+SCHEMA_INDEX_CACHE_SIZE = 64
+_schema_index_cache = OrderedDict()
+
+
+def get_schema_index(schema, root='va'):
+    """
+    Returns the `SchemaIndex` of a schema, from a small LRU cache keyed by the schema object
+    (e.g. `vds.variant_schema`, which Hail only converts from the JVM once per VDS).
+
+    :param TStruct schema: Schema
+    :param str root: Root of the schema
+    :return: Index of the schema
+    :rtype: SchemaIndex
+    """
+    key = (id(schema), root)
+    index = _schema_index_cache.pop(key, None)
+    if index is None or index.schema is not schema:
+        index = SchemaIndex(schema, root)
+    _schema_index_cache[key] = index
+    if len(_schema_index_cache) > SCHEMA_INDEX_CACHE_SIZE:
+        _schema_index_cache.popitem(last=False)
+    return index
+
+
 def ann_exists(annotation, schema, root='va'):
     """
     Tests whether an annotation (given by its full path) exists in a given schema and its root.
@@ -217,8 +379,7 @@ def ann_exists(annotation, schema, root='va'):
     :return: Whether the annotation was found
     :rtype: bool
     """
-    anns = flatten_struct(schema, root, leaf_only=False)
-    return annotation in anns
+    return annotation in get_schema_index(schema, root)
 
 
 def get_ann_field(annotation, schema, root='va'):
@@ -231,7 +392,7 @@ def get_ann_field(annotation, schema, root='va'):
     :return: The Field corresponding to the input annotation
     :rtype: Field
     """
-    anns = flatten_struct(schema, root, leaf_only=False)
+    anns = get_schema_index(schema, root).fields
     if not annotation in anns:
         logger.error("%s missing from schema.", annotation)
         sys.exit(1)
@@ -299,7 +460,27 @@ def get_variant_type_expr(root="va.variantType"):
             "mixed"''' % root
 
 
-def get_allele_stats_expr(root="va.stats", medians=False, samples_filter_expr=''):
+# Genotype-level metrics summarized by `get_allele_stats_expr`: name -> (genotype filter, genotype value)
+ALLELE_STATS_METRICS = OrderedDict([
+    ('gq', ('g.isCalledNonRef', 'g.gq')),
+    ('dp', ('g.isCalledNonRef', 'g.dp')),
+    ('nrq', ('g.isCalledNonRef', '-log10(g.gp[0])')),
+    ('ab', ('g.isHet', 'g.ad[1]/g.dp')),
+    ('pab', ('g.isHet', 'g.pAB()'))
+])
+
+# Histograms (start, end, bins) used to approximate the medians of ALLELE_STATS_METRICS (see `get_hist_median_expr`).
+# GQ and DP bins are centered on integers, so their approximate medians are exact whenever they are within range.
+ALLELE_STATS_MEDIAN_HISTS = {
+    'gq': (-0.5, 99.5, 100),
+    'dp': (-0.5, 499.5, 500),
+    'nrq': (0.0, 200.0, 400),
+    'ab': (0.0, 1.0, 100),
+    'pab': (0.0, 1.0, 100)
+}
+
+
+def get_allele_stats_expr(root="va.stats", medians=False, samples_filter_expr='', fused=False, approx_medians=False):
     """
 
     Gets allele-specific stats expression: GQ, DP, NRQ, AB, Best AB, p(AB), NRDP, QUAL, combined p(AB)
@@ -307,9 +488,21 @@ def get_allele_stats_expr(root="va.stats", medians=False, samples_filter_expr=''
     :param str root: annotations root
     :param bool medians: Calculate medians for GQ, DP, NRQ, AB and p(AB)
     :param str samples_filter_expr: Expression for filtering samples (e.g. "sa.keep")
+    :param bool fused: Compute all stats with a single expression (see `get_fused_allele_stats_expr`)
+    :param bool approx_medians: Approximate medians from bounded histograms instead of collecting all values (requires `medians`).
+                                Medians are missing when the middle values fall outside the ALLELE_STATS_MEDIAN_HISTS range,
+                                e.g. NRQ medians above 200 (see `get_hist_median_expr`)
     :return: List of expressions for `annotate_alleles_expr`
     :rtype: list of str
     """
+    if approx_medians and not medians:
+        raise ValueError("approx_medians requires medians=True")
+
+    if fused:
+        return [get_fused_allele_stats_expr(root, medians, samples_filter_expr, approx_medians)]
+
+    median_expr = ['%s.%s_median = %s' % (root, metric, get_allele_stats_median_expr(metric, samples_filter_expr, approx_medians))
+                   for metric in ALLELE_STATS_METRICS] if medians else []
 
     if samples_filter_expr:
         samples_filter_expr = "&& " + samples_filter_expr
@@ -324,60 +517,241 @@ def get_allele_stats_expr(root="va.stats", medians=False, samples_filter_expr=''
              '%s.qual = -10*gs.filter(g => g.isCalledNonRef %s).map(g => if(g.pl[0] > 3000) -300 else log10(g.gp[0])).sum()',
              '%s.combined_pAB = let hetSamples = gs.filter(g => g.isHet %s).map(g => log(g.pAB())).collect() in orMissing(!hetSamples.isEmpty, -10*log10(pchisqtail(-2*hetSamples.sum(),2*hetSamples.length)))']
 
-    if medians:
-        stats.extend(['%s.gq_median = gs.filter(g => g.isCalledNonRef %s).map(g => g.gq).collect().median',
-                    '%s.dp_median = gs.filter(g => g.isCalledNonRef %s).map(g => g.dp).collect().median',
-                    '%s.nrq_median = gs.filter(g => g.isCalledNonRef %s).map(g => -log10(g.gp[0])).collect().median',
-                    '%s.ab_median = gs.filter(g => g.isHet %s).map(g => g.ad[1]/g.dp).collect().median',
-                    '%s.pab_median = gs.filter(g => g.isHet %s).map(g => g.pAB()).collect().median'])
-
     stats_expr = [x % (root, samples_filter_expr) for x in stats]
 
-    return stats_expr
+    return stats_expr + median_expr
 
 
-def run_samples_sanity_checks(vds, reference_vds, n_samples=10, verbose=True):
-    logger.info("Running samples sanity checks on %d samples" % n_samples)
+def get_allele_stats_median_expr(metric, samples_filter_expr='', approx=False):
+    """
 
-    comparison_metrics = ['nHomVar',
-                          'nSNP',
-                          'nTransition',
-                          'nTransversion',
-                          'nInsertion',
-                          'nDeletion',
-                          'nNonRef',
-                          'nHet'
-                          ]
+    Gets the expression for the median of one of the ALLELE_STATS_METRICS.
+    Exact medians collect all values for each variant, whereas approximate medians only keep a histogram
+    of ALLELE_STATS_MEDIAN_HISTS[metric] bins (see `get_hist_median_expr` for the error bound).
+
+    :param str metric: One of the ALLELE_STATS_METRICS
+    :param str samples_filter_expr: Expression for filtering samples (e.g. "sa.keep")
+    :param bool approx: Whether to approximate the median
+    :return: Median expression
+    :rtype: str
+    """
+    metric_filter, value = ALLELE_STATS_METRICS[metric]
+    if samples_filter_expr:
+        metric_filter += " && " + samples_filter_expr
+    agg_expr = 'gs.filter(g => %s).map(g => %s)' % (metric_filter, value)
+    if approx:
+        return get_hist_median_expr(agg_expr, *ALLELE_STATS_MEDIAN_HISTS[metric])
+    return agg_expr + '.collect().median'
+
+
+def get_hist_median_expr(agg_expr, start, end, bins):
+    """
+
+    Gets an expression approximating the median of a numeric aggregable using a fixed-bin histogram,
+    so that memory is bounded by the number of bins rather than the number of values.
+
+    The approximate median is the mean of the centers of the bins containing the two middle values, found from the
+    cumulative bin counts (computed once, in a single `scan` over the bins).
+    When both middle values are within [start, end], the error is at most half a bin width: (end - start) / (2 * bins).
+    When either middle value is outside [start, end], the median is missing.
+
+    :param str agg_expr: Numeric aggregable expression (e.g. "gs.map(g => g.dp)")
+    :param float start: Start of the histogram range
+    :param float end: End of the histogram range
+    :param int bins: Number of bins
+    :return: Approximate median expression (Double)
+    :rtype: str
+    """
+    return ('let h = {agg}.hist({start}, {end}, {bins}) in '
+            'let cum = h.binFrequencies.scan(h.nLess)((acc, x) => acc + x)[1:] in '
+            'let n = cum[{last}] + h.nGreater in '
+            'let lo = range({bins}).find(i => cum[i] >= n / 2.0) and '
+            'hi = range({bins}).find(i => cum[i] > n / 2.0) in '
+            'orMissing(n > 0 && h.nLess < n / 2.0, {start} + ((lo + hi) / 2.0 + 0.5) * {width})'.format(
+        agg=agg_expr, start=float(start), end=float(end), bins=bins, last=bins - 1, width=float(end - start) / bins))
+
+
+def get_fused_allele_stats_expr(root="va.stats", medians=False, samples_filter_expr='', approx_medians=False):
+    """
+
+    Gets the allele-specific stats of `get_allele_stats_expr` as a single expression.
+    Each genotype value is computed once and all sums (and sums of squares) are accumulated in one array `sum()`
+    aggregation, from which mean, stdev, nNotMissing, sum, NRDP, QUAL and combined p(AB) are derived.
+    Only min / max (and medians if requested) use their own aggregators, and combined p(AB) no longer collects
+    the het genotypes.
+
+    The resulting `root` struct has the same fields and types as the one produced by `get_allele_stats_expr`
+    when used with `annotate_variants_expr` (note that any other field already present in `root` is overwritten).
+    Means and standard deviations are computed from sums and may differ from `stats()` by floating-point rounding.
+
+    :param str root: annotations root
+    :param bool medians: Calculate medians for GQ, DP, NRQ, AB and p(AB)
+    :param str samples_filter_expr: Expression for filtering samples (e.g. "sa.keep")
+    :param bool approx_medians: Approximate medians from bounded histograms instead of collecting all values (requires `medians`,
+                                see `get_allele_stats_expr` for out-of-range values)
+    :return: Expression for `annotate_variants_expr`
+    :rtype: str
+    """
+    if approx_medians and not medians:
+        raise ValueError("approx_medians requires medians=True")
+
+    median_fields = [('%s_median' % metric, get_allele_stats_median_expr(metric, samples_filter_expr, approx_medians))
+                     for metric in ALLELE_STATS_METRICS] if medians else []
+
+    if samples_filter_expr:
+        samples_filter_expr = "&& " + samples_filter_expr
+
+    moments = []
+
+    def add_moment(expr):
+        moments.append(expr)
+        return 'm[%d]' % (len(moments) - 1)
+
+    genotype_values = OrderedDict([(k, 'if (%s) (%s).toDouble else NA: Double' % (f, v) if f == 'g.isHet' else '(%s).toDouble' % v)
+                                   for k, (f, v) in ALLELE_STATS_METRICS.iteritems()])
+    genotype_values['qual'] = 'if(g.pl[0] > 3000) -300.0 else log10(g.gp[0])'
+
+    aggs = OrderedDict()
+    fields = OrderedDict()
+    for metric, (metric_filter, value) in ALLELE_STATS_METRICS.iteritems():
+        n = add_moment('if (isDefined(%s)) 1.0 else 0.0' % metric)
+        s = add_moment('orElse(%s, 0.0)' % metric)
+        ss = add_moment('orElse(%s * %s, 0.0)' % (metric, metric))
+        for f in ['min', 'max']:
+            aggs['%s_%s' % (metric, f)] = 'gs.filter(g => %s %s).map(g => (%s).toDouble).%s()' % (metric_filter, samples_filter_expr, value, f)
+        fields[metric] = ('orMissing({n} > 0, {{mean: {s} / {n}, stdev: sqrt(max({ss} / {n} - ({s} / {n}) * ({s} / {n}), 0.0)), '
+                          'min: {metric}_min, max: {metric}_max, nNotMissing: {n}.toLong, sum: {s}}})'.format(metric=metric, n=n, s=s, ss=ss))
+        if metric == 'ab':
+            aggs['best_ab'] = 'gs.filter(g => g.isHet %s).map(g => abs((g.ad[1]/g.dp) - 0.5)).min()' % samples_filter_expr
+            fields['best_ab'] = 'best_ab'
+
+    fields['nrdp'] = '%s.toInt' % add_moment('orElse(dp, 0.0)')
+    fields['qual'] = '-10*%s' % add_moment('orElse(qual, 0.0)')
+    n_het = add_moment('if (g.isHet) 1.0 else 0.0')
+    sum_log_pab = add_moment('orElse(log(pab), 0.0)')
+    fields['combined_pAB'] = 'orMissing({0} > 0, -10*log10(pchisqtail(-2*{1},2*{0})))'.format(n_het, sum_log_pab)
+
+    fields.update(median_fields)
+
+    # The sum is missing when no genotype passes the filter: default to zeros so that NRDP and QUAL are 0 as in `get_allele_stats_expr`
+    moments_agg = 'orElse(gs.filter(g => g.isCalledNonRef %s).map(g => let %s in [%s]).sum(), [%s])' % (
+        samples_filter_expr,
+        ' and '.join(['%s = %s' % (k, v) for k, v in genotype_values.iteritems()]),
+        ', '.join(moments),
+        ', '.join(['0.0'] * len(moments)))
+
+    return '%s = let m = %s and %s in {%s}' % (root,
+                                               moments_agg,
+                                               ' and '.join(['%s = %s' % (k, v) for k, v in aggs.iteritems()]),
+                                               ', '.join(['%s: %s' % (k, v) for k, v in fields.iteritems()]))
+
+
+SAMPLE_QC_METRICS = OrderedDict([
+    ('nHomVar', 'if (c.isHomVar) 1 else 0'),
+    ('nSNP', 'alts.filter(a => a.isSNP).length'),
+    ('nTransition', 'alts.filter(a => a.isTransition).length'),
+    ('nTransversion', 'alts.filter(a => a.isTransversion).length'),
+    ('nInsertion', 'alts.filter(a => a.isInsertion).length'),
+    ('nDeletion', 'alts.filter(a => a.isDeletion).length'),
+    ('nNonRef', 'if (c.isCalledNonRef) 1 else 0'),
+    ('nHet', 'if (c.isHet) 1 else 0')
+])
+
+
+def get_sample_qc_metrics_expr(root='sa.qc', metrics=SAMPLE_QC_METRICS.keys(), call_expr='g'):
+    """
+    Returns an expression computing a subset of the `sample_qc` metrics (see `SAMPLE_QC_METRICS`) in a single
+    array `sum()` aggregation.
+
+    :param str root: Annotation root
+    :param list of str metrics: Metrics to compute
+    :param str call_expr: Expression for the genotype call (see `get_call_expr`)
+    :return: Expression for `annotate_samples_expr`
+    :rtype: str
+    """
+    return ('{root} = let m = gs.map(g => {call}).filter(c => c.isCalled).map(c => '
+            'let alts = [c.gtj, c.gtk].filter(a => a > 0).map(a => v.altAlleles[a - 1]) in [{values}]).sum() in '
+            '{{{fields}}}'.format(root=root, call=call_expr,
+                                  values=', '.join([SAMPLE_QC_METRICS[metric] for metric in metrics]),
+                                  fields=', '.join(['%s: m[%d]' % (metric, i) for i, metric in enumerate(metrics)])))
+
+
+SampleMetricDiff = namedtuple('SampleMetricDiff', ['sample', 'metric', 'data', 'reference'])
+
+
+class SamplesSanityChecks(object):
+    """
+    Result of `run_samples_sanity_checks`: the metrics that match (`matches`) and differ (`failures`) between the data
+    and reference, as lists of `SampleMetricDiff`, and the samples missing from the reference (`missing_samples`).
+    """
+
+    def __init__(self, matches, failures, missing_samples, verbose=True):
+        self.matches = matches
+        self.failures = failures
+        self.missing_samples = missing_samples
+        self.verbose = verbose
+
+    @property
+    def passed(self):
+        return not self.failures and not self.missing_samples
+
+    def __str__(self):
+        output = ''
+        for s in self.missing_samples:
+            output += "WARN: Sample %s not found in reference data.\n" % s
+        if self.verbose:
+            for x in self.matches:
+                output += "SUCCESS: Sample %s %s matches (N = %d).\n" % (x.sample, x.metric, x.data)
+        for x in self.failures:
+            output += "FAILURE: Sample %s, %s differs: Data: %s, Reference: %s.\n" % (x.sample, x.metric, x.data, x.reference)
+        return output
+
+
+@profiled()
+def run_samples_sanity_checks(vds, reference_vds, n_samples=10, verbose=True, use_sample_qc=False):
+    """
+    Compares the `sample_qc` metrics of `SAMPLE_QC_METRICS` between `vds` and `reference_vds` for the first
+    `n_samples` samples of `vds`. Both datasets are restricted to these samples and processed concurrently,
+    with all metrics computed in a single aggregation (see `get_sample_qc_metrics_expr`).
+
+    :param VariantDataset vds: Data to check
+    :param VariantDataset reference_vds: Reference data
+    :param int n_samples: Number of samples to compare
+    :param bool verbose: Whether the output should also list matching metrics
+    :param bool use_sample_qc: Compute the metrics with a full `sample_qc()` instead
+    :return: Comparison results (its string representation lists the successes and failures)
+    :rtype: SamplesSanityChecks
+    """
+    logger.info("Running samples sanity checks on %d samples" % n_samples)
 
     samples = vds.sample_ids[:n_samples]
 
-    def get_samples_metrics(vds, samples):
-        metrics = (vds.filter_samples_expr('["%s"].toSet.contains(s)' % '","'.join(samples))
-                   .sample_qc()
-                   .query_samples('samples.map(s => {sample: s, metrics: sa.qc }).collect()')
-                   )
+    def get_samples_metrics(vds):
+        vds = vds.filter_samples_list(samples)
+        vds = vds.sample_qc() if use_sample_qc else vds.annotate_samples_expr(get_sample_qc_metrics_expr(call_expr=get_call_expr(vds)))
+        metrics = vds.query_samples('samples.map(s => {sample: s, metrics: sa.qc }).collect()')
         return {x.sample: x.metrics for x in metrics}
 
-    test_metrics = get_samples_metrics(vds, samples)
-    ref_metrics = get_samples_metrics(reference_vds, samples)
+    pool = ThreadPool(2)
+    try:
+        test_metrics, ref_metrics = pool.map(bind_to_step(get_samples_metrics), [vds, reference_vds])
+    finally:
+        pool.close()
 
-    output = ''
-
-    for s, m in test_metrics.iteritems():
+    matches, failures, missing_samples = [], [], []
+    for s in samples:
+        if s not in test_metrics:
+            continue
         if s not in ref_metrics:
-            output += "WARN: Sample %s not found in reference data.\n" % s
+            missing_samples.append(s)
         else:
-            rm = ref_metrics[s]
-            for metric in comparison_metrics:
-                if m[metric] == rm[metric]:
-                    if verbose:
-                        output += "SUCCESS: Sample %s %s matches (N = %d).\n" % (s, metric, m[metric])
-                else:
-                    output += "FAILURE: Sample %s, %s differs: Data: %s, Reference: %s.\n" % (
-                        s, metric, m[metric], rm[metric])
+            for metric in SAMPLE_QC_METRICS:
+                diff = SampleMetricDiff(s, metric, test_metrics[s][metric], ref_metrics[s][metric])
+                (matches if diff.data == diff.reference else failures).append(diff)
 
-    logger.info(output)
-    return output
+    result = SamplesSanityChecks(matches, failures, missing_samples, verbose)
+    logger.info(str(result))
+    return result
 
 
 def merge_schemas(vdses):
@@ -392,7 +766,7 @@ def merge_schemas(vdses):
     if not isinstance(vds_schemas[0], TStruct):
         return vdses
 
-    anns = [flatten_struct(s, root='va') for s in vds_schemas]
+    anns = [get_schema_index(s).leaves for s in vds_schemas]
 
     all_anns = {}
     for i in reversed(range(len(vds_schemas))):
@@ -405,27 +779,44 @@ def merge_schemas(vdses):
                 sys.exit(1)
         all_anns.update(anns[i])
 
+    merged_vdses = []
     for i, vds in enumerate(vdses):
-        vds = vds.annotate_variants_expr(["%s = NA: %s" % (k, str(v.typ)) for k, v in
-                                          all_anns.iteritems() if k not in anns[i]])
-        for ann, f in all_anns.iteritems():
-            vds = vds.set_va_attributes(ann, f.attributes)
+        missing_anns = ["%s = NA: %s" % (k, str(v.typ)) for k, v in all_anns.iteritems() if k not in anns[i]]
+        if missing_anns:
+            vds = vds.annotate_variants_expr(missing_anns)
+        merged_vdses.append(update_va_attributes(vds, OrderedDict((ann, f.attributes) for ann, f in all_anns.iteritems())))
 
-    return vdses
+    return merged_vdses
 
 
-def copy_schema_attributes(vds1, vds2):
-    anns1 = flatten_struct(vds1.variant_schema, root='va')
-    anns2 = flatten_struct(vds2.variant_schema, root='va')
-    for ann in anns1.keys():
-        if ann in anns2:
-            vds1 = vds1.set_va_attributes(ann, anns2[ann].attributes)
+def update_va_attributes(vds, attributes):
+    """
+    Sets the attributes of many variant annotations.
+    Each `set_va_attributes` call creates a new dataset on the JVM, so the requested attributes are first diffed against
+    the current schema and only the annotations whose attributes actually change are updated.
+    Hail 0.1 has no bulk attribute setter, so this still makes one `set_va_attributes` call (one py4j round-trip) per
+    changed annotation: e.g. merging attributes into a dataset that has none costs one call per field.
 
-    return vds1
+    :param VariantDataset vds: Input VDS
+    :param dict of str:dict attributes: Annotation path (e.g. `va.info.AC`) -> attributes
+    :return: VDS with updated attributes
+    :rtype: VariantDataset
+    """
+    current = get_schema_index(vds.variant_schema).fields
+    for ann, attrs in attributes.iteritems():
+        if ann in current and dict(current[ann].attributes) != dict(attrs):
+            vds = vds.set_va_attributes(ann, attrs)
+    return vds
+
+
+def copy_schema_attributes(vds1, vds2):
+    anns1 = get_schema_index(vds1.variant_schema).leaves
+    anns2 = get_schema_index(vds2.variant_schema).leaves
+    return update_va_attributes(vds1, {ann: anns2[ann].attributes for ann in anns1 if ann in anns2})
 
 
 def print_attributes(vds, path=None):
-    anns = flatten_struct(vds.variant_schema, root='va')
+    anns = get_schema_index(vds.variant_schema).leaves
     if path is not None:
         print "%s attributes: %s" % (path, anns[path].attributes)
     else:
@@ -433,6 +824,23 @@ def print_attributes(vds, path=None):
             print "%s attributes: %s" % (ann, f.attributes)
 
 
+def default_number(field):
+    """
+    Returns the default VCF `Number` of a field based on its type (e.g. `TBoolean` -> `0`, `TInt` -> `1`, `TArray` -> `.`)
+
+    :param Field field: Field
+    :return: Default Number, or None if the field cannot be natively exported to VCF
+    :rtype: str
+    """
+    if isinstance(field.typ, TArray) or isinstance(field.typ, TSet):
+        return '.'
+    elif isinstance(field.typ, TBoolean):
+        return '0'
+    elif annotation_type_in_vcf_info(field.typ):
+        return '1'
+    return None
+
+
 def get_numbered_annotations(schema , root='va', recursive = False, default_when_missing = True):
     """
         Get numbered annotations from a VDS variant schema based on their `Number` va attributes.
@@ -446,16 +854,7 @@ def get_numbered_annotations(schema , root='va', recursive = False, default_when
     :rtype: dict of namedtuple(str path, Field field)
     """
 
-    def default_values(field):
-        if isinstance(field.typ, TArray) or isinstance(field.typ, TSet):
-            return '.'
-        elif isinstance(field.typ, TBoolean):
-            return '0'
-        elif annotation_type_in_vcf_info(field.typ):
-            return '1'
-        return None
-
-    annotations = group_annotations_by_attribute(schema, 'Number', root, recursive, default_values if default_when_missing else None)
+    annotations = group_annotations_by_attribute(schema, 'Number', root, recursive, default_number if default_when_missing else None)
     logger.info("Found the following fields:")
     for k, v in annotations.iteritems():
         if k is not None:
@@ -478,29 +877,7 @@ def group_annotations_by_attribute(schema, grouping_key, root='va', recursive =
     :return: Dictionary containing annotations
     :rtype: dict of namedtuple(str path, Field field)
     """
-    annotations = defaultdict(list)
-    PathAndField = namedtuple('PathAndField', ['path','field'])
-
-    if '.' in root:
-        fields = get_ann_type(root, schema)
-    else:
-        fields = schema
-
-    for field in fields.fields:
-        path = '{}.{}'.format(root, field.name)
-        if isinstance(field.typ, TArray):
-            if grouping_key in field.attributes:
-                annotations[field.attributes[grouping_key]].append(PathAndField(path, field))
-        elif recursive and isinstance(field.typ, TStruct):
-            f_annotations = group_annotations_by_attribute(schema, grouping_key, path, recursive, default_func)
-            for k,v in f_annotations.iteritems():
-                annotations[k].extend(v)
-        elif default_func is not None:
-            annotations[default_func(field)].append(PathAndField(path, field))
-        else:
-            annotations[None].append(PathAndField(path, field))
-
-    return annotations
+    return get_schema_index(schema, root.split('.')[0]).group_by_attribute(grouping_key, root, recursive, default_func)
 
 
 def filter_annotations_regex(annotation_fields, ignore_list):
@@ -511,157 +888,1052 @@ def filter_annotations_regex(annotation_fields, ignore_list):
     return [x for x in annotation_fields if not ann_in(x.name, ignore_list)]
 
 
-def pc_project(vds, pc_vds, pca_loadings_root='va.pca_loadings'):
+def prepare_vcf_info(vds, info_root='va.info', ignore=[]):
+    """
+    Prepares the `info_root` annotations for VCF export: drops the fields matching the `ignore` regexes and sets the
+    default `Number` attribute (see `default_number`, e.g. `.` for arrays and sets) on the fields that don't have one,
+    so that the exported header has proper `Number=` entries.
+
+    :param VariantDataset vds: Input VDS
+    :param str info_root: Root of the INFO annotations
+    :param list of str ignore: Regexes of the INFO fields to drop
+    :return: VDS ready for export
+    :rtype: VariantDataset
+    """
+    info = get_ann_field(info_root, vds.variant_schema)
+    fields = filter_annotations_regex(info.typ.fields, ignore)
+    if len(fields) < len(info.typ.fields):
+        vds = vds.annotate_variants_expr('{0} = select({0}, {1})'.format(info_root, ",".join(f.name for f in fields)))
+    attributes = {}
+    for field in get_ann_type(info_root, vds.variant_schema).fields:
+        number = default_number(field)
+        if number is not None and 'Number' not in field.attributes:
+            attributes['%s.%s' % (info_root, field.name)] = dict(field.attributes, Number=number)
+    return update_va_attributes(vds, attributes)
+
+
+def contig_sort_key(contig):
+    """
+    Sort key for contigs in karyotypic order (1, 2, ..., 22, X, Y, MT), with or without `chr` prefix
+
+    :param str contig: Contig name
+    :return: Sort key
+    :rtype: tuple
+    """
+    c = contig[3:] if contig.startswith('chr') else contig
+    return (0, int(c), '') if c.isdigit() else (1, ['X', 'Y', 'M', 'MT'].index(c) if c in ['X', 'Y', 'M', 'MT'] else 4, c)
+
+
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+BGZF_BLOCK_SIZE = 0xff00
+GSUTIL_COMPOSE_MAX_COMPONENTS = 32
+
+
+def bgzf_compress(data):
+    """
+    Compresses data as BGZF blocks of at most `BGZF_BLOCK_SIZE` uncompressed bytes (without the end-of-file block)
+
+    :param str data: Data to compress
+    :return: BGZF blocks
+    :rtype: str
+    """
+    blocks = []
+    for start in range(0, len(data), BGZF_BLOCK_SIZE):
+        chunk = data[start:start + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        cdata = compressor.compress(chunk) + compressor.flush()
+        blocks.append(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25) + cdata +
+                      struct.pack('<II', zlib.crc32(chunk) & 0xffffffff, len(chunk)))
+    return ''.join(blocks)
+
+
+def read_bgzf_block(f):
+    """
+    Reads the next BGZF block of a binary stream
+
+    :param file f: Binary stream
+    :return: Compressed block and its decompressed content, or None at the end of the stream
+    :rtype: (str, str)
+    """
+    header = f.read(18)
+    if not header:
+        return None
+    if len(header) < 18 or header[:4] != '\x1f\x8b\x08\x04' or header[12:14] != 'BC':
+        raise ValueError("Input is not block-gzipped (BGZF)")
+    block = header + f.read(struct.unpack('<H', header[16:18])[0] - 17)
+    return block, zlib.decompress(block[18:-8], -15)
+
+
+def split_bgzf_vcf_header(f):
     """
-    Projects samples in `vds` on PCs computed in `pc_vds`
-    :param vds: VDS containing the samples to project
-    :param pc_vds: VDS containing the PC loadings for the variants
-    :param pca_loadings_root: Annotation root for the loadings. Can be either an Array[Double] or a Struct{ PC1: Double, PC2: Double, ...}
-    :return: VDS with
+    Reads the header of a block-gzipped VCF from a binary stream, decompressing only the blocks containing header lines
+
+    :param file f: Binary stream, at the start of the VCF
+    :return: The header, the records sharing a block with the header (recompressed with `bgzf_compress`, possibly empty)
+             and the offset of the first block containing only records
+    :rtype: (str, str, int)
     """
+    text = ''
+    pos = offset = 0
+    while True:
+        block = read_bgzf_block(f)
+        if block is None:
+            return text, '', offset
+        raw, data = block
+        if pos == len(text) and data and not data.startswith('#'):
+            return text, '', offset
+        text += data
+        offset += len(raw)
+        while pos < len(text) and text[pos] == '#':
+            end = text.find('\n', pos)
+            if end == -1:
+                break
+            pos = end + 1
+        else:
+            if pos < len(text):
+                return text[:pos], bgzf_compress(text[pos:]), offset
 
-    pca_loadings_type = get_ann_type(pca_loadings_root, pc_vds.variant_schema)  # TODO: this isn't used?
 
-    pc_vds = pc_vds.annotate_variants_expr('va.pca.calldata = gs.callStats(g => v)')
+def _local_path(path):
+    return path[len('file://'):] if path.startswith('file://') else path
 
-    pcs_struct_to_array = ",".join(['vds.pca_loadings.PC%d' % x for x in range(1, 21)])
-    arr_to_struct_expr = ",".join(['PC%d: sa.pca[%d - 1]' % (x, x) for x in range(1, 21)])
 
-    vds = (vds.filter_multi()
-           .annotate_variants_vds(pc_vds, expr = 'va.pca_loadings = [%s], va.pca_af = vds.pca.calldata.AF[1]' % pcs_struct_to_array)
-           .filter_variants_expr('!isMissing(va.pca_loadings) && !isMissing(va.pca_af)')
-     )
+def read_vcf_shard_header(path):
+    """
+    Reads the header of a block-gzipped VCF (see `split_bgzf_vcf_header`). Remote files are streamed with `gsutil cat`.
 
-    n_variants = vds.query_variants(['variants.count()'])[0]
+    :param str path: Path to the .vcf.bgz file
+    :return: The header, the records sharing a block with the header (BGZF) and the offset of the first block containing only records
+    :rtype: (str, str, int)
+    """
+    if not is_remote_path(path):
+        with open(_local_path(path), 'rb') as f:
+            return split_bgzf_vcf_header(f)
+    proc = subprocess.Popen(['gsutil', 'cat', path], stdout=subprocess.PIPE)
+    try:
+        return split_bgzf_vcf_header(proc.stdout)
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+
+
+def tabix_index(path):
+    """
+    Indexes a block-gzipped VCF with `tabix`, writing `path.tbi`. Remote files are indexed from a local copy.
 
-    return(vds
-           .annotate_samples_expr('sa.pca = gs.filter(g => g.isCalled && va.pca_af > 0.0 && va.pca_af < 1.0).map(g => let p = va.pca_af in (g.gt - 2 * p) / sqrt(%d * 2 * p * (1 - p)) * va.pca_loadings).sum()' % n_variants)
-           .annotate_samples_expr('sa.pca = {%s}' % arr_to_struct_expr)
+    :param str path: Path to the .vcf.bgz file
+    """
+    if not is_remote_path(path):
+        subprocess.check_call(['tabix', '-f', '-p', 'vcf', _local_path(path)])
+        return
+    tmp_dir = tempfile.mkdtemp(prefix='gnomad_tabix_')
+    try:
+        local_path = os.path.join(tmp_dir, 'shard.vcf.gz')
+        gsutil_fetch(path, local_path)
+        subprocess.check_call(['tabix', '-f', '-p', 'vcf', local_path])
+        subprocess.check_call(['gsutil', '-q', 'cp', local_path + '.tbi', path + '.tbi'])
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@profiled()
+def export_sites_vcf_shards(vds, output_dir, contigs=None, info_root='va.info', ignore=[], n_threads=8, tabix=True):
+    """
+    Exports a sites-only VCF per contig (`output_dir/<contig>.vcf.bgz`, block-gzipped), in parallel.
+    Each shard only reads the partitions of its contig (see `filter_intervals`).
+    The shards can be concatenated into a single VCF using `concatenate_vcf_shards`.
+
+    :param VariantDataset vds: Input VDS
+    :param str output_dir: Output directory
+    :param list of str contigs: Contigs to export (default: all the contigs present in the data)
+    :param str info_root: Root of the INFO annotations (see `prepare_vcf_info`)
+    :param list of str ignore: Regexes of the INFO fields to drop
+    :param int n_threads: Number of shards exported concurrently
+    :param bool tabix: Whether to tabix-index the shards
+    :return: Paths of the shards, in karyotypic order
+    :rtype: list of str
+    """
+    vds = prepare_vcf_info(vds.drop_samples(), info_root, ignore)
+    if contigs is None:
+        contigs = vds.query_variants('variants.map(v => v.contig).collect().toSet')
+    contigs = sorted([str(c) for c in contigs], key=contig_sort_key)
+    output_dir = output_dir.rstrip('/')
+
+    def export_shard(contig):
+        path = '%s/%s.vcf.bgz' % (output_dir, contig)
+        logger.info("Exporting %s", path)
+        vds.filter_intervals(Interval.parse(contig)).export_vcf(path)
+        if tabix:
+            tabix_index(path)
+        return path
+
+    pool = ThreadPool(max(1, min(n_threads, len(contigs))))
+    try:
+        return pool.map(bind_to_step(export_shard), contigs)
+    finally:
+        pool.close()
+
+
+def concatenate_vcf_shards(shards, output, tabix=True, n_threads=8):
+    """
+    Concatenates block-gzipped VCF shards (e.g. from `export_sites_vcf_shards`, in that order) into a single
+    block-gzipped VCF, keeping the header of the first shard.
+
+    BGZF files remain valid when concatenated, so the shards are joined as compressed bytes (like `bcftools concat --naive`):
+    only the blocks containing the header of each shard are decompressed, and the rest of each shard is copied as is.
+    A local `output` is written directly; a remote one is assembled from headerless parts with `gsutil compose`.
+
+    :param list of str shards: Paths of the shards (all with the same samples)
+    :param str output: Output path (.vcf.bgz)
+    :param bool tabix: Whether to tabix-index the output
+    :param int n_threads: Number of shards processed concurrently
+    """
+    pool = ThreadPool(max(1, min(n_threads, len(shards))))
+    try:
+        splits = pool.map(read_vcf_shard_header, shards)
+        columns = [header.rstrip('\n').split('\n')[-1] for header, _, _ in splits]
+        if any(c != columns[0] for c in columns):
+            raise ValueError("VCF shards have different samples, cannot concatenate them")
+
+        if not is_remote_path(output):
+            with open(_local_path(output), 'wb') as out:
+                out.write(bgzf_compress(splits[0][0]))
+                for shard, (_, records, offset) in zip(shards, splits):
+                    out.write(records)
+                    if is_remote_path(shard):
+                        cat = subprocess.Popen(['gsutil', 'cat', '-r', '%d-' % offset, shard], stdout=subprocess.PIPE)
+                        shutil.copyfileobj(cat.stdout, out)
+                        cat.stdout.close()
+                        if cat.wait():
+                            raise subprocess.CalledProcessError(cat.returncode, 'gsutil cat %s' % shard)
+                    else:
+                        with open(_local_path(shard), 'rb') as f:
+                            f.seek(offset)
+                            shutil.copyfileobj(f, out)
+                out.write(BGZF_EOF)
+        else:
+            parts_dir = '%s.parts.%s' % (output, uuid.uuid4().hex)
+
+            def upload(data, path):
+                proc = subprocess.Popen(['gsutil', '-q', 'cp', '-', path], stdin=subprocess.PIPE)
+                proc.communicate(data)
+                if proc.returncode:
+                    raise subprocess.CalledProcessError(proc.returncode, 'gsutil cp - %s' % path)
+
+            def write_parts(i):
+                shard, (_, records, offset) = shards[i], splits[i]
+                parts = []
+                if records:
+                    parts.append('%s/%05d_header_records.bgz' % (parts_dir, i))
+                    upload(records, parts[-1])
+                if offset == 0:
+                    parts.append(shard)
+                else:
+                    parts.append('%s/%05d_records.bgz' % (parts_dir, i))
+                    cat = subprocess.Popen(['gsutil', 'cat', '-r', '%d-' % offset, shard], stdout=subprocess.PIPE)
+                    subprocess.check_call(['gsutil', '-q', 'cp', '-', parts[-1]], stdin=cat.stdout)
+                    cat.stdout.close()
+                    if cat.wait():
+                        raise subprocess.CalledProcessError(cat.returncode, 'gsutil cat %s' % shard)
+                return parts
+
+            try:
+                upload(bgzf_compress(splits[0][0]), '%s/header.bgz' % parts_dir)
+                upload(BGZF_EOF, '%s/eof.bgz' % parts_dir)
+                parts = ['%s/header.bgz' % parts_dir] + [p for ps in pool.map(write_parts, range(len(shards))) for p in ps] + ['%s/eof.bgz' % parts_dir]
+                subprocess.check_call(['gsutil', '-q', 'compose'] + parts[:GSUTIL_COMPOSE_MAX_COMPONENTS] + [output])
+                for start in range(GSUTIL_COMPOSE_MAX_COMPONENTS, len(parts), GSUTIL_COMPOSE_MAX_COMPONENTS - 1):
+                    subprocess.check_call(['gsutil', '-q', 'compose', output] + parts[start:start + GSUTIL_COMPOSE_MAX_COMPONENTS - 1] + [output])
+            finally:
+                remove_path(parts_dir)
+    finally:
+        pool.close()
+
+    if tabix:
+        tabix_index(output)
+
+
+def get_pc_loadings_kt(pc_vds, pca_loadings_root='va.pca_loadings', pca_af_root=None, output_path=None, overwrite=False):
+    """
+    Computes the per-variant inputs of `pc_project` as a compact KeyTable keyed by `v`, with:
+    - loadings: Struct{ PC1: Double, PC2: Double, ...} of the PC loadings (so the number of PCs is in the schema)
+    - af: the alternate allele frequency of the variant in the PCA samples
+    - norm: the genotype normalization factor 1 / sqrt(2 * af * (1 - af)), or 0 for monomorphic variants
+    All variants with loadings and a defined af are kept: monomorphic variants do not contribute to the scores but are
+    counted in the number of variants used to scale them, as in the original `pc_project`.
+
+    When `output_path` is given, the table is written there along with a fingerprint of its inputs
+    (`<output_path>.fingerprint.json`: loadings root, af root, samples, variant schema and a summary of the loadings).
+    It is read back on subsequent calls with the same inputs, and recomputed when the inputs differ.
+
+    :param VariantDataset pc_vds: VDS containing the PC loadings for the variants
+    :param str pca_loadings_root: Annotation root for the loadings. Can be either an Array[Double] or a Struct{ PC1: Double, PC2: Double, ...}
+    :param str pca_af_root: Annotation containing the allele frequency of the variants (computed from the `pc_vds` genotypes if not set)
+    :param str output_path: Path where to cache the table
+    :param bool overwrite: Whether to recompute the table if it is already present at `output_path`
+    :return: Loadings KeyTable
+    :rtype: KeyTable
+    """
+    loadings_type = get_ann_type(pca_loadings_root, pc_vds.variant_schema)
+    if isinstance(loadings_type, TStruct):
+        pcs = ['%s.%s' % (pca_loadings_root, f.name) for f in loadings_type.fields]
+    else:
+        lengths = pc_vds.query_variants('variants.filter(v => isDefined(%s)).map(v => %s.length).take(1)' % (pca_loadings_root, pca_loadings_root))
+        if not lengths:
+            raise ValueError("No variant has defined loadings in %s" % pca_loadings_root)
+        n_pcs = lengths[0]
+        pcs = ['%s[%d]' % (pca_loadings_root, i) for i in range(n_pcs)]
+
+    if output_path:
+        n_variants, loadings_sum = pc_vds.query_variants(['variants.count()', 'variants.map(v => %s).sum()' % " + ".join(pcs)])
+        inputs_fingerprint = fingerprint({'pca_loadings_root': pca_loadings_root, 'pca_af_root': pca_af_root,
+                                          'sample_ids': pc_vds.sample_ids, 'variant_schema': str(pc_vds.variant_schema),
+                                          'n_variants': n_variants, 'loadings_sum': repr(loadings_sum)})
+        fingerprint_path = output_path + '.fingerprint.json'
+        if not overwrite:
+            if read_json(fingerprint_path, {}).get('fingerprint') == inputs_fingerprint:
+                return pc_vds.hc.read_table(output_path)
+            logger.info("No PC loadings table matching the inputs found at %s, computing it.", output_path)
+
+    kt = (pc_vds.filter_multi()
+          .annotate_variants_expr('va = {loadings: {%s}, af: %s}' % (", ".join(['PC%d: %s' % (i + 1, pc) for i, pc in enumerate(pcs)]),
+                                                                     pca_af_root if pca_af_root else 'gs.callStats(g => v).AF[1]'))
+          .filter_variants_expr('!isMissing(va.loadings) && !isMissing(va.af)')
+          .variants_table()
+          .annotate(['loadings = va.loadings', 'af = va.af',
+                     'norm = if (va.af > 0.0 && va.af < 1.0) 1.0 / sqrt(2.0 * va.af * (1.0 - va.af)) else 0.0'])
+          .select(['v', 'loadings', 'af', 'norm']))
+
+    if output_path:
+        remove_path(fingerprint_path)
+        kt.write(output_path, overwrite=True)
+        write_json(fingerprint_path, {'fingerprint': inputs_fingerprint})
+        kt = pc_vds.hc.read_table(output_path)
+    return kt
+
+
+def pc_project(vds, pc_vds=None, pca_loadings_root='va.pca_loadings', loadings_kt=None, n_pcs=None):
+    """
+    Projects samples in `vds` on PCs computed in `pc_vds`, in a single pass over `vds`.
+    Scores are scaled by 1 / sqrt(number of variants of `vds` with loadings and a defined af in `pc_vds`).
+
+    :param VariantDataset vds: VDS containing the samples to project
+    :param VariantDataset pc_vds: VDS containing the PC loadings for the variants (not needed if `loadings_kt` is given)
+    :param str pca_loadings_root: Annotation root for the loadings. Can be either an Array[Double] or a Struct{ PC1: Double, PC2: Double, ...}
+    :param KeyTable loadings_kt: Precomputed loadings table (see `get_pc_loadings_kt`)
+    :param int n_pcs: Number of PCs to project on (by default, all PCs of the loadings table)
+    :return: VDS with the scores in `sa.pca` as a Struct{ PC1: Double, PC2: Double, ...}
+    :rtype: VariantDataset
+    """
+    if loadings_kt is None:
+        loadings_kt = get_pc_loadings_kt(pc_vds, pca_loadings_root)
+
+    loadings_type = [f.typ for f in loadings_kt.schema.fields if f.name == 'loadings'][0]
+    pcs = [f.name for f in loadings_type.fields]
+    if n_pcs is not None:
+        pcs = pcs[:n_pcs]
+
+    arr_to_struct_expr = ",".join(['%s: sa.pca.sums[%d] * s' % (pc, i) for i, pc in enumerate(pcs)])
+
+    return (vds.filter_multi()
+            .annotate_variants_table(loadings_kt, root='va.pca')
+            .filter_variants_expr('isDefined(va.pca)')
+            .annotate_variants_expr('va.pca = {loadings: [%s], af: va.pca.af, norm: va.pca.norm}' % ", ".join(['va.pca.loadings.%s' % pc for pc in pcs]))
+            .annotate_samples_expr('sa.pca = {sums: gs.filter(g => g.isCalled).map(g => (g.gt - 2.0 * va.pca.af) * va.pca.norm * va.pca.loadings).sum(), '
+                                   'n_variants: gs.count()}')
+            .annotate_samples_expr('sa.pca = let s = 1.0 / sqrt(sa.pca.n_variants.toDouble()) in {%s}' % arr_to_struct_expr)
     )
 
 
+def pc_project_local(gts, loadings, afs, block_size=10000):
+    """
+    Projects samples on PCs locally with NumPy, e.g. for small cohorts. Computes the same scores as `pc_project`,
+    processing variants in blocks of `block_size`.
+
+    The loadings and allele frequencies of a loadings table can be obtained with `collect_pc_loadings`.
+
+    :param array gts: Alternate allele counts as an n_samples x n_variants matrix (NaN when missing)
+    :param array loadings: PC loadings as an n_variants x n_pcs matrix
+    :param array afs: Allele frequencies of the variants
+    :param int block_size: Number of variants per block
+    :return: Scores as an n_samples x n_pcs matrix
+    :rtype: numpy.ndarray
+    """
+    import numpy as np
+
+    gts = np.asarray(gts, dtype=float)
+    loadings = np.asarray(loadings, dtype=float)
+    afs = np.asarray(afs, dtype=float)
+
+    keep = ~np.isnan(afs) & ~np.isnan(loadings).any(axis=1)
+    gts, loadings, afs = gts[:, keep], loadings[keep], afs[keep]
+    polymorphic = (afs > 0) & (afs < 1)
+    norms = np.zeros(len(afs))
+    norms[polymorphic] = 1.0 / np.sqrt(2.0 * afs[polymorphic] * (1.0 - afs[polymorphic]))
+
+    scores = np.zeros((gts.shape[0], loadings.shape[1]))
+    for start in range(0, gts.shape[1], block_size):
+        block = (gts[:, start:start + block_size] - 2.0 * afs[start:start + block_size]) * norms[start:start + block_size]
+        block[np.isnan(block)] = 0.0
+        scores += block.dot(loadings[start:start + block_size])
+
+    return scores / np.sqrt(gts.shape[1])
+
+
+def collect_pc_loadings(loadings_kt):
+    """
+    Collects a loadings table (see `get_pc_loadings_kt`) for `pc_project_local`
+
+    :param KeyTable loadings_kt: Loadings table
+    :return: Variants, loadings (n_variants x n_pcs) and allele frequencies
+    :rtype: (list of Variant, numpy.ndarray, numpy.ndarray)
+    """
+    import numpy as np
+
+    loadings_type = [f.typ for f in loadings_kt.schema.fields if f.name == 'loadings'][0]
+    rows = loadings_kt.collect()
+    return [r.v for r in rows], np.array([[getattr(r.loadings, f.name) for f in loadings_type.fields] for r in rows]), np.array([r.af for r in rows])
+
+
+def iter_list_data(input_file):
+    """
+    Streams the (stripped) lines of a text file, without copying it locally.
+    Works on local paths and any Hadoop-readable URL (e.g. gs://), and decompresses gzip / bgzip files.
+
+    :param str input_file: Path to the file
+    :return: Generator of lines
+    :rtype: generator of str
+    """
+    with _open_text(resolve_resource(input_file)) as f:
+        for line in f:
+            yield line.strip()
+
+
+def iter_list_data_chunks(input_file, chunk_size=100000):
+    """
+    Streams the (stripped) lines of a text file in lists of `chunk_size` lines (see `iter_list_data`)
+
+    :param str input_file: Path to the file
+    :param int chunk_size: Number of lines per chunk
+    :return: Generator of lists of lines
+    :rtype: generator of list of str
+    """
+    chunk = []
+    for line in iter_list_data(input_file):
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def read_list_data(input_file):
-    if input_file.startswith('gs://'):
-        hadoop_copy(input_file, 'file:///' + input_file.split("/")[-1])
-        f = gzip.open("/" + os.path.basename(input_file)) if input_file.endswith('gz') else open( "/" + os.path.basename(input_file))
-    else:
-        f = gzip.open(input_file) if input_file.endswith('gz') else open(input_file)
-    output = []
-    for line in f:
-        output.append(line.strip())
-    f.close()
-    return output
+    return list(iter_list_data(input_file))
 
 
 def rename_samples(vds, input_file, filter_to_samples_in_file=False):
-    names = {old: new for old, new in [x.split("\t") for x in read_list_data(input_file)]}
-    logger.info("Found %d samples for renaming in input file %s." % (len(names.keys()), input_file))
-    logger.info("Renaming %d samples found in VDS" % len(set(names.keys()).intersection(set(vds.sample_ids)) ))
+    """
+    Renames the samples of a VDS given a tab-delimited file of old and new names.
+    The file is streamed and only the names of the samples present in the VDS are kept in memory.
+
+    :param VariantDataset vds: Input VDS
+    :param str input_file: Path to the file with the old and new sample names (no header)
+    :param bool filter_to_samples_in_file: Whether to only keep the samples found in the file
+    :return: VDS with renamed samples
+    :rtype: VariantDataset
+    """
+    sample_ids = set(vds.sample_ids)
+    names = {}
+    n_lines = 0
+    for line in iter_list_data(input_file):
+        if not line:
+            continue
+        n_lines += 1
+        old, new = line.split("\t")
+        if old in sample_ids:
+            names[old] = new
+    logger.info("Found %d samples for renaming in input file %s." % (n_lines, input_file))
+    logger.info("Renaming %d samples found in VDS" % len(names))
 
     if filter_to_samples_in_file:
         vds = vds.filter_samples_list(names.keys())
     return vds.rename_samples(names)
 
 
-def filter_low_conf_regions(vds, filter_lcr=True, filter_decoy=True, high_conf_regions=None):
+_interval_index_cache = {}
+
+
+def _open_text(path):
+    """
+    Opens a (possibly gzipped) text file for reading: plain local paths are read directly and any other URL
+    (e.g. gs://, hdfs://) through Hadoop.
+
+    :param str path: Path to the file
+    :return: File-like object
+    """
+    if is_remote_path(path):
+        return hadoop_read(path)
+    path = path[len('file://'):] if path.startswith('file://') else path
+    return gzip.open(path) if path.endswith('gz') else open(path)
+
+
+def parse_interval(line):
+    """
+    Parses an interval in one of the formats accepted by `KeyTable.import_interval_list`:
+    `contig:start-end` or tab-delimited `contig start end [strand target]`, with 1-based inclusive coordinates.
+
+    :param str line: Interval line
+    :return: (contig, start, end) or None for header and empty lines
+    :rtype: (str, int, int)
+    """
+    line = line.strip()
+    if not line or line.startswith(('@', '#', 'track', 'browser')):
+        return None
+    fields = line.split('\t')
+    if len(fields) >= 3:
+        return fields[0], int(fields[1]), int(fields[2])
+    match = re.match(r'^(\S+):(\d+)-(\d+)$', line)
+    if match is None:
+        raise ValueError("Could not parse interval: %s" % line)
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
+
+def merge_intervals(intervals):
+    """
+    Sorts and merges overlapping or adjacent intervals.
+
+    :param iterable of (str, int, int) intervals: Intervals (contig, start, end) with 1-based inclusive coordinates
+    :return: Sorted, non-overlapping intervals
+    :rtype: list of (str, int, int)
+    """
+    merged = []
+    for contig, start, end in sorted(intervals):
+        if merged and merged[-1][0] == contig and start <= merged[-1][2] + 1:
+            merged[-1] = (contig, merged[-1][1], max(merged[-1][2], end))
+        else:
+            merged.append((contig, start, end))
+    return merged
+
+
+def intersect_intervals(intervals1, intervals2):
+    """
+    Intersects two lists of sorted, non-overlapping intervals (as output by `merge_intervals`).
+
+    :param list of (str, int, int) intervals1: First intervals
+    :param list of (str, int, int) intervals2: Second intervals
+    :return: Sorted, non-overlapping intervals contained in both inputs
+    :rtype: list of (str, int, int)
+    """
+    result = []
+    i = j = 0
+    while i < len(intervals1) and j < len(intervals2):
+        (c1, s1, e1), (c2, s2, e2) = intervals1[i], intervals2[j]
+        if c1 == c2 and max(s1, s2) <= min(e1, e2):
+            result.append((c1, max(s1, s2), min(e1, e2)))
+        if (c1, e1) < (c2, e2):
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def subtract_intervals(intervals1, intervals2):
+    """
+    Removes the positions in `intervals2` from `intervals1`, both sorted and non-overlapping (as output by `merge_intervals`).
+
+    :param list of (str, int, int) intervals1: Intervals to subtract from
+    :param list of (str, int, int) intervals2: Intervals to subtract
+    :return: Sorted, non-overlapping intervals in `intervals1` but not in `intervals2`
+    :rtype: list of (str, int, int)
+    """
+    result = []
+    j = 0
+    for contig, start, end in intervals1:
+        while j < len(intervals2) and (intervals2[j][0], intervals2[j][2]) < (contig, start):
+            j += 1
+        k = j
+        while start <= end and k < len(intervals2) and intervals2[k][0] == contig and intervals2[k][1] <= end:
+            if intervals2[k][1] > start:
+                result.append((contig, start, intervals2[k][1] - 1))
+            start = max(start, intervals2[k][2] + 1)
+            k += 1
+        if start <= end:
+            result.append((contig, start, end))
+    return result
+
+
+def get_interval_index(path):
+    """
+    Returns the sorted and merged intervals of an interval file (see `parse_interval` for the formats).
+    The merged intervals are cached in memory and on local disk (in `get_cache_dir('intervals')`, keyed by the SHA-1
+    of the file content), so that each file is only parsed and merged once.
+
+    :param str path: Path to the interval file (local, or any Hadoop-readable URL)
+    :return: Sorted, non-overlapping intervals (contig, start, end) with 1-based inclusive coordinates
+    :rtype: list of (str, int, int)
+    """
+    if path in _interval_index_cache:
+        return _interval_index_cache[path]
+
+    with _open_text(resolve_resource(path)) as f:
+        lines = f.readlines()
+    index_path = os.path.join(get_cache_dir('intervals'), '{}.intervals'.format(hash_content(lines)))
+
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            intervals = [parse_interval(line) for line in f]
+    else:
+        intervals = merge_intervals(x for x in (parse_interval(line) for line in lines) if x is not None)
+        with open(index_path + '.tmp', 'w') as f:
+            f.writelines(['{}\t{}\t{}\n'.format(*x) for x in intervals])
+        os.rename(index_path + '.tmp', index_path)
+        logger.info("Merged %d lines from %s into %d intervals", len(lines), path, len(intervals))
+
+    _interval_index_cache[path] = intervals
+    return intervals
+
+
+def intervals_to_hail(intervals):
+    """
+    Converts intervals with 1-based inclusive coordinates to Hail (half-open) `Interval`s
+
+    :param list of (str, int, int) intervals: Intervals (contig, start, end)
+    :return: Hail intervals
+    :rtype: list of Interval
+    """
+    return [Interval(Locus(contig, start), Locus(contig, end + 1)) for contig, start, end in intervals]
+
+
+def filter_low_conf_regions(vds, filter_lcr=True, filter_decoy=True, high_conf_regions=None,
+                            lcr_intervals=lcr_intervals_path, decoy_intervals=decoy_intervals_path):
     """
     Filters low-confidence regions
 
+    The interval files are merged once (see `get_interval_index`) and all regions are combined into a single
+    set of intervals, applied with a single `filter_intervals`.
+
     :param VariantDataset vds: VDS to filter
     :param bool filter_lcr: Whether to filter LCR regions
     :param bool filter_decoy: Wheter to filter Segdup regions
-    :param list of str high_conf_regions: Paths to set of high confidence regions to restrict to (union of regions)
-    :return:
+    :param list of str high_conf_regions: Paths to set of high confidence regions to restrict to (intersection of regions)
+    :param str lcr_intervals: Path to the LCR intervals
+    :param str decoy_intervals: Path to the decoy intervals
+    :return: Filtered VDS
+    :rtype: VariantDataset
     """
 
-    if filter_lcr:
-        vds = vds.filter_variants_table(KeyTable.import_interval_list(lcr_intervals_path), keep=False)
+    excluded = merge_intervals(
+        [x for path, do_filter in [(lcr_intervals, filter_lcr), (decoy_intervals, filter_decoy)] if do_filter
+         for x in get_interval_index(path)])
 
-    if filter_decoy:
-        vds = vds.filter_variants_table(KeyTable.import_interval_list(decoy_intervals_path), keep=False)
+    if high_conf_regions:
+        included = reduce(intersect_intervals, [get_interval_index(region) for region in high_conf_regions])
+        return vds.filter_intervals(intervals_to_hail(subtract_intervals(included, excluded)), keep=True)
 
-    if high_conf_regions is not None:
-        for region in high_conf_regions:
-            vds = vds.filter_variants_table(KeyTable.import_interval_list(region), keep=True)
+    if excluded:
+        return vds.filter_intervals(intervals_to_hail(excluded), keep=False)
 
     return vds
 
 
+def split_top_level(expr, sep=','):
+    """
+    Splits an expression on `sep` characters that are not nested in brackets, strings or backquoted names.
+
+    :param str expr: Expression
+    :param str sep: Separator character
+    :return: Parts of the expression
+    :rtype: list of str
+    """
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    i = 0
+    while i < len(expr):
+        c = expr[i]
+        if quote:
+            if c == '\\':
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c in '"`\'':
+            quote = c
+        elif c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+        elif c == sep and depth == 0:
+            parts.append(expr[start:i])
+            start = i + 1
+        i += 1
+    parts.append(expr[start:])
+    return [x.strip() for x in parts if x.strip()]
+
+
+def parse_annotation_expr(expr):
+    """
+    Parses the assignments of an annotation expression (e.g. `va.a = va.b + 1, va.c = 2`)
+
+    :param str expr: Annotation expression
+    :return: List of (path, value expression)
+    :rtype: list of (str, str)
+    """
+    assignments = []
+    for part in split_top_level(expr):
+        match = re.match(r'^\s*((?:\w+|`[^`]*`)(?:\.(?:\w+|`[^`]*`))*)\s*=(?![=>])(.*)$', part, re.DOTALL)
+        if match is None:
+            raise ValueError("Could not parse annotation expression: %s" % part)
+        assignments.append((match.group(1), match.group(2).strip()))
+    return assignments
+
+
+def get_path_components(path):
+    return tuple(x.strip('`') for x in re.findall(r'`[^`]*`|[^.`]+', path))
+
+
+def get_read_paths(expr, roots=('va',)):
+    """
+    Returns the annotation paths read by an expression (e.g. `va.info.AC` for `va.info.AC[0] > 1`)
+
+    :param str expr: Expression
+    :param tuple of str roots: Annotation roots to look for
+    :return: Set of paths, as tuples of path components
+    :rtype: set of tuple
+    """
+    expr = re.sub(r'"(?:[^"\\]|\\.)*"', '""', expr)
+    return {get_path_components(m.group(0)) for m in
+            re.finditer(r'(?<![\w.`])(?:%s)(?![\w`])(?:\.(?:\w+|`[^`]*`))*' % '|'.join(roots), expr)}
+
+
+def paths_overlap(paths1, paths2):
+    """
+    Returns whether any path of `paths1` is equal to, contains or is contained in any path of `paths2`
+
+    :param iterable of tuple paths1: Paths, as tuples of path components
+    :param iterable of tuple paths2: Paths, as tuples of path components
+    :rtype: bool
+    """
+    return any(x[:len(y)] == y[:len(x)] for x in paths1 for y in paths2)
+
+
+class VariantAnnotationPlan(object):
+    """
+    Lazily collects variant annotation and filter expressions, and applies them with as few `annotate_variants_expr`
+    and `filter_variants_expr` calls as possible, while keeping the results of applying them one at a time:
+    - Annotations are added to the current `annotate_variants_expr` unless they read an annotation written in it
+      (all expressions of an `annotate_variants_expr` are evaluated on its input annotations)
+    - Filters are moved before the annotations they do not depend on, and consecutive filters are combined
+
+    E.g.
+    plan = VariantAnnotationPlan(vds)
+    plan.annotate('va.a = va.x + 1').filter('va.y > 0').annotate('va.b = va.z')
+    vds = plan.execute()  # filter_variants_expr('va.y > 0').annotate_variants_expr(['va.a = va.x + 1', 'va.b = va.z'])
+    """
+
+    def __init__(self, vds):
+        """
+        :param VariantDataset vds: Input VDS
+        """
+        self.vds = vds
+        self.stages = []
+
+    def annotate(self, expr, same_input=False):
+        """
+        Adds annotation expressions to the plan
+
+        :param str or list of str expr: Annotation expression(s), as given to `annotate_variants_expr`
+        :param bool same_input: When set, the expressions are evaluated on the same input annotations (as they would be in a single `annotate_variants_expr`) rather than one after the other
+        :return: The plan
+        :rtype: VariantAnnotationPlan
+        """
+        assignments = [(path, value) for e in ([expr] if isinstance(expr, basestring) else expr) for path, value in parse_annotation_expr(e)]
+        groups = [assignments] if same_input else [[x] for x in assignments]
+        for group in groups:
+            if not group:
+                continue
+            reads = set().union(*[get_read_paths(value) for path, value in group])
+            last = self.stages[-1] if self.stages else None
+            if last is None or last['type'] != 'annotate' or paths_overlap(reads, last['writes']):
+                last = {'type': 'annotate', 'exprs': [], 'writes': set()}
+                self.stages.append(last)
+            for path, value in group:
+                last['exprs'].append('{} = {}'.format(path, value))
+                last['writes'].add(get_path_components(path))
+        return self
+
+    def filter(self, expr, keep=True):
+        """
+        Adds a variant filter to the plan
+
+        :param str expr: Filter expression, as given to `filter_variants_expr`
+        :param bool keep: Whether to keep (or remove) the variants for which `expr` is true
+        :return: The plan
+        :rtype: VariantAnnotationPlan
+        """
+        reads = get_read_paths(expr)
+        i = len(self.stages)
+        while i > 0 and self.stages[i - 1]['type'] == 'annotate' and not paths_overlap(reads, self.stages[i - 1]['writes']):
+            i -= 1
+        previous = self.stages[i - 1] if i > 0 else None
+        if keep and previous is not None and previous['type'] == 'filter' and previous['keep']:
+            previous['exprs'].append(expr)
+        else:
+            self.stages.insert(i, {'type': 'filter', 'exprs': [expr], 'keep': keep})
+        return self
+
+    @property
+    def n_stages(self):
+        """
+        :return: Number of Hail calls needed to execute the plan
+        :rtype: int
+        """
+        return len(self.stages)
+
+    def execute(self):
+        """
+        Applies the plan
+
+        :return: Annotated and filtered VDS
+        :rtype: VariantDataset
+        """
+        vds = self.vds
+        for stage in self.stages:
+            if stage['type'] == 'annotate':
+                vds = vds.annotate_variants_expr(stage['exprs'])
+            elif len(stage['exprs']) == 1:
+                vds = vds.filter_variants_expr(stage['exprs'][0], keep=stage['keep'])
+            else:
+                vds = vds.filter_variants_expr(' && '.join(['(%s)' % x for x in stage['exprs']]), keep=stage['keep'])
+        return vds
+
+
+class VEPCache(object):
+    """
+    Persistent cache of VEP annotations keyed by variant, so that only variants never seen before are sent to VEP.
+
+    The cache is stored under `root` (local or remote) as sites-only VDS shards (`root/shards/<id>.vds`, with the
+    VEP annotation in `va.vep`), listed in `root/manifest.json` along with the VEP config used to compute them.
+    Each `annotate` call appends the novel variants as a new shard; `compact` merges the shards into one.
+    """
+
+    def __init__(self, root, vep_config=vep_config):
+        """
+        :param str root: Directory of the cache (e.g. gs://gnomad/annotations/vep_cache)
+        :param str vep_config: VEP config the cached annotations are computed with
+        """
+        self.root = root.rstrip('/')
+        self.vep_config = vep_config
+
+    @property
+    def manifest_path(self):
+        return self.root + '/manifest.json'
+
+    def load_manifest(self):
+        """
+        :return: Dictionary with the `vep_config` and the list of `shards` paths
+        :rtype: dict
+        """
+        manifest = read_json(self.manifest_path, {'vep_config': self.vep_config, 'shards': []})
+        if manifest['shards'] and manifest['vep_config'] != self.vep_config:
+            raise ValueError("VEP cache {} was computed with {}, not {}".format(self.root, manifest['vep_config'], self.vep_config))
+        return manifest
+
+    def save_manifest(self, manifest):
+        if not is_remote_path(self.root):
+            get_dir(self.root)
+        write_json(self.manifest_path, manifest)
+
+    def read(self, hc):
+        """
+        :param HailContext hc: HailContext
+        :return: Sites-only VDS with all cached annotations in `va.vep`, or None if the cache is empty
+        :rtype: VariantDataset
+        """
+        shards = self.load_manifest()['shards']
+        if not shards:
+            return None
+        vdses = [hc.read(path) for path in shards]
+        return vdses[0].union(*vdses[1:]) if len(vdses) > 1 else vdses[0]
+
+    def add(self, vds):
+        """
+        Writes a new shard to the cache
+
+        :param VariantDataset vds: Sites-only VDS with `va.vep` (and no other annotation), for variants not in the cache
+        :return: The shard, read back from the cache
+        :rtype: VariantDataset
+        """
+        manifest = self.load_manifest()
+        path = '{}/shards/{}.vds'.format(self.root, uuid.uuid4().hex)
+        logger.info("Writing VEP cache shard %s", path)
+        vds.write(path)
+        manifest['shards'].append(path)
+        self.save_manifest(manifest)
+        return vds.hc.read(path)
+
+    def compact(self, hc):
+        """
+        Merges all the shards of the cache into a single shard
+
+        :param HailContext hc: HailContext
+        """
+        manifest = self.load_manifest()
+        if len(manifest['shards']) < 2:
+            return
+        path = '{}/shards/{}.vds'.format(self.root, uuid.uuid4().hex)
+        self.read(hc).write(path)
+        old_shards = manifest['shards']
+        manifest['shards'] = [path]
+        self.save_manifest(manifest)
+        for shard in old_shards:
+            remove_path(shard)
+
+    def annotate(self, vds, root='va.vep', vep_func=None, update=True):
+        """
+        Annotates a VDS with VEP: variants missing from the cache (anti-join) are annotated with `vep_func` and, when
+        `update` is set, added to the cache. All annotations are then joined back from the cache.
+
+        :param VariantDataset vds: Input VDS
+        :param str root: Where to put the VEP annotation
+        :param function vep_func: Function annotating a sites-only VDS with `va.vep` (default: `vds.vep(self.vep_config)`)
+        :param bool update: Whether to add the novel variants to the cache
+        :return: Annotated VDS
+        :rtype: VariantDataset
+        """
+        if vep_func is None:
+            vep_func = lambda x: x.vep(self.vep_config, root='va.vep')
+
+        cache_vds = self.read(vds.hc)
+        novel_vds = VariantDataset.from_table(vds.variants_table().select(['v']))
+        if cache_vds is not None:
+            novel_vds = (novel_vds.annotate_variants_vds(cache_vds, expr='va.cached = isDefined(vds)')
+                         .filter_variants_expr('va.cached', keep=False))
+
+        n_novel = novel_vds.count_variants()
+        logger.info("%d variants not found in VEP cache %s", n_novel, self.root)
+        if n_novel:
+            novel_vds = vep_func(novel_vds).annotate_variants_expr('va = {vep: va.vep}')
+            if update:
+                novel_vds = self.add(novel_vds)
+            cache_vds = novel_vds if cache_vds is None else cache_vds.union(novel_vds)
+
+        if cache_vds is None:
+            return vds
+        return vds.annotate_variants_vds(cache_vds, expr='%s = vds.vep' % root)
+
+
+@profiled()
+def cached_vep(vds, cache, root='va.vep', vep_config=vep_config, vep_func=None):
+    """
+    Runs VEP on the variants that are not in `cache` only (see `VEPCache`)
+
+    :param VariantDataset vds: Input VDS
+    :param VEPCache cache: VEP cache, or the path to its root
+    :param str root: Where to put the VEP annotation
+    :param str vep_config: VEP config (when `cache` is a path)
+    :param function vep_func: Function annotating a sites-only VDS with `va.vep` (default: `vds.vep(vep_config)`)
+    :return: Annotated VDS
+    :rtype: VariantDataset
+    """
+    if not isinstance(cache, VEPCache):
+        cache = VEPCache(cache, vep_config)
+    return cache.annotate(vds, root, vep_func)
+
+
 def process_consequences(vds, vep_root='va.vep', genes_to_string=True):
     """
     Adds most_severe_consequence (worst consequence for a transcript) into [vep_root].transcript_consequences,
-    and worst_csq and worst_csq_suffix (worst consequence across transcripts) into [vep_root]
+    and worst_csq, worst_csq_suffix, lof and worst_csq_genes (worst consequence across transcripts) into [vep_root]
+
+    All annotations are computed in a single `annotate_variants_expr`: consequence terms are mapped to their rank in
+    CSQ_ORDER using `global.csq_ranks`, each transcript is ranked once and the worst consequence is the minimum rank.
+    The suffix (see CSQ_SUFFIXES) is given by the most severe LoF / PolyPhen prediction across all transcripts.
 
     :param VariantDataset vds: Input VDS
     :param str vep_root: Root for vep annotation (probably va.vep)
+    :param bool genes_to_string: Whether to output worst_csq_genes as a `|`-delimited String rather than a Set
     :return: VDS with better formatted consequences
     :rtype: VariantDataset
     """
-    if vep_root + '.worst_csq' in flatten_struct(vds.variant_schema, root='va'):
-        vds = (vds.annotate_variants_expr('%(vep)s.transcript_consequences = '
-                                          ' %(vep)s.transcript_consequences.map('
-                                          '     csq => drop(csq, most_severe_consequence)'
-                                          ')' % {'vep': vep_root}))
-    vds = (vds.annotate_global('global.csqs', CSQ_ORDER, TArray(TString()))
-           .annotate_variants_expr(
-        '%(vep)s.transcript_consequences = '
-        '   %(vep)s.transcript_consequences.map(csq => '
-        '   let worst_csq = global.csqs.find(c => csq.consequence_terms.toSet().contains(c)) in'
-        # '   let worst_csq_suffix = if (csq.filter(x => x.lof == "HC").length > 0)'
-        # '       worst_csq + "-HC" '
-        # '   else '
-        # '       if (csq.filter(x => x.lof == "LC").length > 0)'
-        # '           worst_csq + "-LC" '
-        # '       else '
-        # '           if (csq.filter(x => x.polyphen_prediction == "probably_damaging").length > 0)'
-        # '               worst_csq + "-probably_damaging"'
-        # '           else'
-        # '               if (csq.filter(x => x.polyphen_prediction == "possibly_damaging").length > 0)'
-        # '                   worst_csq + "-possibly_damaging"'
-        # '               else'
-        # '                   worst_csq in'
-        '   merge(csq, {most_severe_consequence: worst_csq'
-        # ', most_severe_consequence_suffix: worst_csq_suffix'
-        '})'
-        ')' % {'vep': vep_root}
-    ).annotate_variants_expr(
-        '%(vep)s.worst_csq = global.csqs.find(c => %(vep)s.transcript_consequences.map(x => x.most_severe_consequence).toSet().contains(c)),'
-        '%(vep)s.worst_csq_suffix = '
-        'let csq = global.csqs.find(c => %(vep)s.transcript_consequences.map(x => x.most_severe_consequence).toSet().contains(c)) in '
-        'if (%(vep)s.transcript_consequences.filter(x => x.lof == "HC" && x.lof_flags == "").length > 0)'
-        '   csq + "-HC" '
-        'else '
-        '   if (%(vep)s.transcript_consequences.filter(x => x.lof == "HC").length > 0)'
-        '       csq + "-HC-flag" '
-        '   else '
-        '       if (%(vep)s.transcript_consequences.filter(x => x.lof == "LC").length > 0)'
-        '           csq + "-LC" '
-        '       else '
-        '           if (%(vep)s.transcript_consequences.filter(x => x.polyphen_prediction == "probably_damaging").length > 0)'
-        '               csq + "-probably_damaging"'
-        '           else'
-        '               if (%(vep)s.transcript_consequences.filter(x => x.polyphen_prediction == "possibly_damaging").length > 0)'
-        '                   csq + "-possibly_damaging"'
-        '               else'
-        '                   if (%(vep)s.transcript_consequences.filter(x => x.polyphen_prediction == "benign").length > 0)'
-        '                       csq + "-benign"'
-        '                   else'
-        '                       csq' % {'vep': vep_root}
-    ).annotate_variants_expr(
-        '{vep}.lof = "-HC" ~ {vep}.worst_csq_suffix, '
-        '{vep}.worst_csq_genes = {vep}.transcript_consequences'
-        '.filter(x => x.most_severe_consequence == {vep}.worst_csq).map(x => x.gene_symbol).toSet(){genes_to_string}'.format(
-            vep=vep_root, genes_to_string='.mkString("|")' if genes_to_string else '')
-    ))
-    return vds
+    return annotate_csq_globals(vds).annotate_variants_expr(get_process_consequences_expr(vds.variant_schema, vep_root, genes_to_string))
 
 
-def filter_vep_to_canonical_transcripts(vds, vep_root='va.vep'):
-    return vds.annotate_variants_expr(
-        '{vep}.transcript_consequences = '
-        '   {vep}.transcript_consequences.filter(csq => csq.canonical == 1)'.format(vep=vep_root))
+def annotate_csq_globals(vds):
+    """
+    Adds the consequences (global.csqs) and their ranks (global.csq_ranks) used by `get_process_consequences_expr`
+
+    :param VariantDataset vds: Input VDS
+    :return: VDS with global.csqs and global.csq_ranks
+    :rtype: VariantDataset
+    """
+    return (vds
+            .annotate_global('global.csqs', CSQ_ORDER, TArray(TString()))
+            .annotate_global('global.csq_ranks', {csq: i for i, csq in enumerate(CSQ_ORDER)}, TDict(TString(), TInt())))
+
+
+def get_process_consequences_expr(schema, vep_root='va.vep', genes_to_string=True):
+    """
+    Returns the annotation expression used by `process_consequences` (requires the globals added by `annotate_csq_globals`)
+
+    :param TStruct schema: Variant schema
+    :param str vep_root: Root for vep annotation (probably va.vep)
+    :param bool genes_to_string: Whether to output worst_csq_genes as a `|`-delimited String rather than a Set
+    :return: Annotation expression
+    :rtype: str
+    """
+    vep_fields = [f.name for f in get_ann_type(vep_root, schema).fields]
+    csq_fields = [f.name for f in get_ann_type(vep_root + '.transcript_consequences', schema).element_type.fields]
+
+    suffix_rank_expr = ' else '.join(['if (orElse(%s, false)) %d' % (criteria, i) for i, (suffix, criteria) in enumerate(CSQ_SUFFIXES)]
+                                     ) + ' else %d' % len(CSQ_SUFFIXES)
+
+    processed_fields = OrderedDict([
+        ('transcript_consequences', 'ranked.map(x => merge({0}, {{most_severe_consequence: global.csqs[x.rank]}}))'.format(
+            'drop(x.csq, most_severe_consequence)' if 'most_severe_consequence' in csq_fields else 'x.csq')),
+        ('worst_csq', 'worst_csq'),
+        ('worst_csq_suffix', 'suffix'),
+        ('lof', '"-HC" ~ suffix'),
+        ('worst_csq_genes', 'ranked.filter(x => x.rank == worst_rank).map(x => x.csq.gene_symbol).toSet(){}'.format(
+            '.mkString("|")' if genes_to_string else ''))
+    ])
+    vep_struct = ['{}: {}'.format(quote_field_name(f), processed_fields.pop(f) if f in processed_fields else '{}.{}'.format(vep_root, quote_field_name(f)))
+                  for f in vep_fields]
+    vep_struct.extend(['{}: {}'.format(f, expr) for f, expr in processed_fields.iteritems()])
+
+    return (
+        '{vep} = '
+        'let ranked = {vep}.transcript_consequences.map(csq => {{csq: csq, rank: '
+        '   let ranks = csq.consequence_terms.map(c => global.csq_ranks.get(c)).filter(r => isDefined(r)) in '
+        '   orMissing(!ranks.isEmpty, ranks.min())'
+        '}}) in '
+        'let worst_rank = let ranks = ranked.map(x => x.rank).filter(r => isDefined(r)) in orMissing(!ranks.isEmpty, ranks.min()) in '
+        'let worst_csq = global.csqs[worst_rank] in '
+        'let suffix = orMissing(isDefined(worst_csq), '
+        '   worst_csq + {suffixes}[ranked.map(r => let x = r.csq in {suffix_rank}).min()]'
+        ') in '
+        '{{{struct}}}'.format(vep=vep_root,
+                              suffixes='[{}]'.format(', '.join(['"{}"'.format(s) for s, c in CSQ_SUFFIXES] + ['""'])),
+                              suffix_rank=suffix_rank_expr,
+                              struct=', '.join(vep_struct))
+    )
 
 
+def get_canonical_transcripts_expr(vep_root='va.vep'):
+    return ('{vep}.transcript_consequences = '
+            '   {vep}.transcript_consequences.filter(csq => csq.canonical == 1)'.format(vep=vep_root))
+
+
+def get_synonymous_transcripts_expr(vep_root='va.vep'):
+    return ('{vep}.transcript_consequences = '
+            '   {vep}.transcript_consequences.filter(csq => csq.most_severe_consequence == "synonymous_variant")'.format(vep=vep_root))
+
+
+def filter_vep_to_canonical_transcripts(vds, vep_root='va.vep'):
+    return vds.annotate_variants_expr(get_canonical_transcripts_expr(vep_root))
 
 
 def filter_vep(vds, vep_root='va.vep', canonical=False, synonymous=False):
@@ -670,18 +1942,19 @@ def filter_vep(vds, vep_root='va.vep', canonical=False, synonymous=False):
 
 
     """
-    if canonical: vds = filter_vep_to_canonical_transcripts(vds, vep_root=vep_root)
-    vds = process_consequences(vds)
-    if synonymous: vds = filter_vep_to_synonymous_variants(vds, vep_root=vep_root)
+    vds = annotate_csq_globals(vds)
+    plan = VariantAnnotationPlan(vds)
+    if canonical: plan.annotate(get_canonical_transcripts_expr(vep_root))
+    plan.annotate(get_process_consequences_expr(vds.variant_schema, vep_root))
+    if synonymous: plan.annotate(get_synonymous_transcripts_expr(vep_root))
 
-    return (vds.filter_variants_expr('!{}.transcript_consequences.isEmpty'.format(vep_root))
-            .annotate_variants_expr('{0} = select({0}, transcript_consequences)'.format(vep_root)))
+    return (plan.filter('!{}.transcript_consequences.isEmpty'.format(vep_root))
+            .annotate('{0} = select({0}, transcript_consequences)'.format(vep_root))
+            .execute())
 
 
 def filter_vep_to_synonymous_variants(vds, vep_root='va.vep'):
-    return vds.annotate_variants_expr(
-        '{vep}.transcript_consequences = '
-        '   {vep}.transcript_consequences.filter(csq => csq.most_severe_consequence == "synonymous_variant")'.format(vep=vep_root))
+    return vds.annotate_variants_expr(get_synonymous_transcripts_expr(vep_root))
 
 
 def filter_rf_variants(vds):
@@ -692,9 +1965,10 @@ def filter_rf_variants(vds):
     :return: vds with only RF variants removed
     :rtype: VariantDataset
     """
-    return (vds
-            .annotate_variants_expr(index_into_arrays(['va.info.AS_FilterStatus']))
-            .filter_variants_expr('va.info.AS_FilterStatus.toArray() != ["RF"]'))
+    return (VariantAnnotationPlan(vds)
+            .annotate(index_into_arrays(['va.info.AS_FilterStatus']))
+            .filter('va.info.AS_FilterStatus.toArray() != ["RF"]')
+            .execute())
 
 
 def toSSQL(s):
@@ -760,7 +2034,7 @@ def melt_kt(kt, columns_to_melt, key_column_name='variable', value_column_name='
             .drop('comb'))
 
 
-def melt_kt_grouped(kt, columns_to_melt, value_column_names, key_column_name='variable'):
+def melt_kt_grouped(kt, columns_to_melt, value_column_names, key_column_name='variable', keys=None):
     """
     Go from wide to long for a group of variables, or from:
 
@@ -797,14 +2071,28 @@ def melt_kt_grouped(kt, columns_to_melt, value_column_names, key_column_name='va
 
     Note that len(value_column_names) == len(columns_to_melt[i]) for all in columns_to_melt
 
+    `columns_to_melt` can also be the name of an Array[Struct] column (e.g. frequencies from `annotate_frequencies`),
+    in which case each element is melted into a row, with its `value_column_names` fields as values and its label in
+    `keys` (e.g. from `get_freq_labels`) as key.
+
     :param KeyTable kt: Input KeyTable
-    :param dict of list of str columns_to_melt: Which columns to spread out
-    :param list of str value_column_names: What to call the value columns
+    :param dict of list of str columns_to_melt: Which columns to spread out (or the name of an Array[Struct] column)
+    :param list of str value_column_names: What to call the value columns (or the fields to keep for an Array[Struct] column)
     :param str key_column_name: What to call the key column
+    :param list of str keys: Keys of the elements of an Array[Struct] column
     :return: melted Key Table
     :rtype: KeyTable
     """
 
+    if isinstance(columns_to_melt, basestring):
+        return (kt
+                .annotate('comb = let keys = [{keys}] in range({col}.length).map(i => merge({{k: keys[i]}}, select({col}[i], {fields})))'.format(
+                    keys=', '.join(['"%s"' % k for k in keys]), col=columns_to_melt, fields=', '.join(value_column_names)))
+                .drop(columns_to_melt)
+                .explode('comb')
+                .annotate('{} = comb.k, {}'.format(key_column_name, ', '.join(['{0} = comb.{0}'.format(x) for x in value_column_names])))
+                .drop('comb'))
+
     if any([len(value_column_names) != len(v) for v in columns_to_melt.values()]):
         logger.warning('Length of columns_to_melt sublist is not equal to length of value_column_names')
         logger.warning('value_column_names = %s', value_column_names)
@@ -827,24 +2115,130 @@ def melt_kt_grouped(kt, columns_to_melt, value_column_names, key_column_name='va
             .drop('comb'))
 
 
-def filter_samples_then_variants(vds, sample_criteria, callstats_temp_location='va.callstats_temp', min_allele_count=0):
+FREQ_GROUPS = ['adj', 'raw']
+
+
+def get_freq_meta(pops, sexes):
+    """
+    Returns the strata computed by `annotate_frequencies`, in order: for each of adj and raw, all samples, then each
+    population, each sex and each population / sex combination.
+
+    :param list of str pops: Populations
+    :param list of str sexes: Sexes
+    :return: Strata as dicts with the `group` (adj or raw) and, where applicable, `pop` and `sex`
+    :rtype: list of dict
+    """
+    freq_meta = []
+    for group in FREQ_GROUPS:
+        freq_meta.append({'group': group})
+        freq_meta.extend({'group': group, 'pop': pop} for pop in pops)
+        freq_meta.extend({'group': group, 'sex': sex} for sex in sexes)
+        freq_meta.extend({'group': group, 'pop': pop, 'sex': sex} for pop in pops for sex in sexes)
+    return freq_meta
+
+
+def get_freq_labels(freq_meta):
     """
-    Filter out samples, then generate callstats to filter variants, then filter out monomorphic variants
-    Assumes split VDS
-    TODO: add split logic
+    Returns labels for frequency strata (e.g. `adj`, `adj_afr`, `raw_afr_female`)
+
+    :param list of dict freq_meta: Strata (see `get_freq_meta`)
+    :return: Labels
+    :rtype: list of str
+    """
+    return ['_'.join([x[k] for k in ['group', 'pop', 'sex'] if k in x]) for x in freq_meta]
+
+
+def annotate_frequencies(vds, pops, sexes=None, pop_expr='sa.meta.population', sex_expr='sa.meta.sex',
+                         adj_expr=None, root='va.freq', freq_meta_root='global.freq_meta'):
+    """
+    Computes AC, AN, AF and Hom for all adj / raw x population x sex strata (see `get_freq_meta`) in a single pass
+    over the genotypes. Each called genotype is counted once in a `counter()` keyed by its
+    (population, sex, adj, number of non-ref alleles) cell, and all strata are summed from these counts.
+
+    The frequencies are stored in `root` as an Array[Struct{AC, AN, AF, Hom}] and the corresponding strata in `freq_meta_root`
+    as an Array[Dict[String, String]]. The frequencies can be converted to a long table using `melt_kt_grouped`, e.g.:
+    melt_kt_grouped(vds.variants_table().annotate('freq = va.freq').select(['v', 'freq']), 'freq', ['AC', 'AN', 'AF', 'Hom'], 'stratum', keys=get_freq_labels(freq_meta))
+
+    Assumes a split VDS. Population and sex values are compared in lower case, and samples with a population or sex
+    not in `pops` / `sexes` only count towards the broader strata.
+
+    :param VariantDataset vds: Input VDS
+    :param list of str pops: Populations (e.g. GENOME_POPS or EXOME_POPS, compared in lower case)
+    :param list of str sexes: Sexes (default: those in SEXES, compared in lower case)
+    :param str pop_expr: Expression for the population of a sample
+    :param str sex_expr: Expression for the sex of a sample
+    :param str adj_expr: Expression for adj genotypes (default: ADJ_CRITERIA, or the adj bit of packed hardcalls)
+    :param str root: Where to put the frequencies
+    :param str freq_meta_root: Where to put the strata
+    :return: VDS with frequencies
+    :rtype: VariantDataset
+    """
+    pops = [pop.lower() for pop in pops]
+    sexes = [sex.lower() for sex in (sexes if sexes is not None else sorted(SEXES))]
+    if adj_expr is None:
+        adj_expr = get_adj_expr(vds)
+    freq_meta = get_freq_meta(pops, sexes)
+
+    def index_expr(expr, values):
+        # Matches the distinct sample values of `expr` in lower case, so that no string is transformed per genotype
+        sample_values = [x for x in vds.query_samples('samples.map(s => %s).collect().toSet' % expr) if x is not None]
+        matches = sorted([(x, values.index(x.lower())) for x in sample_values if x.lower() in values], key=lambda x: x[1])
+        return 'orElse(%s, %d)' % (' else '.join(['if (%s == %s) %d' % (expr, json.dumps(x), i) for x, i in matches] + [str(len(values))]), len(values))
+
+    def cell(pop, sex, adj, n):
+        return ((pop * (len(sexes) + 1) + sex) * 2 + adj) * 3 + n
+
+    n_cells = cell(len(pops), len(sexes), 1, 2) + 1
+
+    def stratum_expr(stratum):
+        pop_indices = [pops.index(stratum['pop'])] if 'pop' in stratum else range(len(pops) + 1)
+        sex_indices = [sexes.index(stratum['sex'])] if 'sex' in stratum else range(len(sexes) + 1)
+        adjs = [1] if stratum['group'] == 'adj' else [0, 1]
+
+        def count_expr(n_alleles):
+            return '[%s].map(i => c[i]).sum()' % ', '.join([str(cell(p, s, a, n)) for p in pop_indices for s in sex_indices for a in adjs for n in n_alleles])
+
+        return ('let ac = {het} + 2 * {hom} and an = 2 * {called} in '
+                '{{AC: ac, AN: an, AF: orMissing(an > 0, ac.toDouble / an.toDouble), Hom: {hom}}}'.format(
+            het=count_expr([1]), hom=count_expr([2]), called=count_expr([0, 1, 2])))
+
+    return (vds
+            .annotate_global(freq_meta_root, freq_meta, TArray(TDict(TString(), TString())))
+            .annotate_variants_expr(
+        '{root} = let counts = gs.filter(g => {call}.isCalled).map(g => '
+        '   let pop = {pop} and sex = {sex} in '
+        '   ((pop * {n_sexes} + sex) * 2 + (if (orElse({adj}, false)) 1 else 0)) * 3 + {call}.nNonRefAlleles'
+        ').counter() in '
+        'let c = range({n_cells}).map(i => orElse(counts.get(i), 0L)) in '
+        '[{strata}]'.format(root=root,
+                            call=get_call_expr(vds),
+                            pop=index_expr(pop_expr, pops),
+                            sex=index_expr(sex_expr, sexes),
+                            n_sexes=len(sexes) + 1,
+                            adj=adj_expr,
+                            n_cells=n_cells,
+                            strata=', '.join([stratum_expr(x) for x in freq_meta])))
+    )
+
+
+def filter_samples_then_variants(vds, sample_criteria, callstats_temp_location=None, min_allele_count=0, split=True):
+    """
+    Filter out samples, then filter out variants with an allele count of at most `min_allele_count` in the remaining
+    samples (monomorphic variants by default).
+    Only the non-reference allele counts are aggregated, directly in the variant filter.
 
     :param VariantDataset vds: Input VDS
     :param str sample_criteria: String to be passed to `filter_samples_expr` to filter samples
-    :param str callstats_temp_location: Temporary location for callstats to use to determine variants to drop
+    :param str callstats_temp_location: Deprecated, no longer used
     :param int min_allele_count: minimum allele count to filter (default 0 for monomorphic variants)
-
+    :param bool split: Whether the VDS is split. For unsplit VDSes, variants are kept if any of their alternate alleles passes the filter.
     :return: Filtered VDS
     :rtype: VariantDataset
     """
     vds = vds.filter_samples_expr(sample_criteria)
-    vds = vds.annotate_variants_expr('{} = gs.callStats(g => v)'.format(callstats_temp_location))
-    vds = vds.filter_variants_expr('{}.AC[1] > {}'.format(callstats_temp_location, min_allele_count))
-    return vds.annotate_variants_expr('va = drop(va, {})'.format(callstats_temp_location.split('.', 1)[-1]))
+    if split:
+        return vds.filter_variants_expr('gs.map(g => g.nNonRefAlleles).sum() > {}'.format(min_allele_count))
+    return vds.filter_variants_expr('gs.map(g => g.oneHotAlleles(v)).sum()[1:].exists(ac => ac > {})'.format(min_allele_count))
 
 
 def recompute_filters_by_allele(vds, AS_filters=None, indexed_into_array=False):
@@ -864,22 +2258,57 @@ def recompute_filters_by_allele(vds, AS_filters=None, indexed_into_array=False):
     return vds
 
 
-def split_vds_and_annotations(vds, AS_filters = None, extra_ann_expr=[]):
-    annotations, a_annotations, g_annotations, dot_annotations = get_numbered_annotations(vds, "va.info")
+def split_vds_and_annotations(vds, AS_filters=None, extra_ann_expr=[], vep_root='va.vep'):
+    """
+    Splits multi-allelics and their annotations in a single annotation pass after `split_multi`:
+    - A-based `va.info` annotations (according to their `Number` attribute) are indexed using `va.aIndex`
+    - VEP consequences are filtered to the split allele
+    - `va.filters` is recomputed from the split allele `AS_FilterStatus` (see `recompute_filters_by_allele`)
+    - G-based `va.info` annotations are dropped
 
-    as_filters = ["AC0", "RF"]
+    :param VariantDataset vds: Input VDS
+    :param list of str AS_filters: All possible AS filter values (default is ["AC0","RF"])
+    :param list of str extra_ann_expr: Additional annotation expressions, applied after the split annotations (in the same pass when they do not depend on them)
+    :param str vep_root: Root of the VEP annotations (ignored if not present in the VDS)
+    :return: Split VDS
+    :rtype: VariantDataset
+    """
     vds = vds.split_multi()
-    vds = vds.annotate_variants_expr(
-        index_into_arrays(a_based_annotations=["va.info." + a.name for a in a_annotations], vep_root='va.vep'))
-    if as_filters:
-        vds = recompute_filters_by_allele(vds, as_filters, True)
+    return (VariantAnnotationPlan(vds)
+            .annotate(get_split_annotations_expr(vds.variant_schema, AS_filters, vep_root), same_input=True)
+            .annotate(extra_ann_expr)
+            .execute())
+
+
+def get_split_annotations_expr(schema, AS_filters=None, vep_root='va.vep'):
+    """
+    Returns the annotation expressions used by `split_vds_and_annotations` after `split_multi`.
+    They are all evaluated on the annotations before the split, so they can be applied in a single `annotate_variants_expr`
+    (the G-based annotations drop comes first as it replaces the whole `va.info` struct).
+
+    :param TStruct schema: Variant schema of the split VDS
+    :param list of str AS_filters: All possible AS filter values (default is ["AC0","RF"])
+    :param str vep_root: Root of the VEP annotations (ignored if not present in the schema)
+    :return: Annotation expressions
+    :rtype: list of str
+    """
+    if AS_filters is None:
+        AS_filters = ["AC0", "RF"]
+
+    numbered_annotations = get_numbered_annotations(schema, "va.info")
+    a_annotations = [a.path for a in numbered_annotations['A']]
+    g_annotations = [a.field.name for a in numbered_annotations['G']]
+
     ann_expr = []
     if g_annotations:
-        ann_expr.extend(['va.info = drop(va.info, {0})'.format(",".join([a.name for a in g_annotations]))])
-    if extra_ann_expr:
-        ann_expr.extend(extra_ann_expr)
-    vds = vds.annotate_variants_expr(ann_expr)
-    return vds
+        ann_expr.append('va.info = drop(va.info, {0})'.format(",".join(g_annotations)))
+    ann_expr.extend(index_into_arrays(a_based_annotations=a_annotations,
+                                      vep_root=vep_root if ann_exists(vep_root, schema) else None))
+    if AS_filters and ann_exists('va.info.AS_FilterStatus', schema):
+        as_filter_status = ('va.info.AS_FilterStatus[va.aIndex - 1]' if 'va.info.AS_FilterStatus' in a_annotations
+                            else 'va.info.AS_FilterStatus.toSet().flatten()')
+        ann_expr.append('va.filters = va.filters.filter(x => !["{0}"].toSet.difference({1}).contains(x))'.format('","'.join(AS_filters), as_filter_status))
+    return ann_expr
 
 
 def quote_field_name(f):
@@ -996,13 +2425,10 @@ def replace_vds_variant_schema(vds, new_schema):
         return '{{{}}}'.format(",".join(field_expr))
 
     vds = vds.annotate_variants_expr('va = {}'.format(
-        get_schema_expr(new_schema, 'va', flatten_struct(vds.variant_schema, root='va', leaf_only=False))))
-
-    for path, field in flatten_struct(new_schema, root='va').iteritems():
-        if field.attributes:
-            vds = vds.set_va_attributes(path, field.attributes)
+        get_schema_expr(new_schema, 'va', get_schema_index(vds.variant_schema).fields)))
 
-    return vds
+    return update_va_attributes(vds, OrderedDict((path, field.attributes) for path, field in
+                                                 get_schema_index(new_schema).leaves.iteritems() if field.attributes))
 
 
 def unify_vds_schemas(vdses):